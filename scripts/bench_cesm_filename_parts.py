@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+"""
+benchmark batched parsing of CESM file names against per-file parsing,
+on a synthetic directory listing
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import yaml
+
+from src.data_catalog import (
+    libdir,
+    _cesm_filename_parts,
+    _cesm_filename_parts_batch,
+)
+
+parser = argparse.ArgumentParser(description="benchmark CESM file name parsing")
+parser.add_argument("--nfiles", type=int, default=1000000, help="number of file names")
+args = parser.parse_args()
+
+with open(os.path.join(libdir, "cesm_definitions.yml")) as f:
+    component_streams = yaml.full_load(f)["component_streams"]
+
+# synthetic listing, with realistic mix of streams, variables, and date strings
+rng = np.random.default_rng(0)
+streams = [stream for streams in component_streams.values() for stream in streams]
+datestrs = ["000101-001012", "0001-0100", "00010101-00101231"]
+filenames = [
+    f"b.e21.B1850.f09_g17.CMIP6-piControl.001.{stream}.VAR{var_ind:04d}.{datestr}.nc"
+    for stream, var_ind, datestr in zip(
+        rng.choice(streams, args.nfiles),
+        rng.integers(0, 2000, args.nfiles),
+        rng.choice(datestrs, args.nfiles),
+    )
+]
+
+time_start = time.time()
+fileparts_list = [_cesm_filename_parts(f, component_streams) for f in filenames]
+elapsed_per_file = time.time() - time_start
+print(
+    f"per-file: {elapsed_per_file:.2f}s, {args.nfiles / elapsed_per_file:.0f} files/s"
+)
+
+time_start = time.time()
+df = _cesm_filename_parts_batch(filenames, component_streams)
+elapsed_batch = time.time() - time_start
+print(f"batch: {elapsed_batch:.2f}s, {args.nfiles / elapsed_batch:.0f} files/s")
+print(f"speedup: {elapsed_per_file / elapsed_batch:.1f}")
+
+if df.to_dict("records") != fileparts_list:
+    raise ValueError("batch results differ from per-file results")
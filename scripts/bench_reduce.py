@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+"""
+benchmark regional reduction methods, on a synthetic POP sized grid,
+with 18 region masks
+"""
+
+import argparse
+import time
+
+import numpy as np
+import xarray as xr
+
+from src.utils_grid import CompactRegionMask
+from src.utils_reduce import RegionReducer, reduce_methods
+
+parser = argparse.ArgumentParser(description="benchmark regional reduction methods")
+parser.add_argument("--ntime", type=int, default=24, help="number of time levels")
+parser.add_argument("--nz", type=int, default=1, help="number of vertical levels")
+args = parser.parse_args()
+
+nlat, nlon, nregion = 384, 320, 18
+
+# region masks partitioning the ocean into latitude bands, plus a global mask
+rng = np.random.default_rng(0)
+ocean = rng.uniform(size=(nlat, nlon)) < 0.7
+band = np.arange(nlat)[:, np.newaxis] * (nregion - 1) // nlat
+rmask_vals = np.stack(
+    [ocean] + [ocean & (band == region) for region in range(nregion - 1)]
+).astype(np.float64)
+rmask = xr.DataArray(
+    rmask_vals,
+    dims=("region", "nlat", "nlon"),
+    coords={"region": [f"region_{region}" for region in range(nregion)]},
+)
+
+rmask_compact = CompactRegionMask.from_dense(rmask)
+print(f"region mask bytes: dense={rmask.nbytes}, compact={rmask_compact.nbytes}")
+
+weight = xr.DataArray(rng.uniform(size=(nlat, nlon)), dims=("nlat", "nlon"))
+dims, shape = ("time", "nlat", "nlon"), (args.ntime, nlat, nlon)
+if args.nz > 1:
+    weight = xr.DataArray(rng.uniform(size=args.nz), dims=("z_t",)) * weight
+    dims, shape = ("time", "z_t", "nlat", "nlon"), (args.ntime, args.nz, nlat, nlon)
+reduce_dims = [dim for dim in dims if dim != "time"]
+
+vals = rng.normal(size=shape).astype(np.float32)
+vals[..., ~ocean] = np.nan
+da = xr.DataArray(vals, dims=dims)
+
+results = {}
+for method in reduce_methods:
+    time_start = time.time()
+    reducer = RegionReducer(rmask_compact, weight, reduce_dims, method)
+    results[method] = reducer.average(da).values
+    print(f"{method}: {time.time() - time_start:.2f}s")
+
+for method in reduce_methods[1:]:
+    rel_err = np.nanmax(np.abs(results[method] / results["dense"] - 1.0))
+    print(f"{method}: max relative difference from dense={rel_err:.2e}")
@@ -1,6 +1,33 @@
 #! /usr/bin/env python
 
+import argparse
+
 from src.data_catalog import build_catalog
 from src.config import expr_metadata_fname
 
-build_catalog(expr_metadata_fname, clobber=True)
+parser = argparse.ArgumentParser(description="build data catalogs")
+parser.add_argument(
+    "--nworkers",
+    type=int,
+    default=8,
+    help="number of data sources that are scanned concurrently",
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="update existing catalogs, only rescanning new or changed directories",
+)
+parser.add_argument(
+    "--headers",
+    action="store_true",
+    help="add per-file header metadata to catalog entries that do not have it",
+)
+args = parser.parse_args()
+
+build_catalog(
+    expr_metadata_fname,
+    clobber=not args.incremental,
+    nworkers=args.nworkers,
+    incremental=args.incremental,
+    headers=args.headers,
+)
@@ -14,6 +14,10 @@ noaa_co2_flask_surface_dir = os.path.join(rootdir, "noaa_co2_flask_surface")
 
 grid_dir = os.path.join(rootdir, "grid")
 
+# directory of on-disk store of grid weights, region masks, and weight sums
+# set to None to disable the store
+grid_cache_dir = os.path.join(rootdir, "grid_cache")
+
 obspack_dir = os.path.join(
     os.path.sep,
     "glade",
@@ -25,4 +29,13 @@ obspack_dir = os.path.join(
 
 var_specs_fname = os.path.join(rootdir, "var_specs.yaml")
 
+# execution backend of tseries generation, one of exec_backend.backend_names
+# None uses ncar_jobqueue if it is available, and local_cluster otherwise
+# can be overridden with the environment variable TSERIES_BACKEND
+tseries_backend = None
+
+# memory per worker assumed when planning tseries generation, see tseries_plan
+# can be overridden with the environment variable TSERIES_WORKER_MEMORY
+tseries_worker_memory = "9GB"
+
 expr_metadata_fname = os.path.join(rootdir, "expr_metadata.yaml")
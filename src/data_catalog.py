@@ -1,80 +1,381 @@
 #! /usr/bin/env python
 import os
 import fnmatch
+import functools
+import itertools
+import json
 import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import logging
 
 import pandas as pd
 import numpy as np
 import yaml
+import netCDF4
+
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
 
 from src.config import rootdir
+from src.utils import tmp_fname
 
 logging.basicConfig(level=logging.INFO)
 
 libdir = os.path.join(rootdir, "lib_data_catalog")
+
+# database file name of active catalog, set by set_catalog
 active_database_file_name = None
 
+# columns stored as categoricals, and columns that key the precomputed lookup index
+categorical_columns = ["experiment", "component", "stream", "variable", "case"]
+index_key_columns = ["experiment", "component", "stream", "variable", "ensemble"]
+
+# sort order of catalog rows, and of query results
+sort_columns = ["sequence_order", "files"]
+
+# columns of per-file header metadata, added by add_header_metadata
+# var_dims and var_shape are comma separated strings
+# time_bound_first and time_bound_last are encoded values, in time_units
+header_columns = [
+    "var_dims",
+    "var_shape",
+    "var_dtype",
+    "time_len",
+    "time_bound_first",
+    "time_bound_last",
+    "time_units",
+    "time_calendar",
+    "file_size",
+]
+
+# in-process memo of indexed catalogs, keyed by database file name
+# values are (source_key, _IndexedCatalog), where source_key identifies the database file version
+_catalog_cache = {}
+_catalog_cache_lock = threading.Lock()
+# locks serializing reads of each database file, keyed by database file name,
+# so that reading one catalog does not block reading another
+_catalog_read_locks = {}
+
+
+class Catalog:
+    """
+    data catalog, backed by a catalog database file in libdir
+
+    Query methods are threadsafe. The catalog database is read on first use, and is
+    shared, through an in-process memo, by all Catalog objects for the same file.
+    """
+
+    def __init__(self, catalog_name, check_exists=True):
+        self.name = catalog_name
+        self.database_file_name = os.path.join(libdir, f"{catalog_name}.csv.gz")
+        if not os.path.exists(self.database_file_name) and check_exists:
+            raise OSError(f'cannot set catalog: "{catalog_name}" d.n.e.')
+
+    def __repr__(self):
+        return f"Catalog({self.name!r})"
+
+    def get_files(self, **kwargs):
+        """return files according to requested data."""
+        df_subset = self.find_in_index(**kwargs)
+
+        return df_subset.files.tolist()
+
+    def get_entries(self, **kwargs):
+        """Return a dictionary with all entries of query as lists."""
+        df_subset = self.find_in_index(**kwargs)
+        return {key: df_subset[key].tolist() for key in df_subset}
+
+    def find_in_index(self, **kwargs):
+        """Return subset of database according to requested data."""
+        return _read_catalog(self.database_file_name).find(**kwargs)
+
+    def version(self):
+        """
+        Return string identifying the version of the catalog database file.
+        The catalog database is not read.
+        """
+        return f"{self.name}:{_catalog_source_key(self.database_file_name)}"
+
+
+_active_catalog = None
+
 
 def set_catalog(catalog_name, check_exists=True):
     """Point to a catalog database file."""
-    # TODO: this is not threadsafe...whole thing should be a class
-    global active_database_file_name
-    active_database_file_name = os.path.join(libdir, f"{catalog_name}.csv.gz")
-    if not os.path.exists(active_database_file_name) and check_exists:
-        raise OSError(f'cannot set catalog: "{catalog_name}" d.n.e.')
+    global active_database_file_name, _active_catalog
+    catalog = Catalog(catalog_name, check_exists)
+    _active_catalog = catalog
+    active_database_file_name = catalog.database_file_name
     print(f"active catalog: {catalog_name}")
 
 
-def get_catalog():
-    if active_database_file_name is None:
+def get_active_catalog():
+    """return Catalog object that module-level query functions are applied to"""
+    catalog = _active_catalog
+    if catalog is None:
         raise ValueError("no catalog set.")
-    return os.path.basename(active_database_file_name).replace(".csv.gz", "")
+    return catalog
+
+
+def resolve_catalog(catalog=None):
+    """
+    return Catalog object for catalog
+    catalog can be a Catalog object, a catalog name, or None, for the active catalog
+    """
+    if catalog is None:
+        return get_active_catalog()
+    if isinstance(catalog, str):
+        return Catalog(catalog)
+    return catalog
+
+
+def get_catalog():
+    return get_active_catalog().name
 
 
 def get_files(**kwargs):
     """return files according to requested data.
 
     """
-    df_subset = find_in_index(**kwargs)
-
-    return df_subset.files.tolist()
+    return get_active_catalog().get_files(**kwargs)
 
 
 def get_entries(**kwargs):
     """Return a dictionary with all entries of query as lists."""
-    df_subset = find_in_index(**kwargs)
-    return {key: df_subset[key].tolist() for key in df_subset}
+    return get_active_catalog().get_entries(**kwargs)
 
 
 def find_in_index(**kwargs):
     """Return subset of database according to requested data.
     """
-    if active_database_file_name is None:
-        raise ValueError("no catalog set.")
+    return get_active_catalog().find_in_index(**kwargs)
 
-    df = pd.read_csv(active_database_file_name, index_col=0)
 
-    for key in kwargs.keys():
-        if key not in df.columns:
-            raise ValueError(f'"{key}" is not a column')
+class _IndexedCatalog:
+    """
+    catalog DataFrame, sorted by sort_columns, with a lookup index
 
-    query = np.ones(len(df), dtype=bool)
-    for key, val in kwargs.items():
-        if isinstance(val, list):
-            query_i = np.zeros(len(df), dtype=bool)
-            for vali in val:
-                query_i = query_i | (df[key] == vali)
+    The lookup index maps values of index_key_columns to positions of matching rows.
+    Queries that specify all of index_key_columns, except possibly ensemble, are
+    resolved through the lookup index, so their cost scales with the size of the
+    result, not the size of the catalog.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        # positions of rows matching each index_key_columns tuple
+        # rows with missing values in index_key_columns are not in the lookup index,
+        # their positions are kept, and they are queried like an unindexed catalog
+        if all(key in df.columns for key in index_key_columns):
+            self._key_positions = _group_positions(df, index_key_columns)
+            self._nan_positions = np.flatnonzero(
+                df[index_key_columns].isna().any(axis=1).values
+            )
         else:
-            query_i = df[key] == val
-        query = query & query_i
+            self._key_positions = {}
+            self._nan_positions = np.array([], dtype=int)
+        # ensemble values for each index_key_columns tuple, excluding ensemble
+        self._key_ensembles = {}
+        for key in self._key_positions:
+            self._key_ensembles.setdefault(key[:-1], []).append(key[-1])
+
+    def find(self, **kwargs):
+        """Return subset of catalog according to requested data."""
+        df = self.df
+
+        for key in kwargs.keys():
+            if key not in df.columns:
+                raise ValueError(f'"{key}" is not a column')
+
+        # drop repeated values, so that matching rows are not repeated
+        kwargs_lists = {
+            key: list(dict.fromkeys(val)) if isinstance(val, list) else [val]
+            for key, val in kwargs.items()
+        }
+
+        if not self._key_positions or not all(
+            key in kwargs_lists for key in index_key_columns[:-1]
+        ):
+            query = np.ones(len(df), dtype=bool)
+            for key, val in kwargs_lists.items():
+                query &= df[key].isin(val).values
+            return df.loc[query]
+
+        # resolve query through lookup index
+        keys = []
+        for key_prefix in itertools.product(
+            *[kwargs_lists[key] for key in index_key_columns[:-1]]
+        ):
+            ensembles = self._key_ensembles.get(key_prefix, [])
+            if "ensemble" in kwargs_lists:
+                ensembles = [
+                    ens for ens in ensembles if ens in kwargs_lists["ensemble"]
+                ]
+            keys.extend(key_prefix + (ens,) for ens in ensembles)
+        positions_list = [self._key_positions[key] for key in keys]
+        if len(self._nan_positions) > 0:
+            df_nan = df.iloc[self._nan_positions]
+            query = np.ones(len(df_nan), dtype=bool)
+            for key, val in kwargs_lists.items():
+                query &= df_nan[key].isin(val).values
+            positions_list.append(self._nan_positions[query])
+        if not positions_list:
+            return df.iloc[0:0]
+
+        # df is sorted, so sorting positions yields a sorted result
+        positions = np.sort(np.concatenate(positions_list))
+        df_subset = df.iloc[positions]
+
+        # apply remaining conditions to subset
+        residual_keys = [key for key in kwargs_lists if key not in index_key_columns]
+        if residual_keys:
+            query = np.ones(len(df_subset), dtype=bool)
+            for key in residual_keys:
+                query &= df_subset[key].isin(kwargs_lists[key]).values
+            df_subset = df_subset.loc[query]
+
+        return df_subset
+
+
+def _group_positions(df, columns):
+    """
+    return dict mapping tuples of values of columns to positions of matching rows
+    positions within each group are in increasing order
+    """
+    # this is much faster than groupby.indices when there are many groups
+    group_ids = df.groupby(columns, sort=False, observed=True).ngroup().values
+    order = np.argsort(group_ids, kind="stable")
+    # drop rows with missing values in columns, which have group_id -1
+    order = order[group_ids[order] >= 0]
+    if len(order) == 0:
+        return {}
+    group_starts = np.flatnonzero(np.diff(group_ids[order])) + 1
+    first_rows = order[np.insert(group_starts, 0, 0)]
+    keys = zip(*[df[column].values[first_rows].tolist() for column in columns])
+    return dict(zip(keys, np.split(order, group_starts)))
+
+
+def _read_catalog(database_file_name):
+    """
+    return _IndexedCatalog for database_file_name
+
+    The typed and sorted catalog DataFrame is memoized in-process, and in a binary
+    sidecar file, if pyarrow is available. Both are invalidated when the mtime or
+    size of database_file_name changes. The returned object is shared, and should
+    not be modified.
+    """
+    source_key = _catalog_source_key(database_file_name)
+    with _catalog_cache_lock:
+        read_lock = _catalog_read_locks.setdefault(database_file_name, threading.Lock())
+    with read_lock:
+        with _catalog_cache_lock:
+            cached = _catalog_cache.get(database_file_name)
+        if cached is not None and cached[0] == source_key:
+            return cached[1]
+
+        df = _read_catalog_sidecar(database_file_name, source_key)
+        if df is None:
+            df = _catalog_typed(_read_catalog_csv(database_file_name))
+            _write_catalog_sidecar(database_file_name, source_key, df)
+
+        indexed_catalog = _IndexedCatalog(df)
+        with _catalog_cache_lock:
+            _catalog_cache[database_file_name] = (source_key, indexed_catalog)
+
+    return indexed_catalog
+
+
+def _read_catalog_csv(database_file_name):
+    """
+    return catalog DataFrame read from database_file_name
+    var_dims and var_shape are read as strings, also if all of their values are
+    numbers, e.g., shapes of variables with a single dimension
+    """
+    return pd.read_csv(
+        database_file_name, index_col=0, dtype={"var_dims": str, "var_shape": str}
+    )
+
+
+def _catalog_typed(df):
+    """return copy of catalog df, with categorical columns, sorted by sort_columns"""
+    df = df.astype(
+        {key: "category" for key in categorical_columns if key in df.columns}
+    )
+    return df.sort_values(by=sort_columns, ascending=True, kind="mergesort")
+
 
-    return df.loc[query].sort_values(by=["sequence_order", "files"], ascending=True)
+def _catalog_source_key(database_file_name):
+    """return string identifying the version of database_file_name"""
+    stat = os.stat(database_file_name)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
 
 
-def build_catalog(collection_input_file, clobber=False):
-    """Generate a catalog from input file."""
+def _catalog_sidecar_fname(database_file_name):
+    """return name of binary sidecar file for database_file_name"""
+    return database_file_name.replace(".csv.gz", ".feather")
+
+
+def _read_catalog_sidecar(database_file_name, source_key):
+    """
+    return catalog DataFrame from sidecar file of database_file_name
+    return None if pyarrow is not available, or if sidecar is missing or out of date
+    """
+    if pyarrow is None:
+        return None
+    sidecar_fname = _catalog_sidecar_fname(database_file_name)
+    if not os.path.exists(sidecar_fname):
+        return None
+    try:
+        table = pyarrow.feather.read_table(sidecar_fname)
+    except (OSError, pyarrow.ArrowInvalid):
+        logging.warning(f"unable to read catalog sidecar {sidecar_fname}")
+        return None
+    metadata = table.schema.metadata or {}
+    if metadata.get(b"source_key", b"").decode() != source_key:
+        return None
+    return table.to_pandas()
+
+
+def _write_catalog_sidecar(database_file_name, source_key, df):
+    """write df to sidecar file of database_file_name, if pyarrow is available"""
+    if pyarrow is None:
+        return
+    sidecar_fname = _catalog_sidecar_fname(database_file_name)
+    table = pyarrow.Table.from_pandas(df, preserve_index=True)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"source_key"] = source_key.encode()
+    table = table.replace_schema_metadata(metadata)
+    # write to a temporary file and rename, so that concurrent readers never see a
+    # partially written sidecar
+    tmp_sidecar_fname = tmp_fname(sidecar_fname)
+    try:
+        pyarrow.feather.write_feather(table, tmp_sidecar_fname)
+        os.replace(tmp_sidecar_fname, sidecar_fname)
+    except OSError:
+        logging.warning(f"unable to write catalog sidecar {sidecar_fname}")
+        if os.path.exists(tmp_sidecar_fname):
+            os.remove(tmp_sidecar_fname)
+
+
+def build_catalog(
+    collection_input_file, clobber=False, nworkers=1, incremental=False, headers=False
+):
+    """
+    Generate a catalog from input file.
+    nworkers is the number of data sources (experiment ensemble members) that are
+    scanned concurrently.
+    If incremental is True, existing catalogs are updated, rescanning only data sources
+    that are new or whose attributes have changed, and directories whose mtime has
+    changed since the catalog was last built.
+    If headers is True, per-file header metadata is added to catalog entries that do
+    not have it, see add_header_metadata.
+    """
 
     # -- open the input file
     with open(collection_input_file) as f:
@@ -95,33 +396,182 @@ def build_catalog(collection_input_file, clobber=False):
                 raise ValueError(f"missing required column: {req_col}")
 
         set_catalog(catalog_name, check_exists=False)
-        if os.path.isfile(active_database_file_name) and not clobber:
-            continue
+        database_file_name = Catalog(
+            catalog_name, check_exists=False
+        ).database_file_name
+        if clobber or incremental or not os.path.isfile(database_file_name):
+            # -- build the catalog
+            if collection_type.lower() == "cesm":
+                build_method = _build_catalog_cesm
+
+            build_method(
+                database_file_name,
+                collection,
+                catalog_columns,
+                catalog_definition,
+                nworkers,
+                incremental,
+            )
 
-        # -- build the catalog
-        if collection_type.lower() == "cesm":
-            build_method = _build_catalog_cesm
+        if headers:
+            add_header_metadata(catalog_name, nworkers)
 
-        build_method(collection, catalog_columns, catalog_definition)
+
+def add_header_metadata(catalog_name, nworkers=1, clobber=False):
+    """
+    Add per-file header metadata, in header_columns, to entries of a catalog.
+    Only entries without header metadata are processed, unless clobber is True.
+    Headers are read by nworkers processes.
+    """
+    database_file_name = Catalog(catalog_name).database_file_name
+    df = _read_catalog_csv(database_file_name)
+    for col in header_columns:
+        if col not in df:
+            df[col] = np.nan
+
+    rows = df.index if clobber else df.index[df["file_size"].isna()]
+    if len(rows) == 0:
+        return
+
+    time_start = time.time()
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        headers = list(
+            executor.map(
+                _read_file_header,
+                df.loc[rows, "files"],
+                df.loc[rows, "variable"],
+                chunksize=max(1, len(rows) // (16 * nworkers)),
+            )
+        )
+    elapsed = time.time() - time_start
+    logging.info(
+        f"read {len(rows)} headers in {elapsed:.1f}s"
+        f" ({len(rows) / max(elapsed, 1.0e-6):.0f} files/s, nworkers={nworkers})"
+    )
+
+    df_headers = pd.DataFrame(
+        [header if header is not None else {} for header in headers],
+        index=rows,
+        columns=header_columns,
+    )
+    df[header_columns] = df[header_columns].astype(object)
+    df.loc[rows, header_columns] = df_headers
+    df.to_csv(database_file_name)
+
+
+def _read_file_header(path, varname):
+    """
+    return dict of header metadata, keyed by header_columns, of varname in path
+    return None if path cannot be read
+    """
+    try:
+        with netCDF4.Dataset(path) as ds:
+            var = ds.variables[varname]
+            header = {
+                "var_dims": ",".join(var.dimensions),
+                "var_shape": ",".join(str(dimlen) for dimlen in var.shape),
+                "var_dtype": var.dtype.name,
+            }
+            if "time" in ds.variables:
+                time_var = ds.variables["time"]
+                header["time_len"] = len(time_var)
+                time_var_bounds = time_var
+                if "bounds" in time_var.ncattrs():
+                    time_var_bounds = ds.variables[time_var.getncattr("bounds")]
+                if len(time_var) > 0:
+                    time_var_bounds.set_auto_mask(False)
+                    header["time_bound_first"] = float(np.min(time_var_bounds[0]))
+                    header["time_bound_last"] = float(np.max(time_var_bounds[-1]))
+                for key in ["units", "calendar"]:
+                    if key in time_var.ncattrs():
+                        header[f"time_{key}"] = time_var.getncattr(key)
+    except (OSError, KeyError) as err:
+        logging.warning(f"unable to read header of {varname} in {path}: {err}")
+        return None
+    header["file_size"] = os.path.getsize(path)
+    return header
+
+
+def entries_in_time_range(entries, time_range):
+    """
+    return subset of entries whose date_range overlaps time_range
+    time_range is a tuple (start_year, end_year), end_year is inclusive
+    entries without a parsable date_range are retained
+    """
+    if time_range is None:
+        return entries
+    years = (
+        entries["date_range"]
+        .astype(str)
+        .str.findall(r"\d+")
+        .map(lambda datestrs: datestrs if len(datestrs) == 2 else None)
+    )
+    start = years.map(lambda datestrs: int(datestrs[0][:4]) if datestrs else np.nan)
+    end = years.map(lambda datestrs: int(datestrs[1][:4]) if datestrs else np.nan)
+    keep = ~((start > time_range[1]) | (end < time_range[0]))
+    return entries.loc[keep.values]
+
+
+def file_header(entry):
+    """
+    return dict of header metadata of a catalog entry, with var_dims and var_shape
+    converted to tuples, return None if entry does not have header metadata
+    entry is a row of a DataFrame returned by find_in_index, or a dict
+    """
+    if "file_size" not in entry or pd.isna(entry["file_size"]):
+        return None
+    header = {key: entry[key] for key in header_columns}
+    header["var_dims"] = tuple(str(header["var_dims"]).split(","))
+    header["var_shape"] = tuple(
+        int(dimlen) for dimlen in str(header["var_shape"]).split(",")
+    )
+    return header
+
+
+def _catalog_state_fname(database_file_name):
+    """return name of file recording state of data sources of database_file_name"""
+    return database_file_name.replace(".csv.gz", ".state.json")
+
+
+def _read_catalog_state(database_file_name):
+    """return recorded state of database_file_name, None if it is not available"""
+    state_fname = _catalog_state_fname(database_file_name)
+    if not (os.path.isfile(database_file_name) and os.path.isfile(state_fname)):
+        return None
+    with open(state_fname, mode="r") as fptr:
+        return json.load(fptr)
+
+
+def _write_catalog_state(database_file_name, state):
+    """write state of data sources of database_file_name"""
+    with open(_catalog_state_fname(database_file_name), mode="w") as fptr:
+        json.dump(state, fptr, indent=1, sort_keys=True)
+
+
+def _json_normalized(obj):
+    """return obj as it would be after a round trip through json, e.g., tuples become lists"""
+    return json.loads(json.dumps(obj))
+
+
+# date string patterns in CESM filenames
+# must be in order of longer to shorter strings
+cesm_datestr_patterns = [
+    r"\d{12}Z-\d{12}Z",
+    r"\d{10}Z-\d{10}Z",
+    r"\d{10}-\d{10}",
+    r"\d{8}-\d{8}",
+    r"\d{6}-\d{6}",
+    r"\d{4}-\d{4}",
+    r"\d{6}",
+]
 
 
 def _extract_cesm_date_str(filename):
     """Extract a datastr from file name."""
 
-    # must be in order of longer to shorter strings
     # TODO: make this function return a date object as well as string
     # should it also return a freq?
-    datestrs = [
-        r"\d{12}Z-\d{12}Z",
-        r"\d{10}Z-\d{10}Z",
-        r"\d{10}-\d{10}",
-        r"\d{8}-\d{8}",
-        r"\d{6}-\d{6}",
-        r"\d{4}-\d{4}",
-        r"\d{6}",
-    ]
-
-    for datestr in datestrs:
+    for datestr in cesm_datestr_patterns:
         match = re.compile(datestr).findall(filename)
         if match:
             return match[0]
@@ -174,107 +624,383 @@ def _cesm_filename_parts(filename, component_streams):
     raise ValueError(f"could not identify CESM fileparts: {filename}")
 
 
-def _build_catalog_cesm(collection, catalog_columns, catalog_definition):
+def _cesm_filename_parts_batch(filenames, component_streams):
+    """
+    Extract each part of case.stream.variable.datestr.nc file pattern, for many files.
+    filenames is a list or pandas Series of file names.
+    Return DataFrame, with index of filenames, with columns case, component, stream,
+    variable, datestr. Rows of files that do not conform to the pattern are NaN.
+
+    Results are the same as those of _cesm_filename_parts. A match of the single regular
+    expression used here is only used if it is what _cesm_filename_parts would return,
+    i.e., if no datestr occurs before the matched datestr, and if the matched stream is
+    the first stream that _cesm_filename_parts finds, at the matched position. Files
+    that do not match the regular expression, or whose match is ambiguous, are parsed
+    with _cesm_filename_parts.
+    """
+    filenames = pd.Series(filenames, dtype=object)
+    stream_components, streams_before, regex = _cesm_filename_regex(
+        tuple(
+            (component, tuple(streams))
+            for component, streams in component_streams.items()
+        )
+    )
+    # a file name contains a match of some datestr pattern if and only if it contains a
+    # match of r"\d{6}" or r"\d{4}-\d{4}"
+    datestr_regex = re.compile(r"\d{4}(?:\d{2}|-\d{4})")
+
+    rows = []
+    for filename in filenames:
+        match = regex.match(filename)
+        if match is not None:
+            stream = match["stream"]
+            # datestr patterns are ordered by decreasing length, and the matched datestr
+            # extends to .nc, so it is the first datestr found in the file name if
+            # there is none before it
+            if (
+                datestr_regex.search(filename, 0, match.start("datestr")) is None
+                and filename.find(stream) == match.start("stream")
+                and not any(
+                    stream_loc in filename for stream_loc in streams_before[stream]
+                )
+            ):
+                rows.append(match.groupdict())
+                continue
+        rows.append({})
+    df = pd.DataFrame(
+        rows, index=filenames.index, columns=["case", "stream", "variable", "datestr"]
+    )
+    df.insert(1, "component", df["stream"].map(stream_components))
+
+    # fall back to per-file parsing for files that do not match regex unambiguously
+    for ind in df.index[df["stream"].isna()]:
+        fileparts = _cesm_filename_parts(filenames[ind], component_streams)
+        if fileparts is not None:
+            df.loc[ind, list(fileparts)] = list(fileparts.values())
+
+    return df
+
+
+@functools.lru_cache(maxsize=None)
+def _cesm_filename_regex(component_streams):
+    """
+    return dict mapping streams to components, dict mapping streams to the list of
+    streams that _cesm_filename_parts searches for before them, and compiled regular
+    expression that extracts case, stream, variable, and datestr from CESM file names
+    component_streams is a tuple of (component, tuple of streams) pairs
+    """
+    stream_components = {}
+    streams_before = {}
+    streams_searched = []
+    for component, streams in component_streams:
+        for stream in sorted(streams, key=lambda s: len(s), reverse=True):
+            stream_components.setdefault(stream, component)
+            streams_before.setdefault(stream, list(streams_searched))
+            streams_searched.append(stream)
+
+    # longer streams precede shorter ones in the alternation, to match longest stream
+    streams_sorted = sorted(stream_components, key=lambda s: len(s), reverse=True)
+    regex = re.compile(
+        r"^(?P<case>.+?)\."
+        + f"(?P<stream>{'|'.join(re.escape(stream) for stream in streams_sorted)})"
+        + r"\.(?P<variable>[^.]+)\."
+        + f"(?P<datestr>{'|'.join(cesm_datestr_patterns)})"
+        + r"\.nc$"
+    )
+    return stream_components, streams_before, regex
+
+
+def _build_catalog_cesm(
+    database_file_name,
+    collection,
+    catalog_columns,
+    catalog_definition,
+    nworkers=1,
+    incremental=False,
+):
     """Build a CESM data catalog."""
 
-    component_streams = catalog_definition["component_streams"]
+    # attributes of data sources that scans depend on
+    scan_keys = ["root_dir", "case", "exclude_dirs", "component_attrs"]
+    data_sources = {}
+    for experiment, ensembles in collection["data_sources"].items():
+        for ens, d_attrs in enumerate(ensembles):
+            scan_attrs = {
+                key: val
+                for key, val in d_attrs.items()
+                if key in catalog_columns or key in scan_keys
+            }
+            data_sources[f"{experiment}:{ens}"] = {
+                "experiment": experiment,
+                "ens": ens,
+                "d_attrs": d_attrs,
+                "scan_attrs": _json_normalized(scan_attrs),
+            }
+
+    state_prev = _read_catalog_state(database_file_name) if incremental else None
+    if state_prev is not None:
+        if state_prev["catalog_definition"] != _json_normalized(catalog_definition):
+            logging.info("catalog definition changed, rebuilding catalog from scratch")
+            state_prev = None
+    sources_prev = state_prev["data_sources"] if state_prev is not None else {}
+
+    # for data sources whose scan attributes are unchanged,
+    # only list directories whose mtime has changed
+    def scan(key):
+        data_source = data_sources[key]
+        dir_mtimes_prev = None
+        if key in sources_prev:
+            if sources_prev[key]["scan_attrs"] == data_source["scan_attrs"]:
+                dir_mtimes_prev = sources_prev[key]["dir_mtimes"]
+        return _scan_data_source_cesm(
+            data_source["experiment"],
+            data_source["ens"],
+            data_source["d_attrs"],
+            catalog_columns,
+            catalog_definition,
+            dir_mtimes_prev,
+        )
+
+    # scan data sources concurrently, directory walks are dominated by file system latency
+    time_start = time.time()
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        scan_results = dict(zip(data_sources, executor.map(scan, data_sources)))
+    elapsed = time.time() - time_start
+    nfiles = sum(scan_result["nfiles"] for scan_result in scan_results.values())
+    logging.info(
+        f"scanned {nfiles} files in {elapsed:.1f}s"
+        f" ({nfiles / max(elapsed, 1.0e-6):.0f} files/s, nworkers={nworkers})"
+    )
+
+    # build DataFrame of new entries in one pass
+    fs = [entry for scan_result in scan_results.values() for entry in scan_result["fs"]]
+    df = pd.DataFrame(fs)
+
+    if state_prev is not None:
+        df_prev = _read_catalog_csv(database_file_name)
+        drop = _catalog_rows_to_drop(df_prev, sources_prev, scan_results)
+        logging.info(f"removing {drop.sum()} entries, adding {len(df)} entries")
+        df = pd.concat([df_prev.loc[~drop], df], ignore_index=True, sort=False)
+
+    df = df.reindex(
+        columns=list(df.columns) + [col for col in catalog_columns if col not in df]
+    )
+
+    df.to_csv(database_file_name)
+
+    state = {
+        "catalog_definition": _json_normalized(catalog_definition),
+        "data_sources": {
+            key: {
+                "scan_attrs": data_source["scan_attrs"],
+                "dir_mtimes": scan_results[key]["dir_mtimes"],
+            }
+            for key, data_source in data_sources.items()
+        },
+    }
+    _write_catalog_state(database_file_name, state)
+
+
+def _catalog_rows_to_drop(df_prev, sources_prev, scan_results):
+    """
+    return boolean array of rows of df_prev that are superseded by scan_results
+    or that belong to data sources that have been removed
+    rows belong to a data source if their experiment, ensemble, and case are those of
+    the data source, and their file is in the data source's root_dir
+    """
+    dirnames = df_prev["files"].str.rpartition("/")[0].values
+    drop = np.zeros(len(df_prev), dtype=bool)
+    for key, source_prev in sources_prev.items():
+        experiment, _, ens = key.rpartition(":")
+        scan_attrs = source_prev["scan_attrs"]
+        in_source = (
+            (df_prev["experiment"] == experiment).values
+            & (df_prev["ensemble"] == int(scan_attrs.get("ensemble", ens))).values
+            & (df_prev["case"] == scan_attrs["case"]).values
+            & _in_dir(dirnames, scan_attrs["root_dir"])
+        )
+        if key not in scan_results or not scan_results[key]["incremental"]:
+            # data source removed, or rescanned from scratch
+            drop |= in_source
+        else:
+            dir_mtimes = scan_results[key]["dir_mtimes"]
+            stale_dirs = set(scan_results[key]["scanned_dirs"])
+            stale_dirs.update(
+                d for d in source_prev["dir_mtimes"] if d not in dir_mtimes
+            )
+            drop |= in_source & np.isin(dirnames, list(stale_dirs))
+    return drop
 
-    replacements = {}
-    if "replacements" in catalog_definition:
-        replacements = catalog_definition["replacements"]
 
-    df = pd.DataFrame(columns=catalog_columns)
+def _in_dir(dirnames, root_dir):
+    """
+    return boolean array of dirnames that are root_dir or are below it,
+    comparing whole path components
+    """
+    root_dir = os.path.normpath(root_dir)
+    dirnames = pd.Series(dirnames, dtype=object)
+    return ((dirnames == root_dir) | dirnames.str.startswith(root_dir + "/")).values
 
-    for experiment, ensembles in collection["data_sources"].items():
 
-        entry = {"experiment": experiment}
+def _scan_data_source_cesm(
+    experiment, ens, d_attrs, catalog_columns, catalog_definition, dir_mtimes_prev=None
+):
+    """
+    Walk root_dir of a single data source of a CESM catalog.
+    If dir_mtimes_prev is provided, directories whose mtime is unchanged are not listed,
+    their subdirectories, as recorded in dir_mtimes_prev, are visited.
+    Return dict with list of catalog entries, number of .nc files examined, mtimes of
+    visited directories, and list of directories that were listed.
+    """
+    root_dir = d_attrs["root_dir"]
+
+    exclude_dirs = []
+    if "exclude_dirs" in d_attrs:
+        exclude_dirs = d_attrs["exclude_dirs"]
+
+    base_entry = _cesm_base_entry(experiment, ens, d_attrs, catalog_columns)
+
+    subdirs_prev = {}
+    if dir_mtimes_prev is not None:
+        for dirname in dir_mtimes_prev:
+            subdirs_prev.setdefault(os.path.dirname(dirname), []).append(dirname)
+
+    fs = []
+    nfiles = 0
+    dir_mtimes = {}
+    scanned_dirs = []
+    dir_stack = [root_dir]
+    while dir_stack:
+        root = dir_stack.pop()
+        try:
+            dir_mtimes[root] = os.stat(root).st_mtime_ns
+        except FileNotFoundError:
+            continue
 
-        for ens, d_attrs in enumerate(ensembles):
+        if (
+            dir_mtimes_prev is not None
+            and dir_mtimes_prev.get(root) == dir_mtimes[root]
+        ):
+            dir_stack.extend(subdirs_prev.get(root, []))
+            continue
 
-            root_dir = d_attrs["root_dir"]
-            case = d_attrs["case"]
-            component_attrs = (
-                d_attrs["component_attrs"] if "component_attrs" in d_attrs else {}
-            )
+        files = []
+        subdirs = []
+        # skip directories that cannot be listed, e.g., that are unreadable, or were
+        # removed during the scan, like os.walk, they are not recorded in dir_mtimes,
+        # and mtimes of their parents are recorded as unknown, so that they are
+        # visited and rescanned by the next incremental build
+        try:
+            with os.scandir(root) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.is_dir():
+                        # do not descend into symbolic links to directories,
+                        # like os.walk
+                        if not dir_entry.is_symlink():
+                            subdirs.append(dir_entry.path)
+                    else:
+                        files.append(dir_entry.name)
+        except OSError as err:
+            logging.warning(f"unable to list {root}: {err}")
+            del dir_mtimes[root]
+            parent = root
+            while parent != root_dir and os.path.dirname(parent) in dir_mtimes:
+                parent = os.path.dirname(parent)
+                dir_mtimes[parent] = None
+            continue
+        scanned_dirs.append(root)
+        dir_stack.extend(subdirs)
 
-            exclude_dirs = []
-            if "exclude_dirs" in d_attrs:
-                exclude_dirs = d_attrs["exclude_dirs"]
+        sfiles = sorted([f for f in files if f.endswith(".nc")])
+        if not sfiles:
+            continue
 
-            entry.update(
-                {key: val for key, val in d_attrs.items() if key in catalog_columns}
+        # skip directories specified in `exclude_dirs`
+        local_root = root.replace(root_dir + "/", "")
+        if any(
+            fnmatch.fnmatch(local_root, exclude_dir) for exclude_dir in exclude_dirs
+        ):
+            logging.warning(f"skipping {root}")
+            continue
+
+        nfiles += len(sfiles)
+        fs.extend(
+            _cesm_dir_entries(
+                root, sfiles, base_entry, d_attrs, catalog_columns, catalog_definition
             )
+        )
 
-            if "ensemble" not in d_attrs:
-                entry.update({"ensemble": ens})
-
-            if "sequence_order" not in d_attrs:
-                entry.update({"sequence_order": 0})
-
-            w = os.walk(os.path.join(root_dir))
-
-            for root, dirs, files in w:
-
-                if not files:
-                    continue
-
-                sfiles = sorted([f for f in files if f.endswith(".nc")])
-                if not sfiles:
-                    continue
-
-                # skip directories specified in `exclude_dirs`
-                local_root = root.replace(root_dir + "/", "")
-                if any(
-                    fnmatch.fnmatch(local_root, exclude_dir)
-                    for exclude_dir in exclude_dirs
-                ):
-                    logging.warning(f"skipping {root}")
-                    continue
-
-                fs = []
-                for f in sfiles:
-                    fileparts = _cesm_filename_parts(f, component_streams)
-
-                    if fileparts is None:
-                        continue
-                    if fileparts["case"] != case:
-                        continue
-
-                    component = fileparts["component"]
-                    if component in component_attrs:
-                        entry.update(
-                            {
-                                key: val
-                                for key, val in component_attrs[component].items()
-                                if key in catalog_columns
-                            }
-                        )
-
-                    entry.update(
-                        {
-                            "variable": fileparts["variable"],
-                            "component": component,
-                            "stream": fileparts["stream"],
-                            "date_range": fileparts["datestr"].split("-"),
-                            "file_basename": f,
-                            "files": os.path.join(root, f),
-                        }
-                    )
+    return {
+        "fs": fs,
+        "nfiles": nfiles,
+        "dir_mtimes": dir_mtimes,
+        "scanned_dirs": scanned_dirs,
+        "incremental": dir_mtimes_prev is not None,
+    }
 
-                    completed_entry = dict(entry)
-                    for key, replist in replacements.items():
-                        if key in completed_entry:
-                            for old_new in replist:
-                                if completed_entry[key] == old_new[0]:
-                                    completed_entry[key] = old_new[1]
 
-                    fs.append(completed_entry)
+def _cesm_base_entry(experiment, ens, d_attrs, catalog_columns):
+    """return catalog entry values shared by all files of a data source"""
+    entry = {"experiment": experiment}
+    entry.update({key: val for key, val in d_attrs.items() if key in catalog_columns})
+    if "ensemble" not in d_attrs:
+        entry.update({"ensemble": ens})
+    if "sequence_order" not in d_attrs:
+        entry.update({"sequence_order": 0})
+    return entry
 
-                if fs:
-                    temp_df = pd.DataFrame(fs)
-                else:
-                    temp_df = pd.DataFrame(columns=df.columns)
 
-                df = pd.concat([temp_df, df], ignore_index=True, sort=False)
+def _cesm_dir_entries(
+    root, sfiles, base_entry, d_attrs, catalog_columns, catalog_definition
+):
+    """return catalog entries for the .nc files sfiles in directory root"""
+
+    component_streams = catalog_definition["component_streams"]
+
+    replacements = {}
+    if "replacements" in catalog_definition:
+        replacements = catalog_definition["replacements"]
+
+    case = d_attrs["case"]
+    component_attrs = d_attrs["component_attrs"] if "component_attrs" in d_attrs else {}
+
+    entry = dict(base_entry)
+
+    df_fileparts = _cesm_filename_parts_batch(sfiles, component_streams)
+    df_fileparts["f"] = sfiles
+
+    fs = []
+    for fileparts in df_fileparts.loc[df_fileparts["case"] == case].to_dict("records"):
+        f = fileparts["f"]
+
+        component = fileparts["component"]
+        if component in component_attrs:
+            entry.update(
+                {
+                    key: val
+                    for key, val in component_attrs[component].items()
+                    if key in catalog_columns
+                }
+            )
 
-    df.to_csv(active_database_file_name)
+        entry.update(
+            {
+                "variable": fileparts["variable"],
+                "component": component,
+                "stream": fileparts["stream"],
+                "date_range": fileparts["datestr"].split("-"),
+                "file_basename": f,
+                "files": os.path.join(root, f),
+            }
+        )
+
+        completed_entry = dict(entry)
+        for key, replist in replacements.items():
+            if key in completed_entry:
+                for old_new in replist:
+                    if completed_entry[key] == old_new[0]:
+                        completed_entry[key] = old_new[1]
+
+        fs.append(completed_entry)
+
+    return fs
@@ -0,0 +1,191 @@
+"""execution backends for tseries generation"""
+
+import concurrent.futures
+import contextlib
+import os
+import warnings
+
+import dask
+import dask.distributed
+
+try:
+    import ncar_jobqueue
+except (ImportError, RuntimeError):
+    ncar_jobqueue = None
+
+from src.config import tseries_backend
+from src.utils import print_timestamp
+
+backend_names = ["ncar_jobqueue", "local_cluster", "threads", "processes"]
+
+
+class ExecBackend:
+    """
+    base class of execution backends
+
+    Computations are done with compute, within a session.
+    Sessions may be nested, and shared by concurrent threads, nested sessions reuse
+    the resources of the outermost session.
+    """
+
+    def scale(self, workers):
+        """request workers workers, as appropriate for the backend"""
+
+    @property
+    def dashboard_link(self):
+        """return link to dashboard, None if there is none"""
+        return None
+
+    def session(self):
+        """return context manager, within which compute may be called"""
+        return contextlib.nullcontext()
+
+    def compute(self, *args):
+        """compute dask collections in args, as dask.compute does"""
+        return dask.compute(*args)
+
+    def close(self):
+        """release resources of backend"""
+
+
+class DistributedBackend(ExecBackend):
+    """
+    dask.distributed cluster, with a client for each session
+    If cluster is None, it is instantiated on first use, and closed by close.
+    """
+
+    def __init__(self, cluster=None):
+        self._cluster = cluster
+        self._owned = cluster is None
+        self._client = None
+
+    @property
+    def cluster(self):
+        """return cluster, instantiating it if necessary"""
+        if self._cluster is None:
+            self._cluster = self._new_cluster()
+        return self._cluster
+
+    def _new_cluster(self):
+        """return new cluster"""
+        raise ValueError("cluster not provided")
+
+    def scale(self, workers):
+        print_timestamp(f"calling cluster.scale({workers})")
+        self.cluster.scale(workers)
+
+    @property
+    def dashboard_link(self):
+        return self.cluster.dashboard_link
+
+    @contextlib.contextmanager
+    def session(self):
+        if self._client is not None:
+            yield self._client
+            return
+        with dask.distributed.Client(self.cluster) as client:
+            print_timestamp("client instantiated")
+            self._client = client
+            try:
+                yield client
+            finally:
+                self._client = None
+
+    def compute(self, *args):
+        return dask.compute(*args, scheduler=self._client)
+
+    def close(self):
+        if self._owned and self._cluster is not None:
+            self._cluster.close()
+            self._cluster = None
+
+
+class NCARJobqueueBackend(DistributedBackend):
+    """ncar_jobqueue.NCARCluster, configured in ~/.config/dask/jobqueue.yaml"""
+
+    def __init__(self):
+        if ncar_jobqueue is None:
+            raise ValueError("ncar_jobqueue did not load successfully")
+        super().__init__()
+
+    def _new_cluster(self):
+        # ignore dashboard warnings when instantiating
+        with warnings.catch_warnings():
+            warnings.filterwarnings(action="ignore", module=".*dashboard")
+            return ncar_jobqueue.NCARCluster()
+
+
+class LocalClusterBackend(DistributedBackend):
+    """dask.distributed.LocalCluster, with at most one worker per core"""
+
+    def _new_cluster(self):
+        return dask.distributed.LocalCluster(n_workers=0, threads_per_worker=1)
+
+    def scale(self, workers):
+        super().scale(min(workers, os.cpu_count()))
+
+
+class ThreadsBackend(ExecBackend):
+    """threaded dask scheduler, with at most one thread per core"""
+
+    def __init__(self):
+        self.num_workers = os.cpu_count()
+
+    def scale(self, workers):
+        self.num_workers = min(workers, os.cpu_count())
+
+    def compute(self, *args):
+        return dask.compute(*args, scheduler="threads", num_workers=self.num_workers)
+
+
+class ProcessesBackend(ExecBackend):
+    """concurrent.futures process pool, with at most one process per core"""
+
+    def __init__(self):
+        self.max_workers = os.cpu_count()
+        self._executor = None
+
+    def scale(self, workers):
+        self.max_workers = min(workers, os.cpu_count())
+
+    @contextlib.contextmanager
+    def session(self):
+        if self._executor is not None:
+            yield self._executor
+            return
+        with concurrent.futures.ProcessPoolExecutor(self.max_workers) as executor:
+            self._executor = executor
+            try:
+                yield executor
+            finally:
+                self._executor = None
+
+    def compute(self, *args):
+        return dask.compute(*args, scheduler=self._executor)
+
+
+def get_backend(cluster_in=None):
+    """
+    return execution backend for cluster_in
+    cluster_in may be an ExecBackend, which is returned, or a dask.distributed cluster,
+    if it is None, the backend is set by the environment variable TSERIES_BACKEND,
+    or by config.tseries_backend
+    """
+    if isinstance(cluster_in, ExecBackend):
+        return cluster_in
+    if cluster_in is not None:
+        return DistributedBackend(cluster_in)
+
+    backend_name = os.environ.get("TSERIES_BACKEND", tseries_backend)
+    if backend_name is None:
+        backend_name = "ncar_jobqueue" if ncar_jobqueue is not None else "local_cluster"
+    print_timestamp(f"backend_name={backend_name}")
+    if backend_name == "ncar_jobqueue":
+        return NCARJobqueueBackend()
+    if backend_name == "local_cluster":
+        return LocalClusterBackend()
+    if backend_name == "threads":
+        return ThreadsBackend()
+    if backend_name == "processes":
+        return ProcessesBackend()
+    raise ValueError(f"unknown backend_name={backend_name}")
@@ -7,8 +7,9 @@ import yaml
 import xarray as xr
 
 from src import data_catalog
-from src.config import var_specs_fname, expr_metadata_fname, grid_dir
+from src.config import expr_metadata_fname, grid_dir
 from src.utils import copy_fill_settings, print_timestamp
+from src.var_specs import get_var_specs
 
 
 def main():
@@ -53,9 +54,8 @@ def gen_derived_files(
     assumes that data_catalog.set_catalog has been called
     """
 
-    with open(var_specs_fname, mode="r") as fptr:
-        var_specs_all = yaml.safe_load(fptr)
-    var_spec = var_specs_all[component]["vars"][varname]
+    var_specs = get_var_specs()
+    var_spec = var_specs.var_spec(component, varname)
 
     # if this varname is not derived from others, there is nothing to be done
     if "derived_from_varnames" not in var_spec:
@@ -84,7 +84,7 @@ def gen_derived_files(
 
     # if no stream is specified, get the default stream for this component
     if stream is None:
-        stream = var_specs_all[component]["stream"]
+        stream = var_specs.stream(component, varname)
 
     with open(expr_metadata_fname, mode="r") as fptr:
         expr_metadata = yaml.safe_load(fptr)["experiments"]["data_sources"][experiment]
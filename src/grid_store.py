@@ -0,0 +1,158 @@
+"""on-disk store of grid weights, region masks, and weight sums"""
+
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+
+from src.config import grid_cache_dir
+from src.utils import print_timestamp, tmp_fname, to_netcdf_locked
+from src.utils_grid import (
+    get_weight,
+    get_rmask_compact,
+    rmask_version,
+    CompactRegionMask,
+)
+
+# variables that weights and region masks are derived from, for each component
+grid_var_names = {
+    "ocn": ["TAREA", "dz", "KMT", "REGION_MASK", "TLAT", "TLONG"],
+    "ice": ["tarea", "tmask", "TLAT"],
+    "lnd": ["area", "landfrac", "lat", "lon"],
+    "atm": ["gw", "lat", "lon"],
+}
+
+
+class GridStore:
+    """
+    on-disk store of grid weights, region masks, and weight sums
+
+    Entries are keyed by component and a hash of the grid variables that they are
+    derived from, so files on different grids, or with different land-block
+    elimination, do not share entries. Entries derived from region masks are also
+    keyed by utils_grid.rmask_version. Entries are computed and written on first use.
+    If cache_dir is None, entries are computed on every use, and nothing is written.
+    """
+
+    def __init__(self, cache_dir=grid_cache_dir):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # grid keys, keyed by id of Dataset and component
+        self._keys = {}
+
+    def weight(self, ds, component, reduce_dims):
+        """return weight, as returned by utils_grid.get_weight"""
+        fname = self._fname(ds, component, f"weight_{'_'.join(reduce_dims)}")
+        return self._get(
+            fname,
+            lambda: get_weight(ds, component, reduce_dims).load(),
+            _da_to_dataset,
+            _da_from_dataset,
+        )
+
+    def rmask(self, ds, component):
+        """return region mask, as returned by utils_grid.get_rmask_compact"""
+        fname = self._fname(ds, component, f"rmask_v{rmask_version}")
+        return self._get(
+            fname,
+            lambda: get_rmask_compact(ds, component),
+            CompactRegionMask.to_dataset,
+            CompactRegionMask.from_dataset,
+        )
+
+    def weight_sum(self, ds, component, reducer, da):
+        """
+        return regional sum of weight over cells where da is not NaN,
+        as returned by reducer.weight_sum(da)
+        da is a field without a time dimension, its NaN pattern is part of the key
+        """
+        notnull = da.notnull().values
+        mask_hash = _hash_arrays([np.packbits(notnull), np.array(notnull.shape)])
+        reduce_dims = "_".join(reducer.reduce_dims)
+        fname = self._fname(
+            ds,
+            component,
+            f"weight_sum_v{rmask_version}_{reducer.method}_{reduce_dims}_{mask_hash}",
+        )
+        weight_sum = self._get(
+            fname,
+            lambda: reducer.weight_sum(da).load(),
+            _da_to_dataset,
+            _da_from_dataset,
+        )
+        return weight_sum.assign_coords(region=reducer.region)
+
+    def _fname(self, ds, component, entry_name):
+        """return file name of entry_name, None if cache_dir is None"""
+        if self.cache_dir is None:
+            return None
+        return os.path.join(
+            self.cache_dir, f"{component}_{self.key(ds, component)}_{entry_name}.nc"
+        )
+
+    def key(self, ds, component):
+        """return hash of grid variables of ds that entries are derived from"""
+        if (id(ds), component) not in self._keys:
+            grid_vars = [
+                ds[var_name] for var_name in grid_var_names[component] if var_name in ds
+            ]
+            self._keys[(id(ds), component)] = _hash_arrays(
+                [np.asarray(var.values, dtype=np.float64) for var in grid_vars]
+                + [np.array(var.shape) for var in grid_vars],
+                names=[var.name for var in grid_vars],
+            )
+        return self._keys[(id(ds), component)]
+
+    def _get(self, fname, compute, to_dataset, from_dataset):
+        """
+        return entry stored in fname, computing and storing it if necessary
+        to_dataset and from_dataset convert entries to and from Dataset objects
+        """
+        if fname is None:
+            return compute()
+        if os.path.exists(fname):
+            with xr.open_dataset(fname) as ds_cached:
+                return from_dataset(ds_cached.load())
+
+        entry = compute()
+        # drop encodings inherited from input files, so that values are stored as is
+        ds_entry = to_dataset(entry)
+        for var_name in ds_entry.variables:
+            ds_entry[var_name].encoding = {}
+        # write to a temporary file and rename it, so that readers never see a
+        # partially written file
+        tmp_fname_loc = tmp_fname(fname)
+        try:
+            to_netcdf_locked(ds_entry, tmp_fname_loc)
+            os.replace(tmp_fname_loc, fname)
+            print_timestamp(f"{fname} written")
+        except OSError as err:
+            print_timestamp(f"unable to write {fname}: {err}")
+            if os.path.exists(tmp_fname_loc):
+                os.remove(tmp_fname_loc)
+        return entry
+
+
+def _da_to_dataset(da):
+    """return Dataset containing da, recording its name, which may be None"""
+    ds = da.to_dataset(name="entry")
+    if da.name is not None:
+        ds.attrs["entry_name"] = da.name
+    return ds
+
+
+def _da_from_dataset(ds):
+    """return DataArray stored with _da_to_dataset"""
+    return ds["entry"].rename(ds.attrs.get("entry_name"))
+
+
+def _hash_arrays(arrays, names=()):
+    """return short hex digest of arrays and names"""
+    hasher = hashlib.sha1()
+    for name in names:
+        hasher.update(name.encode())
+    for array in arrays:
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    return hasher.hexdigest()[:16]
@@ -4,23 +4,24 @@ from datetime import datetime, timezone
 import math
 import os
 import sys
-import time
 import warnings
 
 import cf_units
 import xarray as xr
-import yaml
 
 from src import data_catalog
 from src import esmlab_wrap
 from src.utils import (
     print_timestamp,
     time_set_mid,
+    tmp_fname,
     copy_var_names,
     drop_var_names,
 )
 from src.utils_grid import get_latlon_isel_dict
-from src.config import rootdir, var_specs_fname
+from src.utils_lock import GenLock
+from src.config import rootdir
+from src.var_specs import get_var_specs
 
 time_name = "time"
 
@@ -37,16 +38,17 @@ def latlon_sel_get_var(
     cache_dir=cache_dir_default,
     clobber=None,
     entries_in=None,
+    catalog=None,
 ):
     """
     return values for varname, as a xarray.Dataset object
-    assumes that data_catalog.set_catalog has been called
+    catalog is a data_catalog.Catalog object or catalog name,
+    if it is None, the active catalog of data_catalog is used
+    catalog is not used if entries_in is provided
     """
-    # if no stream is specified, get the default stream for this component
+    # if no stream is specified, get the default stream for this varname
     if stream is None:
-        with open(var_specs_fname, mode="r") as fptr:
-            var_specs_all = yaml.safe_load(fptr)
-        stream_loc = var_specs_all[component]["stream"]
+        stream_loc = get_var_specs().stream(component, varname)
     else:
         stream_loc = stream
 
@@ -56,7 +58,7 @@ def latlon_sel_get_var(
     # get matching data_catalog entries
     varname_resolved = _varname_resolved(varname, component)
     if entries_in is None:
-        entries = data_catalog.find_in_index(
+        entries = data_catalog.resolve_catalog(catalog).find_in_index(
             variable=varname_resolved,
             component=component,
             stream=stream_loc,
@@ -104,16 +106,7 @@ def latlon_sel_get_var(
 
 def _varname_resolved(varname, component):
     """resolve varname to underlying varname that appears in files"""
-
-    with open(var_specs_fname, mode="r") as fptr:
-        var_specs_all = yaml.safe_load(fptr)
-
-    if varname not in var_specs_all[component]["vars"]:
-        return varname
-
-    var_spec = var_specs_all[component]["vars"][varname]
-
-    return var_spec["varname"] if "varname" in var_spec else varname
+    return get_var_specs().varname_resolved(component, varname)
 
 
 def _latlon_sel_gen_wrap(
@@ -130,40 +123,30 @@ def _latlon_sel_gen_wrap(
     cache_path = os.path.join(
         cache_dir, latlon_sel_fname(varname, isel_dict, component, experiment, ensemble)
     )
-    cache_path_genlock = cache_path + ".genlock"
-    # if file doesn't exists and isn't being generated, generate it
-    if clobber or (
-        not os.path.exists(cache_path) and not os.path.exists(cache_path_genlock)
-    ):
-        # create genlock file, indicating that cache_path is being generated
-        open(cache_path_genlock, mode="w").close()
-        # generate timeseries
-        try:
-            ds = _latlon_sel_gen(varname, isel_dict, component, ensemble, entries)
-        except:
-            # error occured, remove genlock file and re-raise exception, to ease subsequent attempts
-            os.remove(cache_path_genlock)
-            raise
-
-        # write generated timeseries
-        # ensure NaN _FillValues do not get generated
-        for var in ds.variables:
-            if "_FillValue" not in ds[var].encoding:
-                ds[var].encoding["_FillValue"] = None
-        # remove attributes with forbidden names
-        for att_name in ["_NCProperties"]:
-            if att_name in ds.attrs:
-                del ds.attrs[att_name]
-        ds.to_netcdf(cache_path, format="NETCDF4_CLASSIC")
-        print_timestamp(f"{cache_path} written")
-
-        # remove genlock file, indicating that cache_path has been generated
-        os.remove(cache_path_genlock)
-
-    # wait until genlock file doesn't exists, in case it was being generated or written
-    while os.path.exists(cache_path_genlock):
-        print_timestamp("genlock file exists, waiting")
-        time.sleep(5)
+    # if file doesn't exist, generate it
+    # generation is serialized with a GenLock, so if another process is generating it,
+    # wait for it to finish, and then check again whether generation is still needed
+    if clobber or not os.path.exists(cache_path):
+        with GenLock(cache_path):
+            if clobber or not os.path.exists(cache_path):
+                # generate timeseries
+                ds = _latlon_sel_gen(varname, isel_dict, component, ensemble, entries)
+
+                # write generated timeseries
+                # ensure NaN _FillValues do not get generated
+                for var in ds.variables:
+                    if "_FillValue" not in ds[var].encoding:
+                        ds[var].encoding["_FillValue"] = None
+                # remove attributes with forbidden names
+                for att_name in ["_NCProperties"]:
+                    if att_name in ds.attrs:
+                        del ds.attrs[att_name]
+                # write to a temporary file and rename it, so that readers never see
+                # a partially written file
+                tmp_path = tmp_fname(cache_path)
+                ds.to_netcdf(tmp_path, format="NETCDF4_CLASSIC")
+                os.replace(tmp_path, cache_path)
+                print_timestamp(f"{cache_path} written")
 
     return cache_path
 
@@ -177,14 +160,6 @@ def _latlon_sel_gen(varname, isel_dict, component, ensemble, entries):
     fnames = entries.loc[entries["ensemble"] == ensemble].files.tolist()
     print(fnames)
 
-    with open(var_specs_fname, mode="r") as fptr:
-        var_specs_all = yaml.safe_load(fptr)
-
-    if varname in var_specs_all[component]["vars"]:
-        var_spec = var_specs_all[component]["vars"][varname]
-    else:
-        var_spec = {}
-
     ds_out_list = []
 
     with xr.open_dataset(fnames[0]) as ds0:
@@ -1,41 +1,72 @@
 """interface for extracting timeseries from CESM output"""
 
+import concurrent.futures
+import contextlib
 from datetime import datetime, timezone
-import math
+import hashlib
+import json
 import os
-import sys
-import time
-import warnings
+import pickle
+import shutil
 
 import cf_units
+import netCDF4
 import xarray as xr
-import yaml
+from xarray.backends.locks import HDF5_LOCK
 
 import dask
 
-# import dask_jobqueue
-try:
-    import ncar_jobqueue
-except RuntimeError:
-    pass
-
 from src import data_catalog
 from src import esmlab_wrap
+from src import exec_backend
 from src.utils import (
     print_timestamp,
     copy_fill_settings,
     time_set_mid,
+    time_range_sel,
+    tmp_fname,
+    to_netcdf_locked,
     copy_var_names,
     drop_var_names,
 )
-from src.utils_grid import get_weight, get_rmask
+from src.grid_store import GridStore
+from src.tseries_plan import plan_tseries_gen
+from src.utils_grid import rmask_version
+from src.utils_lock import GenLock
+from src.utils_reduce import RegionReducer, nan_pattern_checksum
 from src.utils_units import clean_units, conv_units
-from src.config import rootdir, var_specs_fname
+from src.config import rootdir
+from src.var_specs import get_var_specs
 
 time_name = "time"
 
 cache_dir_default = os.path.join(rootdir, "tseries")
 
+# name of file in cache directories, mapping tseries to their cached files
+manifest_fname = "manifest.json"
+
+# method of spatial reductions in tseries generation, see utils_reduce.reduce_methods
+# can be overridden with the environment variable TSERIES_REDUCE_METHOD
+reduce_method_default = "dense"
+
+# number of (varnames, ensemble) tseries products generated concurrently, in a shared
+# session of the execution backend, 1 generates them one at a time
+# can be overridden with the environment variable TSERIES_CONCURRENCY
+concurrency_default = 1
+
+# if True, generated mon tseries are streamed, i.e., each time block is written to the
+# tseries file as soon as it is computed, and checkpointed, otherwise the full tseries
+# is held in memory
+# can be overridden with the environment variable TSERIES_STREAM, set to 0 or 1
+stream_default = False
+
+# if True, ann tseries are also generated when mon tseries are generated from scratch,
+# in the same pass, computed from the mon tseries in memory, also for mon requests
+# it is False, so that mon requests only write mon tseries files, ann requests
+# generate ann tseries in the same pass regardless
+# can be overridden with the environment variable TSERIES_GEN_ANN, set to 0 or 1
+gen_ann_default = False
+
 
 def tseries_get_vars(
     varnames,
@@ -46,40 +77,71 @@ def tseries_get_vars(
     cache_dir=cache_dir_default,
     clobber=None,
     cluster_in=None,
+    catalog=None,
+    time_range=None,
 ):
     """
     return tseries for varnames, as a xarray.Dataset object
-    assumes that data_catalog.set_catalog has been called
+    catalog is a data_catalog.Catalog object or catalog name,
+    if it is None, the active catalog of data_catalog is used
+    time_range is a tuple (start_year, end_year), end_year is inclusive,
+    if it is not None, only files overlapping time_range are used
 
     arguments are passed to tseries_get_var
     """
-    # if no stream is specified, get the default stream for this component
-    if stream is None:
-        with open(var_specs_fname, mode="r") as fptr:
-            var_specs_all = yaml.safe_load(fptr)
-        stream_loc = var_specs_all[component]["stream"]
-    else:
-        stream_loc = stream
-
     if clobber is None:
         clobber = os.environ["CLOBBER"] == "True" if "CLOBBER" in os.environ else False
 
+    # if all tseries are in the cache manifest, open them without consulting
+    # var_specs or querying the catalog
+    catalog = data_catalog.resolve_catalog(catalog)
+    if not clobber and time_range is None:
+        manifest = _read_manifest(cache_dir)
+        catalog_version = catalog.version()
+        paths_all = [
+            _manifest_paths(
+                manifest,
+                cache_dir,
+                catalog_version,
+                varname,
+                component,
+                experiment,
+                freq,
+            )
+            for varname in varnames
+        ]
+        if all(paths is not None for paths in paths_all):
+            return xr.merge(
+                [
+                    _tseries_open(paths, varname)
+                    for varname, paths in zip(varnames, paths_all)
+                ]
+            )
+
+    # if no stream is specified, get the default stream for this component
+    var_specs = get_var_specs()
+    stream_loc = var_specs.stream(component) if stream is None else stream
+
     # get matching data_catalog entries
-    entries = data_catalog.find_in_index(
+    entries = catalog.find_in_index(
         variable=_varnames_resolved(varnames, component),
         component=component,
         stream=stream_loc,
         experiment=experiment,
     )
-
-    # instantiate cluster, if not provided via argument
-    # ignore dashboard warnings when instantiating
-    if cluster_in is None and "ncar_jobqueue" in sys.modules:
-        with warnings.catch_warnings():
-            warnings.filterwarnings(action="ignore", module=".*dashboard")
-            cluster = ncar_jobqueue.NCARCluster()
-    else:
-        cluster = cluster_in
+    entries = data_catalog.entries_in_time_range(entries, time_range)
+
+    # get execution backend, its cluster, if any, is instantiated on first use,
+    # and is shared by all varnames
+    backend = exec_backend.get_backend(cluster_in)
+
+    # generate tseries of varnames that share a varname in files in a single pass,
+    # tseries_get_var then finds them in the cache
+    varnames_fused = []
+    if time_range is None:
+        varnames_fused = _tseries_gen_fused_wrap(
+            varnames, component, experiment, freq, cache_dir, clobber, entries, backend
+        )
 
     ds = xr.merge(
         [
@@ -90,18 +152,20 @@ def tseries_get_vars(
                 stream_loc,
                 freq,
                 cache_dir,
-                clobber,
+                clobber and varname not in varnames_fused,
                 entries,
-                cluster,
+                backend,
+                catalog,
+                time_range,
             )
             for varname in varnames
         ]
     )
 
-    # if cluster was instantiated here, close it
-    if cluster_in is None and "ncar_jobqueue" in sys.modules:
+    # if backend was instantiated here, close it
+    if cluster_in is None:
         ds.load()
-        cluster.close()
+        backend.close()
 
     return ds
 
@@ -116,26 +180,43 @@ def tseries_get_var(
     clobber=None,
     entries_in=None,
     cluster_in=None,
+    catalog=None,
+    time_range=None,
 ):
     """
     return tseries for varname, as a xarray.Dataset object
-    assumes that data_catalog.set_catalog has been called
+    catalog is a data_catalog.Catalog object or catalog name,
+    if it is None, the active catalog of data_catalog is used
+    catalog is not queried if entries_in is provided, if entries_in is provided and
+    catalog is None, the cache manifest, which depends on the catalog, is not used
+    time_range is a tuple (start_year, end_year), end_year is inclusive,
+    if it is not None, only files overlapping time_range are used,
+    and the returned tseries is subset to time_range
     """
-    # if no stream is specified, get the default stream for this component
-    if stream is None:
-        with open(var_specs_fname, mode="r") as fptr:
-            var_specs_all = yaml.safe_load(fptr)
-        stream_loc = var_specs_all[component]["stream"]
-    else:
-        stream_loc = stream
-
     if clobber is None:
         clobber = os.environ["CLOBBER"] == "True" if "CLOBBER" in os.environ else False
 
+    if entries_in is None or catalog is not None:
+        catalog = data_catalog.resolve_catalog(catalog)
+
+    # if tseries is in the cache manifest, open it without consulting
+    # var_specs or querying the catalog
+    if not clobber and time_range is None and catalog is not None:
+        manifest = _read_manifest(cache_dir)
+        paths = _manifest_paths(
+            manifest, cache_dir, catalog.version(), varname, component, experiment, freq
+        )
+        if paths is not None:
+            return _tseries_open(paths, varname)
+
+    # if no stream is specified, get the default stream for this varname
+    var_specs = get_var_specs()
+    stream_loc = var_specs.stream(component, varname) if stream is None else stream
+
     # get matching data_catalog entries
     varname_resolved = _varname_resolved(varname, component)
     if entries_in is None:
-        entries = data_catalog.find_in_index(
+        entries = catalog.find_in_index(
             variable=varname_resolved,
             component=component,
             stream=stream_loc,
@@ -143,10 +224,11 @@ def tseries_get_var(
         )
     else:
         entries = entries_in.loc[entries_in["variable"] == varname_resolved]
+    entries = data_catalog.entries_in_time_range(entries, time_range)
 
     if entries.empty:
         raise ValueError(
-            f"no file matches found for varname={varname}, component={component}, experiment={experiment}"
+            f"no file matches found for varname={varname}, component={component}, experiment={experiment}, time_range={time_range}"
         )
 
     # loop over matching ensembles
@@ -162,10 +244,27 @@ def tseries_get_var(
             clobber,
             entries,
             cluster_in,
+            time_range,
         )
         paths.append(path)
 
-    # if there are multiple ensembles, concatenate over ensembles
+    ds = _tseries_open(paths, varname)
+
+    if time_range is not None:
+        ds = time_range_sel(ds, time_name, time_range)
+    elif catalog is not None:
+        _update_manifest(
+            cache_dir, catalog.version(), varname, component, experiment, freq, paths
+        )
+
+    return ds
+
+
+def _tseries_open(paths, varname):
+    """
+    return tseries in paths, as a xarray.Dataset object
+    if there are multiple paths, concatenate over ensembles
+    """
     decode_times = True
     if len(paths) > 1:
         ds = xr.open_mfdataset(
@@ -177,10 +276,94 @@ def tseries_get_var(
         )
     else:
         ds = xr.open_dataset(paths[0], decode_times=decode_times)
-
     return ds
 
 
+def _manifest_key(varname, component, experiment, freq):
+    """return key of manifest entries"""
+    return f"{varname}:{component}:{experiment}:{freq}"
+
+
+def _read_manifest(cache_dir):
+    """
+    return manifest of cache_dir, a dict mapping manifest keys to dicts with
+        files: list of tseries file names, relative to cache_dir, one per ensemble
+        catalog_version: version of the catalog the entries were generated from
+        tseries_spec_hash: tseries_spec_hash provenance attribute of the files
+        file_stats: list of sizes and modification times of the files
+        input_files: list of files that the files were generated from
+        input_files_hash: hash of names, sizes, and modification times of input_files
+    return an empty dict if the manifest does not exist or cannot be read
+    """
+    try:
+        with open(os.path.join(cache_dir, manifest_fname), mode="r") as fptr:
+            return json.load(fptr)
+    except (OSError, ValueError):
+        return {}
+
+
+def _manifest_paths(
+    manifest, cache_dir, catalog_version, varname, component, experiment, freq
+):
+    """
+    return list of paths of cached tseries files for varname, from manifest
+    return None if tseries is not in manifest, is from a different catalog version,
+        or some of its files do not exist, are being generated, or may be stale
+    files are not opened, and only stats of files and their input files are read,
+        they may be stale if var specs of varname, the files, or their input files
+        changed since the entry was recorded, and are then validated and regenerated
+        if necessary, as if they were not in manifest
+    """
+    entry = manifest.get(_manifest_key(varname, component, experiment, freq))
+    if entry is None or entry["catalog_version"] != catalog_version:
+        return None
+    if entry.get("tseries_spec_hash") != _tseries_spec_hash(component, varname):
+        return None
+    paths = [os.path.join(cache_dir, fname) for fname in entry["files"]]
+    file_stats = _file_stats(paths)
+    if entry.get("file_stats") != file_stats or [None, None] in file_stats:
+        return None
+    if entry.get("input_files_hash") != _input_files_hash(entry.get("input_files", [])):
+        return None
+    for path in paths:
+        if GenLock(path).held():
+            return None
+    return paths
+
+
+def _update_manifest(
+    cache_dir, catalog_version, varname, component, experiment, freq, paths
+):
+    """add paths of cached tseries files for varname to manifest of cache_dir"""
+    key = _manifest_key(varname, component, experiment, freq)
+    entry = {
+        "files": [os.path.relpath(path, cache_dir) for path in paths],
+        "catalog_version": catalog_version,
+        "tseries_spec_hash": _tseries_spec_hash(component, varname),
+        "file_stats": _file_stats(paths),
+    }
+    entry["input_files"] = [
+        fname for path in paths for fname in _tseries_input_file_list(path)
+    ]
+    entry["input_files_hash"] = _input_files_hash(entry["input_files"])
+    manifest = _read_manifest(cache_dir)
+    if manifest.get(key) == entry:
+        return
+    manifest[key] = entry
+    # write to a temporary file and rename it, so that readers never see a
+    # partially written manifest
+    manifest_path = os.path.join(cache_dir, manifest_fname)
+    tmp_path = tmp_fname(manifest_path)
+    try:
+        with open(tmp_path, mode="w") as fptr:
+            json.dump(manifest, fptr, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    except OSError as err:
+        print_timestamp(f"unable to update {manifest_path}: {err}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def _varnames_resolved(varnames, component):
     """resolve varnames to underlying varname that appears in files"""
     return [_varname_resolved(varname, component) for varname in varnames]
@@ -188,16 +371,257 @@ def _varnames_resolved(varnames, component):
 
 def _varname_resolved(varname, component):
     """resolve varname to underlying varname that appears in files"""
+    return get_var_specs().varname_resolved(component, varname)
+
+
+def _tseries_gen_fused_wrap(
+    varnames, component, experiment, freq, cache_dir, clobber, entries, cluster_in
+):
+    """
+    generate tseries files of varnames that resolve to the same varname in files,
+        in a single pass over it, for each ensemble member
+    return list of varnames whose tseries files were generated for all ensembles
+    tseries files of a varname are generated if clobber is True, if neither the
+        file for freq nor the mon file exists, or if either is stale, see
+        _tseries_provenance_valid, and they are not being generated
+    ann tseries are generated along with mon tseries if freq is ann, or if
+        TSERIES_GEN_ANN is set, see gen_ann_default
+    if TSERIES_CONCURRENCY is greater than 1, all such (varnames, ensemble) products,
+        including those of single varnames, are generated concurrently, in a shared
+        session of the execution backend, and written as they finish
+    the remaining varnames are left to tseries_get_var
+    """
+    if freq not in ["mon", "ann"]:
+        return []
+
+    concurrency = int(os.environ.get("TSERIES_CONCURRENCY", concurrency_default))
+    group_len_min = 1 if concurrency > 1 else 2
+    freqs_gen = ["mon", "ann"] if freq == "ann" or _tseries_gen_ann() else ["mon"]
+
+    groups = {}
+    for varname in varnames:
+        groups.setdefault(_varname_resolved(varname, component), []).append(varname)
+
+    # determine products to generate, and paths of their files, keyed by varname
+    # files of products are locked until they are written, locks are released also if
+    # an error occured, to ease subsequent attempts
+    products = []
+    varnames_fused = []
+    locks = []
+    try:
+        for varname_resolved, group in groups.items():
+            if len(group) < group_len_min:
+                continue
+            entries_var = entries.loc[entries["variable"] == varname_resolved]
+            group_fused = list(group)
+            for ensemble in entries_var.ensemble.unique():
+                paths = {
+                    varname: {
+                        freq_loc: os.path.join(
+                            cache_dir,
+                            tseries_fname(
+                                varname, component, experiment, ensemble, freq_loc
+                            ),
+                        )
+                        for freq_loc in freqs_gen
+                    }
+                    for varname in group
+                }
+                # skip varnames whose files are being generated, need for generation
+                # is checked after acquiring their locks, in case another process
+                # generated them in the meantime
+                group_gen = []
+                group_locks = []
+                for varname in group:
+                    locks_var = _genlocks_acquire(paths[varname].values())
+                    if locks_var is None:
+                        continue
+                    paths_exist = [
+                        path for path in paths[varname].values() if os.path.exists(path)
+                    ]
+                    if (
+                        clobber
+                        or not paths_exist
+                        or not all(
+                            _tseries_provenance_valid(path, component, varname)
+                            for path in paths_exist
+                        )
+                    ):
+                        group_gen.append(varname)
+                        group_locks.extend(locks_var)
+                    else:
+                        _genlocks_release(locks_var)
+                if len(group_gen) < group_len_min:
+                    _genlocks_release(group_locks)
+                    group_fused = []
+                    continue
+                locks.extend(group_locks)
+                group_fused = [
+                    varname for varname in group_fused if varname in group_gen
+                ]
+                products.append((group_gen, ensemble, entries_var, paths))
+            varnames_fused.extend(group_fused)
+
+        if not products:
+            return []
+
+        if concurrency > 1:
+            _tseries_gen_concurrent(products, component, cluster_in, concurrency)
+        else:
+            for product in products:
+                group_gen, ensemble, entries_var, paths = product
+                ds_mon = _tseries_gen_fused(
+                    group_gen,
+                    component,
+                    ensemble,
+                    entries_var,
+                    cluster_in,
+                    out_paths=_tseries_stream_paths(group_gen, paths),
+                    ann_paths=_tseries_stream_ann_paths(group_gen, paths),
+                )
+                _tseries_write_product(ds_mon, paths)
+    finally:
+        _genlocks_release(locks)
+
+    return varnames_fused
+
+
+def _genlocks_acquire(paths):
+    """
+    acquire GenLocks of paths, without waiting, in sorted order
+    return list of the locks, or None if any of them is held elsewhere
+    """
+    locks = []
+    for path in sorted(set(paths)):
+        lock = GenLock(path)
+        if not lock.acquire(blocking=False):
+            _genlocks_release(locks)
+            return None
+        locks.append(lock)
+    return locks
 
-    with open(var_specs_fname, mode="r") as fptr:
-        var_specs_all = yaml.safe_load(fptr)
 
-    if varname not in var_specs_all[component]["vars"]:
-        return varname
+def _genlocks_release(locks):
+    """release GenLocks in locks"""
+    for lock in locks:
+        lock.release()
 
-    var_spec = var_specs_all[component]["vars"][varname]
 
-    return var_spec["varname"] if "varname" in var_spec else varname
+def _tseries_stream_paths(varnames, paths):
+    """
+    return dict of paths of mon tseries files of varnames, keyed by varname, that
+    tseries are streamed to, None if streaming is disabled
+    paths is as constructed in _tseries_gen_fused_wrap
+    """
+    if not int(os.environ.get("TSERIES_STREAM", stream_default)):
+        return None
+    return {varname: paths[varname]["mon"] for varname in varnames}
+
+
+def _tseries_stream_ann_paths(varnames, paths):
+    """
+    return dict of paths of ann tseries files of varnames, keyed by varname, that ann
+    means of streamed mon tseries are written to, None if streaming is disabled, or
+    paths has no ann tseries files
+    paths is as constructed in _tseries_gen_fused_wrap
+    """
+    if (
+        _tseries_stream_paths(varnames, paths) is None
+        or "ann" not in paths[varnames[0]]
+    ):
+        return None
+    return {varname: paths[varname]["ann"] for varname in varnames}
+
+
+def _tseries_gen_ann():
+    """return True if ann tseries are generated along with mon tseries"""
+    return bool(int(os.environ.get("TSERIES_GEN_ANN", gen_ann_default)))
+
+
+def _tseries_gen_concurrent(products, component, cluster_in, concurrency):
+    """
+    generate and write tseries of products concurrently, in a shared session of the
+    execution backend
+    each product is a tuple (varnames, ensemble, entries, paths), as constructed in
+        _tseries_gen_fused_wrap
+    """
+    backend = exec_backend.get_backend(cluster_in)
+
+    # scale cluster for the concurrently generated products needing the most workers
+    reduce_method = os.environ.get("TSERIES_REDUCE_METHOD", reduce_method_default)
+    workers_list = []
+    for varnames, ensemble, entries_var, _ in products:
+        plan = _tseries_plan(
+            _varname_resolved(varnames[0], component),
+            entries_var.loc[entries_var["ensemble"] == ensemble],
+            reduce_method,
+        )
+        workers_list.append(plan["workers"])
+    concurrency = min(concurrency, len(products))
+    workers = sum(sorted(workers_list, reverse=True)[:concurrency])
+    backend.scale(workers)
+    print_timestamp(f"dashboard_link={backend.dashboard_link}")
+
+    with backend.session():
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            futures = {
+                executor.submit(
+                    _tseries_gen_fused,
+                    varnames,
+                    component,
+                    ensemble,
+                    entries_var,
+                    backend,
+                    False,
+                    _tseries_stream_paths(varnames, paths),
+                    _tseries_stream_ann_paths(varnames, paths),
+                ): paths
+                for varnames, ensemble, entries_var, paths in products
+            }
+            # write results in this thread, as they finish
+            # streamed tseries are written by the generating threads, netCDF writes
+            # are serialized with HDF5_LOCK, see utils.to_netcdf_locked
+            for future in concurrent.futures.as_completed(futures):
+                _tseries_write_product(future.result(), futures[future])
+
+    # if backend was instantiated here, close it
+    if cluster_in is None:
+        backend.close()
+
+
+def _tseries_write_product(ds_mon, paths):
+    """
+    write mon tseries in ds_mon, a dict of Datasets keyed by varname, to paths,
+    and ann tseries computed from them, if paths has ann tseries files
+    values of ds_mon that are paths are streamed mon tseries, which have already been
+    written, along with their ann tseries
+    """
+    for varname, ds in ds_mon.items():
+        if isinstance(ds, str):
+            continue
+        _tseries_write(ds, paths[varname]["mon"])
+        if "ann" in paths[varname]:
+            print_timestamp(f"computing ann means from mon means for {varname}")
+            _tseries_write(_tseries_ann(ds), paths[varname]["ann"])
+
+
+def _tseries_ann(ds_mon):
+    """
+    return ann means of mon tseries ds_mon, which is in memory
+    values are first rounded to the dtype they are written with, and time is encoded
+    as it is in ds_mon, so that ann means are the same as those computed from the file
+    that ds_mon is written to, also if ds_mon is a time block of it
+    """
+    ds_mon = ds_mon.copy()
+    for name, var in ds_mon.data_vars.items():
+        dtype = var.encoding.get("dtype")
+        if time_name in var.dims and var.dtype.kind == "f" and dtype is not None:
+            ds_mon[name] = var.copy(data=var.values.astype(dtype))
+    ds_ann = esmlab_wrap.compute_ann_mean(ds_mon)
+    for key in ["units", "calendar"]:
+        if key in ds_mon[time_name].encoding:
+            ds_ann[time_name].encoding[key] = ds_mon[time_name].encoding[key]
+    return ds_ann
 
 
 def _tseries_gen_wrap(
@@ -210,10 +634,21 @@ def _tseries_gen_wrap(
     clobber,
     entries,
     cluster_in=None,
+    time_range=None,
 ):
     """
     return path for file containing tseries for varname for a single ensemble member
         creating the file if necessary
+    if time_range is not None, entries are assumed to be subset to time_range,
+        and the returned file contains at least the files of entries,
+        it is the full tseries file if that exists and covers entries,
+        otherwise it is a partial tseries file, which is extended as needed
+    if time_range is None, and the existing file was not generated from all files of
+        entries, e.g., because the experiment was extended, it is extended with
+        tseries generated from the new files
+    if time_range is None, and the mon tseries is generated from scratch, the ann
+        tseries is computed from it in memory, in the same pass, if freq is ann, or if
+        TSERIES_GEN_ANN is set, see gen_ann_default
     """
     if freq not in ["mon", "ann"]:
         msg = f"freq={freq} not implemented"
@@ -222,132 +657,593 @@ def _tseries_gen_wrap(
     cache_path = os.path.join(
         cache_dir, tseries_fname(varname, component, experiment, ensemble, freq)
     )
-    cache_path_genlock = cache_path + ".genlock"
-    # if file doesn't exists and isn't being generated, generate it
-    if clobber or (
-        not os.path.exists(cache_path) and not os.path.exists(cache_path_genlock)
-    ):
-        # create genlock file, indicating that cache_path is being generated
-        open(cache_path_genlock, mode="w").close()
-        # generate timeseries
-        try:
-            if freq == "mon":
-                ds = _tseries_gen(varname, component, ensemble, entries, cluster_in)
-            if freq == "ann":
-                mon_path = _tseries_gen_wrap(
+    fnames = entries.loc[entries["ensemble"] == ensemble].files.tolist()
+    if time_range is not None:
+        if (
+            not clobber
+            and _tseries_cache_covers(cache_path, fnames)
+            and _tseries_provenance_valid(cache_path, component, varname)
+        ):
+            return cache_path
+        cache_path = os.path.join(
+            cache_dir,
+            tseries_fname(varname, component, experiment, ensemble, freq, True),
+        )
+    # generate file if it doesn't exist, doesn't cover fnames, or is stale
+    # generation is serialized with a GenLock, so if another process is generating it,
+    # wait for it to finish, and then check again whether generation is still needed
+    if clobber or not _tseries_cache_current(cache_path, component, varname, fnames):
+        with GenLock(cache_path):
+            # stale files are regenerated, instead of being reused or extended
+            stale = os.path.exists(cache_path) and not _tseries_provenance_valid(
+                cache_path, component, varname
+            )
+            if stale:
+                print_timestamp(f"{cache_path} is stale")
+            if clobber or stale or not _tseries_cache_covers(cache_path, fnames):
+                cache_exists = os.path.exists(cache_path) and not stale
+                _tseries_gen_wrap_locked(
                     varname,
                     component,
                     experiment,
                     ensemble,
-                    "mon",
+                    freq,
                     cache_dir,
                     clobber,
                     entries,
                     cluster_in,
+                    time_range,
+                    cache_path,
+                    cache_exists,
                 )
-                print_timestamp(f"computing ann means from mon means for {varname}")
-                ds = esmlab_wrap.compute_ann_mean(xr.open_dataset(mon_path))
-        except:
-            # error occured, remove genlock file and re-raise exception, to ease subsequent attempts
-            os.remove(cache_path_genlock)
-            raise
-
-        # write generated timeseries
-        # ensure NaN _FillValues do not get generated
-        for var in ds.variables:
-            if "_FillValue" not in ds[var].encoding:
-                ds[var].encoding["_FillValue"] = None
-        # remove attributes with forbidden names
-        for att_name in ["_NCProperties"]:
-            if att_name in ds.attrs:
-                del ds.attrs[att_name]
-        ds.to_netcdf(cache_path, format="NETCDF4_CLASSIC")
-        print_timestamp(f"{cache_path} written")
-
-        # remove genlock file, indicating that cache_path has been generated
-        os.remove(cache_path_genlock)
-
-    # wait until genlock file doesn't exists, in case it was being generated or written
-    while os.path.exists(cache_path_genlock):
-        print_timestamp("genlock file exists, waiting")
-        time.sleep(5)
 
     return cache_path
 
 
+def _tseries_cache_current(cache_path, component, varname, fnames):
+    """return True if cache_path exists, covers fnames, and is not stale"""
+    return _tseries_cache_covers(cache_path, fnames) and _tseries_provenance_valid(
+        cache_path, component, varname
+    )
+
+
+def _tseries_gen_wrap_locked(
+    varname,
+    component,
+    experiment,
+    ensemble,
+    freq,
+    cache_dir,
+    clobber,
+    entries,
+    cluster_in,
+    time_range,
+    cache_path,
+    cache_exists,
+):
+    """
+    generate and write tseries file cache_path, for _tseries_gen_wrap, which holds
+    the GenLock of cache_path
+    if cache_exists, cache_path is a current file that can be extended
+    """
+    if freq == "mon" and time_range is None and not clobber and cache_exists:
+        # extend cached tseries with tseries of files it was not generated from,
+        # appending them to it if possible, otherwise rewriting it
+        print_timestamp(f"extending {cache_path}")
+        ds = None
+        if not _tseries_extend(
+            varname, component, ensemble, entries, cluster_in, cache_path
+        ):
+            ds = _tseries_gen_partial(
+                varname, component, ensemble, entries, cluster_in, cache_path
+            )
+    elif freq == "mon" and time_range is None:
+        # generate ann tseries in the same pass, if enabled, and the ann file isn't
+        # being generated elsewhere, e.g., by a caller computing it from this file
+        ann_lock = None
+        if _tseries_gen_ann():
+            ann_lock = GenLock(
+                os.path.join(
+                    cache_dir,
+                    tseries_fname(varname, component, experiment, ensemble, "ann"),
+                )
+            )
+            if not ann_lock.acquire(blocking=False):
+                ann_lock = None
+        try:
+            _tseries_gen_mon_ann(
+                varname,
+                component,
+                ensemble,
+                entries,
+                cluster_in,
+                cache_path,
+                None if ann_lock is None else ann_lock.path,
+            )
+        finally:
+            if ann_lock is not None:
+                ann_lock.release()
+        ds = None
+    if freq == "mon" and time_range is not None:
+        ds = _tseries_gen_partial(
+            varname,
+            component,
+            ensemble,
+            entries,
+            cluster_in,
+            None if clobber or not cache_exists else cache_path,
+        )
+    if freq == "ann":
+        # if the mon tseries is generated from scratch, generate it and the ann tseries
+        # in a single pass, otherwise compute the ann tseries from the mon tseries file
+        if time_range is None:
+            mon_path = os.path.join(
+                cache_dir,
+                tseries_fname(varname, component, experiment, ensemble, "mon"),
+            )
+            with GenLock(mon_path):
+                if (
+                    clobber
+                    or not os.path.exists(mon_path)
+                    or not _tseries_provenance_valid(mon_path, component, varname)
+                ):
+                    _tseries_gen_mon_ann(
+                        varname,
+                        component,
+                        ensemble,
+                        entries,
+                        cluster_in,
+                        mon_path,
+                        cache_path,
+                    )
+                    return
+        mon_path = _tseries_gen_wrap(
+            varname,
+            component,
+            experiment,
+            ensemble,
+            "mon",
+            cache_dir,
+            clobber,
+            entries,
+            cluster_in,
+            time_range,
+        )
+        # extend cached ann tseries with ann means of years after its last full year
+        ds = None
+        if (
+            time_range is not None
+            or clobber
+            or not cache_exists
+            or not _tseries_extend_ann(cache_path, mon_path)
+        ):
+            print_timestamp(f"computing ann means from mon means for {varname}")
+            ds = esmlab_wrap.compute_ann_mean(xr.open_dataset(mon_path))
+
+    # write generated timeseries, streamed timeseries have already been written
+    if ds is not None:
+        _tseries_write(ds, cache_path)
+
+
+def _tseries_gen_mon_ann(
+    varname, component, ensemble, entries, cluster_in, mon_path, ann_path=None
+):
+    """
+    generate mon tseries for varname for a particular ensemble member, and write it to
+    mon_path, and if ann_path is not None, write ann tseries computed from the mon
+    tseries in memory to ann_path, without reading mon_path
+    """
+    paths = {varname: {"mon": mon_path}}
+    if ann_path is not None:
+        paths[varname]["ann"] = ann_path
+    ds_mon = _tseries_gen_fused(
+        [varname],
+        component,
+        ensemble,
+        entries,
+        cluster_in,
+        out_paths=_tseries_stream_paths([varname], paths),
+        ann_paths=_tseries_stream_ann_paths([varname], paths),
+    )
+    _tseries_write_product(ds_mon, paths)
+
+
+def _tseries_write(ds, cache_path):
+    """write generated tseries ds to cache_path"""
+    ds = _tseries_write_prep(ds)
+    # write to a temporary file and rename it, so that readers never see a partially
+    # written file, and a cached file that ds was extended from can be replaced
+    tmp_path = tmp_fname(cache_path)
+    try:
+        to_netcdf_locked(ds, tmp_path, format="NETCDF4_CLASSIC")
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    print_timestamp(f"{cache_path} written")
+
+
+def _tseries_write_prep(ds):
+    """return ds, with encodings and attributes adjusted for writing"""
+    # ensure NaN _FillValues do not get generated
+    for var in ds.variables:
+        if "_FillValue" not in ds[var].encoding:
+            ds[var].encoding["_FillValue"] = None
+    # remove attributes with forbidden names
+    for att_name in ["_NCProperties"]:
+        if att_name in ds.attrs:
+            del ds.attrs[att_name]
+    # make time unlimited, so that the tseries file can be extended
+    if time_name in ds.dims:
+        ds.encoding["unlimited_dims"] = {time_name}
+    return ds
+
+
+class _TseriesCheckpoint:
+    """
+    context manager of checkpoints of computed time blocks of a tseries written to path
+    Blocks are pickled into the directory path + ".ckpt", which also contains a
+    manifest of the blocks, and of key, a dict of the settings that blocks depend on.
+    Checkpoints with a different key are discarded. The directory is removed on exit,
+    unless an exception occurred, e.g., a worker died, or a batch job was terminated,
+    so that a subsequent generation resumes from the checkpointed blocks.
+    """
+
+    def __init__(self, path, key):
+        self.dir = f"{path}.ckpt"
+        # normalize key, as it would be after a round trip through json
+        self.key = json.loads(json.dumps(key))
+        self._manifest_path = os.path.join(self.dir, "manifest.json")
+        self._blocks = []
+        manifest = None
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, mode="r") as fptr:
+                manifest = json.load(fptr)
+        if manifest is not None and manifest["key"] == self.key:
+            self._blocks = manifest["blocks"]
+            print_timestamp(f"{len(self._blocks)} blocks checkpointed in {self.dir}")
+        elif os.path.exists(self.dir):
+            print_timestamp(f"discarding checkpoints in {self.dir}")
+            shutil.rmtree(self.dir)
+
+    def __enter__(self):
+        return self
+
+    def get(self, time_ind0):
+        """return checkpointed block starting at time_ind0, None if there is none"""
+        if time_ind0 not in self._blocks:
+            return None
+        with open(self._block_path(time_ind0), mode="rb") as fptr:
+            return pickle.load(fptr)
+
+    def put(self, ds, time_ind0):
+        """checkpoint block ds, starting at time_ind0"""
+        os.makedirs(self.dir, exist_ok=True)
+        # write to temporary files and rename them, so that checkpoints are not
+        # corrupted if the process is terminated while writing them
+        block_path = self._block_path(time_ind0)
+        with open(f"{block_path}.tmp", mode="wb") as fptr:
+            pickle.dump(ds, fptr)
+        os.replace(f"{block_path}.tmp", block_path)
+        self._blocks.append(time_ind0)
+        with open(f"{self._manifest_path}.tmp", mode="w") as fptr:
+            json.dump({"key": self.key, "blocks": self._blocks}, fptr, indent=1)
+        os.replace(f"{self._manifest_path}.tmp", self._manifest_path)
+
+    def _block_path(self, time_ind0):
+        """return path of checkpoint of block starting at time_ind0"""
+        return os.path.join(self.dir, f"block_{time_ind0:08d}.pkl")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+
+def _tseries_cache_covers(cache_path, fnames):
+    """
+    return True if tseries file cache_path exists and, if fnames is not None,
+    was generated from all of fnames
+    """
+    if not os.path.exists(cache_path):
+        return False
+    if fnames is None:
+        return True
+    return set(fnames) <= set(_tseries_input_file_list(cache_path))
+
+
+def _tseries_provenance(component, varname, fnames):
+    """
+    return dict of provenance attributes of tseries of varname generated from fnames
+        tseries_spec_hash: hash of resolved var spec of varname, and region mask version
+        input_files_hash: hash of names, sizes, and modification times of fnames
+    """
+    return {
+        "tseries_spec_hash": _tseries_spec_hash(component, varname),
+        "input_files_hash": _input_files_hash(fnames),
+    }
+
+
+def _input_files_hash(fnames):
+    """return hash of names, sizes, and modification times of fnames"""
+    file_stats = [
+        [fname, *file_stat] for fname, file_stat in zip(fnames, _file_stats(fnames))
+    ]
+    return _hash_json(file_stats)
+
+
+def _tseries_spec_hash(component, varname):
+    """
+    return hash of resolved var spec of varname, and region mask version
+    var specs are memoized, see var_specs.get_var_specs, so this is cheap
+    """
+    spec = {
+        "var_spec": get_var_specs().resolved_spec(component, varname),
+        "rmask_version": rmask_version,
+    }
+    return _hash_json(spec)
+
+
+def _file_stats(fnames):
+    """return list of sizes and modification times of fnames, None if missing"""
+    file_stats = []
+    for fname in fnames:
+        try:
+            stat = os.stat(fname)
+            file_stats.append([stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            file_stats.append([None, None])
+    return file_stats
+
+
+def _tseries_provenance_valid(cache_path, component, varname):
+    """
+    return True if provenance attributes of tseries file cache_path match those of
+    tseries of varname generated now, from the files that cache_path was generated
+    from, i.e., var specs, region masks, and input files have not changed
+    files without provenance attributes, generated before they were introduced,
+    are assumed to be valid
+    """
+    attrs = _tseries_attrs(cache_path)
+    if "tseries_spec_hash" not in attrs:
+        return True
+    provenance = _tseries_provenance(
+        component, varname, attrs.get("input_file_list", "").split()
+    )
+    return all(attrs.get(key) == value for key, value in provenance.items())
+
+
+def _hash_json(obj):
+    """return short hex digest of json serialization of obj"""
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _tseries_input_file_list(cache_path):
+    """return list of files that tseries file cache_path was generated from"""
+    if not os.path.exists(cache_path):
+        return []
+    return _tseries_attrs(cache_path).get("input_file_list", "").split()
+
+
+def _tseries_attrs(cache_path):
+    """
+    return dict of file attributes of tseries file cache_path
+    the file is read with HDF5_LOCK, so that it can be read while tseries are written
+    in concurrent threads, see utils.to_netcdf_locked
+    """
+    with HDF5_LOCK, netCDF4.Dataset(cache_path, mode="r") as fptr:
+        return fptr.__dict__
+
+
+def _tseries_gen_partial(varname, component, ensemble, entries, cluster_in, cache_path):
+    """
+    generate a tseries for a particular ensemble member, return a Dataset object
+    if cache_path is not None, and the tseries in cache_path overlaps entries,
+    reuse it, only generating tseries for files before and after it
+    """
+    entries_ens = entries.loc[entries["ensemble"] == ensemble]
+    fnames = entries_ens.files.tolist()
+    fnames_cached = [] if cache_path is None else _tseries_input_file_list(cache_path)
+
+    # split fnames into files before, in, and after fnames_cached
+    # fnames_cached is only reused if it is a contiguous range of fnames, e.g., not if
+    # fnames has a file in the middle of fnames_cached that it was not generated from
+    fnames_pre, fnames_post = fnames, []
+    in_cached = [fname in fnames_cached for fname in fnames]
+    if any(in_cached):
+        ind0 = in_cached.index(True)
+        ind1 = len(fnames) - in_cached[::-1].index(True)
+        if all(in_cached[ind0:ind1]) and fnames[ind0:ind1] == fnames_cached:
+            fnames_pre, fnames_post = fnames[:ind0], fnames[ind1:]
+        else:
+            fnames_cached = []
+    else:
+        fnames_cached = []
+
+    ds_list = []
+    ds_gen = None
+    for fnames_gen in [fnames_pre, None, fnames_post]:
+        if fnames_gen is None:
+            if fnames_cached:
+                print_timestamp(f"reusing {cache_path}")
+                with xr.open_dataset(cache_path) as ds_cached:
+                    ds_list.append(ds_cached.load())
+        elif fnames_gen:
+            ds_gen = _tseries_gen(
+                varname,
+                component,
+                ensemble,
+                entries_ens.loc[entries_ens["files"].isin(fnames_gen)],
+                cluster_in,
+            )
+            ds_list.append(ds_gen)
+
+    if len(ds_list) == 1:
+        return ds_list[0]
+
+    ds_out = xr.concat(
+        ds_list,
+        dim=time_name,
+        data_vars=[varname],
+        coords="minimal",
+        compat="override",
+    )
+    ds_out.attrs = ds_gen.attrs
+    fnames_out = fnames_pre + fnames_cached + fnames_post
+    ds_out.attrs["input_file_list"] = " ".join(fnames_out)
+    ds_out.attrs.update(_tseries_provenance(component, varname, fnames_out))
+    for var in ds_out.variables:
+        if var in ds_gen.variables:
+            ds_out[var].encoding = ds_gen[var].encoding
+    ds_out.encoding = ds_gen.encoding
+
+    return ds_out
+
+
+def _tseries_extendable(cache_path, fnames):
+    """
+    return True if tseries file cache_path can be extended to a tseries generated from
+    fnames, by appending to it, i.e., the files it was generated from are a proper
+    prefix of fnames, and its time dimension is unlimited
+    """
+    fnames_cached = _tseries_input_file_list(cache_path)
+    if (
+        len(fnames_cached) >= len(fnames)
+        or fnames[: len(fnames_cached)] != fnames_cached
+    ):
+        return False
+    with HDF5_LOCK, netCDF4.Dataset(cache_path, mode="r") as fptr:
+        return time_name in fptr.dimensions and fptr.dimensions[time_name].isunlimited()
+
+
+def _tseries_extend(varname, component, ensemble, entries, cluster_in, cache_path):
+    """
+    extend tseries file cache_path for a particular ensemble member, by appending
+    tseries generated from files of entries that follow the files it was generated
+    from, without reading or rewriting the cached tseries
+    return False if cache_path is not extendable, see _tseries_extendable
+    """
+    entries_ens = entries.loc[entries["ensemble"] == ensemble]
+    fnames = entries_ens.files.tolist()
+    if not _tseries_extendable(cache_path, fnames):
+        return False
+    fnames_new = fnames[len(_tseries_input_file_list(cache_path)) :]
+    ds_new = _tseries_gen(
+        varname,
+        component,
+        ensemble,
+        entries_ens.loc[entries_ens["files"].isin(fnames_new)],
+        cluster_in,
+    )
+    ds_new.attrs["input_file_list"] = " ".join(fnames)
+    ds_new.attrs.update(_tseries_provenance(component, varname, fnames))
+    with xr.open_dataset(cache_path) as ds_cached:
+        tlen = ds_cached.sizes[time_name]
+    with _TseriesBlockWriter(cache_path, tlen) as writer:
+        writer.append(ds_new)
+    return True
+
+
+def _tseries_extend_ann(ann_path, mon_path):
+    """
+    extend ann tseries file ann_path with ann means of mon tseries file mon_path,
+    after mon_path has been extended
+    ann means of the last year of ann_path, which might have been incomplete, are
+    recomputed, and ann means of subsequent years are appended, without reading
+    or rewriting the rest of the tseries
+    return False if ann_path is not extendable, see _tseries_extendable
+    """
+    if not _tseries_extendable(ann_path, _tseries_input_file_list(mon_path)):
+        return False
+    print_timestamp(f"extending {ann_path}")
+    with xr.open_dataset(ann_path) as ds_ann:
+        tlen = ds_ann.sizes[time_name]
+        year_last = ds_ann[time_name].dt.year.values[-1]
+    with xr.open_dataset(mon_path) as ds_mon:
+        ds_mon = ds_mon.isel({time_name: ds_mon[time_name].dt.year >= year_last})
+        ds_ann_new = _tseries_ann(ds_mon.load())
+    with _TseriesBlockWriter(ann_path, tlen - 1) as writer:
+        writer.append(ds_ann_new)
+    return True
+
+
 def _tseries_gen(varname, component, ensemble, entries, cluster_in):
     """
     generate a tseries for a particular ensemble member, return a Dataset object
     """
-    print_timestamp(f"varname={varname}")
-    varname_resolved = _varname_resolved(varname, component)
-    fnames = entries.loc[entries["ensemble"] == ensemble].files.tolist()
-    print(fnames)
+    return _tseries_gen_fused([varname], component, ensemble, entries, cluster_in)[
+        varname
+    ]
 
-    with open(var_specs_fname, mode="r") as fptr:
-        var_specs_all = yaml.safe_load(fptr)
 
-    if varname in var_specs_all[component]["vars"]:
-        var_spec = var_specs_all[component]["vars"][varname]
-    else:
-        var_spec = {}
+def _tseries_gen_fused(
+    varnames,
+    component,
+    ensemble,
+    entries,
+    cluster_in,
+    scale_cluster=True,
+    out_paths=None,
+    ann_paths=None,
+):
+    """
+    generate tseries of varnames for a particular ensemble member,
+    return a dict of Dataset objects, keyed by varname
+    varnames must resolve to the same varname in files, their tseries are generated
+    in a single pass over it, even if their reduce_dims, tseries_op, or units differ
+    cluster_in is an exec_backend.ExecBackend, a dask.distributed cluster, or None,
+    see exec_backend.get_backend
+    if scale_cluster is False, the backend is not scaled, and may be shared with
+    concurrent calls
+    if out_paths, a dict of paths keyed by varname, is provided, tseries are streamed,
+    each time block is finalized and appended to out_paths[varname] as soon as it is
+    computed, so that only one block is held in memory, and out_paths is returned
+    streamed time blocks are also checkpointed, see _TseriesCheckpoint, if generation
+    is interrupted, a subsequent call only computes blocks that were not checkpointed
+    if tseries are streamed, and ann_paths, a dict of paths keyed by varname, is
+    provided, ann means are computed from the time blocks in memory, and appended to
+    ann_paths[varname], see _TseriesAnnWriter
+    """
+    print_timestamp(f"varnames={varnames}")
+    varname_resolved = _varname_resolved(varnames[0], component)
+    if _varnames_resolved(varnames, component) != [varname_resolved] * len(varnames):
+        raise ValueError(f"varnames={varnames} do not share a varname in files")
+    entries_ens = entries.loc[entries["ensemble"] == ensemble]
+    fnames = entries_ens.files.tolist()
+    print(fnames)
 
-    # use var specific reduce_dims if it exists, otherwise use reduce_dims for component
-    if "reduce_dims" in var_spec:
-        reduce_dims = var_spec["reduce_dims"]
-    else:
-        reduce_dims = var_specs_all[component]["reduce_dims"]
+    var_specs = get_var_specs()
 
-    # get rank of varname from first file, used to set time chunksize
-    # approximate number of time levels, assuming all files have same number
+    # plan chunk sizes, time blocks, and cluster scale
     # save time encoding from first file, to restore it in the multi-file case
     #     https://github.com/pydata/xarray/issues/2921
+    reduce_method = os.environ.get("TSERIES_REDUCE_METHOD", reduce_method_default)
     with xr.open_dataset(fnames[0]) as ds0:
-        vardims = ds0[varname_resolved].dims
-        rank = len(vardims)
-        vertlen = ds0.dims[vardims[1]] if rank > 3 else 0
-        time_chunksize = 10 * 12 if rank < 4 else 6
-        ds0.chunk(chunks={time_name: time_chunksize})
+        plan = _tseries_plan(varname_resolved, entries_ens, reduce_method, ds0)
+        time_chunksize = plan["time_chunksize"]
+        spatial_chunks = plan["spatial_chunks"]
         time_encoding = ds0[time_name].encoding
         var_encoding = ds0[varname_resolved].encoding
-        ds0_attrs = ds0.attrs
-        ds0_encoding = ds0.encoding
+        # settings of the first file, copied to generated tseries
+        ds0_settings = {
+            "attrs": ds0.attrs,
+            "encoding": ds0.encoding,
+            "time_encoding": time_encoding,
+            "fnames": fnames,
+        }
         drop_var_names_loc = drop_var_names(component, ds0, varname_resolved)
 
-    # instantiate cluster, if not provided via argument
-    # ignore dashboard warnings when instantiating
-    if cluster_in is None:
-        if "ncar_jobqueue" in sys.modules:
-            with warnings.catch_warnings():
-                warnings.filterwarnings(action="ignore", module=".*dashboard")
-                cluster = ncar_jobqueue.NCARCluster()
-        else:
-            raise ValueError(
-                "cluster_in not provided and ncar_jobqueue did not load successfully"
-            )
-    else:
-        cluster = cluster_in
-
-    workers = 12
-    if vertlen >= 20:
-        workers *= 2
-    if vertlen >= 60:
-        workers *= 2
-    workers = 2 * round(workers / 2)  # round to nearest multiple of 2
-    print_timestamp(f"calling cluster.scale({workers})")
-    cluster.scale(workers)
-
-    print_timestamp(f"dashboard_link={cluster.dashboard_link}")
-
-    # create dask distributed client, connecting to workers
-    with dask.distributed.Client(cluster) as client:
-        print_timestamp("client instantiated")
+    backend = exec_backend.get_backend(cluster_in)
+    if scale_cluster:
+        backend.scale(plan["workers"])
+        print_timestamp(f"dashboard_link={backend.dashboard_link}")
 
+    with backend.session(), contextlib.ExitStack() as writers:
         # tool to help track down file inconsistencies that trigger errors in open_mfdataset
         # test_open_mfdataset(fnames, time_chunksize, varname)
 
         # data_vars = "minimal", to avoid introducing time dimension to time-invariant fields when there are multiple files
-        # only chunk in time, because if you chunk over spatial dims, then sum results depend on chunksize
+        # only chunk in time, unless the reduce method is exact, because if you chunk over spatial dims, then sum results depend on chunksize
         #     https://github.com/pydata/xarray/issues/2902
         with xr.open_mfdataset(
             fnames,
@@ -355,7 +1251,7 @@ def _tseries_gen(varname, component, ensemble, entries, cluster_in):
             coords="minimal",
             compat="override",
             combine="by_coords",
-            chunks={time_name: time_chunksize},
+            chunks={time_name: time_chunksize, **spatial_chunks},
             drop_variables=drop_var_names_loc,
         ) as ds_in:
             print_timestamp("open_mfdataset returned")
@@ -366,40 +1262,109 @@ def _tseries_gen(varname, component, ensemble, entries, cluster_in):
             da_in_full = ds_in[varname_resolved]
             da_in_full.encoding = var_encoding
 
-            var_units = clean_units(da_in_full.attrs["units"])
-            if "unit_conv" in var_spec:
-                var_units = f"({var_spec['unit_conv']})({var_units})"
-
-            # construct averaging/integrating weight
-            weight = get_weight(ds_in, component, reduce_dims)
-            weight_attrs = weight.attrs
-            weight = get_rmask(ds_in, component) * weight
-            weight.attrs = weight_attrs
+            # settings of the reduction for each varname, keyed by varname
+            reductions = {}
+            grid_store = GridStore()
+            for varname in varnames:
+                reduction = {
+                    "reduce_dims": var_specs.reduce_dims(component, varname),
+                    "tseries_op": var_specs.tseries_op(component, varname),
+                }
+                reductions[varname] = reduction
+
+                var_units = clean_units(da_in_full.attrs["units"])
+                unit_conv = var_specs.unit_conv(component, varname)
+                if unit_conv is not None:
+                    var_units = f"({unit_conv})({var_units})"
+                reduction["var_units"] = var_units
+
+                # construct averaging/integrating weight, and regional reducer,
+                # reusing them from the grid store if possible
+                reduce_dims = reduction["reduce_dims"]
+                reduction["weight"] = grid_store.weight(ds_in, component, reduce_dims)
+                reduction["reducer"] = RegionReducer(
+                    grid_store.rmask(ds_in, component),
+                    reduction["weight"],
+                    reduce_dims,
+                    reduce_method,
+                )
             print_timestamp("weight constructed")
 
-            # compute regional sum of weights
+            # undo spatial chunking if a reducer fell back to a chunking dependent method
+            if spatial_chunks and any(
+                reduction["reducer"].method != "exact"
+                for reduction in reductions.values()
+            ):
+                da_in_full = da_in_full.chunk({dim: -1 for dim in spatial_chunks})
+
             da_in_t0 = da_in_full.isel({time_name: 0}).drop(time_name)
-            ones_masked_t0 = xr.ones_like(da_in_t0).where(da_in_t0.notnull())
-            weight_sum = (ones_masked_t0 * weight).sum(dim=reduce_dims)
-            weight_sum.name = f"weight_sum_{varname}"
-            weight_sum.attrs = weight.attrs
-            weight_sum.attrs[
-                "long_name"
-            ] = f"sum of weights used in tseries generation for {varname}"
+            da_in_tlast = da_in_full.isel({time_name: -1}).drop(time_name)
+            for varname, reduction in reductions.items():
+                # compute regional sum of weights
+                reduce_dims = reduction["reduce_dims"]
+                weight_sum = grid_store.weight_sum(
+                    ds_in, component, reduction["reducer"], da_in_t0
+                )
+
+                # if the NaN pattern of varname is the same at the first and last
+                # times, assume that it is time-invariant, and use weight_sum as the
+                # denominator of averages, instead of recomputing the denominator for
+                # each time
+                # the assumption is verified for each time block with a checksum
+                reduction["average_denom"] = None
+                if reduction["tseries_op"] == "average":
+                    checksum_t0 = nan_pattern_checksum(da_in_t0, reduce_dims).load()
+                    checksum_tlast = nan_pattern_checksum(da_in_tlast, reduce_dims)
+                    if (checksum_tlast == checksum_t0).all():
+                        reduction["average_denom"] = weight_sum.copy()
+                        reduction["checksum_t0"] = checksum_t0
+                    print_timestamp(
+                        f"varname={varname}, time-invariant NaN pattern="
+                        f"{reduction['average_denom'] is not None}"
+                    )
+
+                weight_sum.name = f"weight_sum_{varname}"
+                weight_sum.attrs = dict(reduction["weight"].attrs)
+                weight_sum.attrs[
+                    "long_name"
+                ] = f"sum of weights used in tseries generation for {varname}"
+                reduction["weight_sum"] = weight_sum
+                reduction["display_units"] = var_specs.display_units(component, varname)
+                reduction["provenance"] = _tseries_provenance(
+                    component, varname, fnames
+                )
+                reduction["ds_out_list"] = []
+                if out_paths is not None:
+                    # settings that computed blocks depend on
+                    checkpoint_key = {
+                        "varname": varname,
+                        "fnames": fnames,
+                        "reduce_method": reduce_method,
+                        "time_chunksize": time_chunksize,
+                        "spatial_chunks": spatial_chunks,
+                        "time_step": plan["time_step"],
+                        "reduce_dims": reduce_dims,
+                        "tseries_op": reduction["tseries_op"],
+                        "var_units": reduction["var_units"],
+                        "provenance": reduction["provenance"],
+                    }
+                    reduction["checkpoint"] = writers.enter_context(
+                        _TseriesCheckpoint(out_paths[varname], checkpoint_key)
+                    )
+                    reduction["writer"] = writers.enter_context(
+                        _TseriesBlockWriter(out_paths[varname])
+                    )
+                    if ann_paths is not None:
+                        reduction["ann_writer"] = _TseriesAnnWriter(
+                            writers.enter_context(
+                                _TseriesBlockWriter(ann_paths[varname])
+                            )
+                        )
 
             tlen = da_in_full.sizes[time_name]
             print_timestamp(f"tlen={tlen}")
 
-            # use var specific tseries_op if it exists, otherwise use tseries_op for component
-            if "tseries_op" in var_spec:
-                tseries_op = var_spec["tseries_op"]
-            else:
-                tseries_op = var_specs_all[component]["tseries_op"]
-
-            ds_out_list = []
-
-            time_step_nominal = min(2 * workers * time_chunksize, tlen)
-            time_step = math.ceil(tlen / (tlen // time_step_nominal))
+            time_step = plan["time_step"]
             print_timestamp(f"time_step={time_step}")
             for time_ind0 in range(0, tlen, time_step):
                 print_timestamp(f"time_ind={time_ind0}, {time_ind0 + time_step}")
@@ -407,111 +1372,337 @@ def _tseries_gen(varname, component, ensemble, entries, cluster_in):
                     {time_name: slice(time_ind0, time_ind0 + time_step)}
                 )
 
-                if tseries_op == "integrate":
-                    da_out = (da_in * weight).sum(dim=reduce_dims)
-                    da_out.name = varname
-                    da_out.attrs["long_name"] = "Integrated " + da_in.attrs["long_name"]
-                    da_out.attrs["units"] = cf_units.Unit(
-                        f"({weight.attrs['units']})({var_units})"
-                    ).format()
-                elif tseries_op == "average":
-                    da_out = (da_in * weight).sum(dim=reduce_dims)
-                    ones_masked = xr.ones_like(da_in).where(da_in.notnull())
-                    denom = (ones_masked * weight).sum(dim=reduce_dims)
-                    da_out /= denom
-                    da_out.name = varname
-                    da_out.attrs["long_name"] = "Averaged " + da_in.attrs["long_name"]
-                    da_out.attrs["units"] = cf_units.Unit(var_units).format()
-                else:
-                    msg = f"tseries_op={tseries_op} not implemented"
-                    raise NotImplementedError(msg)
-
-                print_timestamp("da_out computation setup")
-
-                # propagate some settings from da_in to da_out
-                da_out.encoding["dtype"] = da_in.encoding["dtype"]
-                copy_fill_settings(da_in, da_out)
-
-                ds_out = da_out.to_dataset()
-
-                print_timestamp("ds_out generated")
-
                 # copy particular variables from ds_in
                 copy_var_list = [time_name]
                 if "bounds" in ds_in[time_name].attrs:
                     copy_var_list.append(ds_in[time_name].attrs["bounds"])
                 copy_var_list.extend(copy_var_names(component))
-                ds_out = xr.merge(
-                    [
-                        ds_out,
-                        ds_in[copy_var_list].isel(
-                            {time_name: slice(time_ind0, time_ind0 + time_step)}
-                        ),
-                    ]
+                ds_copy = ds_in[copy_var_list].isel(
+                    {time_name: slice(time_ind0, time_ind0 + time_step)}
                 )
 
-                print_timestamp("copy_var_names added")
+                ds_outs = {}
+                checksums = {}
+                # blocks read from checkpoints, keyed by varname
+                ds_outs_checkpoint = {}
+                for varname, reduction in reductions.items():
+                    if out_paths is not None:
+                        ds_out = reduction["checkpoint"].get(time_ind0)
+                        if ds_out is not None:
+                            print_timestamp(f"{varname} block read from checkpoint")
+                            ds_outs_checkpoint[varname] = ds_out
+                            continue
+
+                    reducer = reduction["reducer"]
+                    tseries_op = reduction["tseries_op"]
+                    var_units = reduction["var_units"]
+                    if tseries_op == "integrate":
+                        da_out = reducer.integral(da_in)
+                        da_out.name = varname
+                        da_out.attrs["long_name"] = (
+                            "Integrated " + da_in.attrs["long_name"]
+                        )
+                        da_out.attrs["units"] = cf_units.Unit(
+                            f"({reduction['weight'].attrs['units']})({var_units})"
+                        ).format()
+                    elif tseries_op == "average":
+                        da_out = reducer.average(da_in, reduction["average_denom"])
+                        da_out.name = varname
+                        da_out.attrs["long_name"] = (
+                            "Averaged " + da_in.attrs["long_name"]
+                        )
+                        da_out.attrs["units"] = cf_units.Unit(var_units).format()
+                    else:
+                        msg = f"tseries_op={tseries_op} not implemented"
+                        raise NotImplementedError(msg)
+
+                    # propagate some settings from da_in to da_out
+                    da_out.encoding["dtype"] = da_in.encoding["dtype"]
+                    copy_fill_settings(da_in, da_out)
+
+                    ds_outs[varname] = xr.merge([da_out.to_dataset(), ds_copy])
+
+                    if reduction["average_denom"] is not None:
+                        checksums[varname] = nan_pattern_checksum(
+                            da_in, reduction["reduce_dims"]
+                        )
+
+                print_timestamp("ds_out computation setup")
+
+                # force computation of ds_outs, while resources of backend session
+                # are still available, computing them together reads da_in once
+                if ds_outs:
+                    print_timestamp("calling backend.compute")
+                    ds_outs, checksums = backend.compute(ds_outs, checksums)
+                    print_timestamp("returned from backend.compute")
+
+                ds_outs.update(ds_outs_checkpoint)
+                for varname, reduction in reductions.items():
+                    ds_out = ds_outs[varname]
+                    # fall back to per-time denominators if NaN pattern varies
+                    if (
+                        varname in checksums
+                        and not (checksums[varname] == reduction["checksum_t0"]).all()
+                    ):
+                        print_timestamp(
+                            f"NaN pattern of {varname} varies, recomputing denominators"
+                        )
+                        reduction["average_denom"] = None
+                        da_out = reduction["reducer"].average(da_in)
+                        da_out = da_out.transpose(*ds_out[varname].dims)
+                        ds_out[varname].values = da_out.values
+                    if out_paths is not None:
+                        if varname not in ds_outs_checkpoint:
+                            reduction["checkpoint"].put(ds_out, time_ind0)
+                        ds_out = _tseries_finalize(
+                            ds_out, varname, reduction, ds0_settings
+                        )
+                        reduction["writer"].append(ds_out)
+                        if "ann_writer" in reduction:
+                            reduction["ann_writer"].append(ds_out)
+                    else:
+                        reduction["ds_out_list"].append(ds_out)
+
+            for reduction in reductions.values():
+                if "ann_writer" in reduction:
+                    reduction["ann_writer"].close()
+
+            ds_outs = {}
+            for varname, reduction in reductions.items():
+                if out_paths is not None:
+                    continue
+                print_timestamp(f"concatenating ds_out_list datasets for {varname}")
+                ds_out = xr.concat(
+                    reduction["ds_out_list"],
+                    dim=time_name,
+                    data_vars=[varname],
+                    coords="minimal",
+                    compat="override",
+                )
+                ds_outs[varname] = _tseries_finalize(
+                    ds_out, varname, reduction, ds0_settings
+                )
 
-                # force computation of ds_out, while resources of client are still available
-                print_timestamp("calling ds_out.load")
-                ds_out_list.append(ds_out.load())
-                print_timestamp("returned from ds_out.load")
+    print_timestamp("ds_in and backend session closed")
 
-            print_timestamp("concatenating ds_out_list datasets")
-            ds_out = xr.concat(
-                ds_out_list,
-                dim=time_name,
-                data_vars=[varname],
-                coords="minimal",
-                compat="override",
-            )
+    # if backend was instantiated here, close it
+    if cluster_in is None:
+        backend.close()
 
-            # set ds_out.time to mid-interval values
-            ds_out = time_set_mid(ds_out, time_name)
+    if out_paths is not None:
+        return out_paths
+    return ds_outs
 
-            print_timestamp("time_set_mid returned")
 
-            # copy file attributes
-            ds_out.attrs = ds0_attrs
+def _tseries_finalize(ds_out, varname, reduction, ds0_settings):
+    """
+    return ds_out, the tseries of varname, or a time block of it, with time set to
+    mid-interval values, settings of the first input file, display units, and the
+    regional sum of weights
+    reduction and ds0_settings are as constructed in _tseries_gen_fused
+    """
+    # set ds_out.time to mid-interval values
+    ds_out = time_set_mid(ds_out, time_name)
 
-            datestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z")
-            msg = f"{datestamp}: created by {__file__}"
-            if "history" in ds_out.attrs:
-                ds_out.attrs["history"] = "\n".join([msg, ds_out.attrs["history"]])
-            else:
-                ds_out.attrs["history"] = msg
+    print_timestamp("time_set_mid returned")
 
-            ds_out.attrs["input_file_list"] = " ".join(fnames)
+    # copy file attributes
+    ds_out.attrs = dict(ds0_settings["attrs"])
 
-            for key in ["unlimited_dims"]:
-                if key in ds0_encoding:
-                    ds_out.encoding[key] = ds0_encoding[key]
+    datestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z")
+    msg = f"{datestamp}: created by {__file__}"
+    if "history" in ds_out.attrs:
+        ds_out.attrs["history"] = "\n".join([msg, ds_out.attrs["history"]])
+    else:
+        ds_out.attrs["history"] = msg
 
-            # restore encoding for time from first file
-            ds_out[time_name].encoding = time_encoding
+    ds_out.attrs["input_file_list"] = " ".join(ds0_settings["fnames"])
+    ds_out.attrs.update(reduction["provenance"])
 
-            # change output units, if specified in var_spec
-            units_key = (
-                "integral_display_units"
-                if tseries_op == "integrate"
-                else "display_units"
-            )
-            if units_key in var_spec:
-                ds_out[varname] = conv_units(ds_out[varname], var_spec[units_key])
-                print_timestamp("units converted")
+    for key in ["unlimited_dims"]:
+        if key in ds0_settings["encoding"]:
+            ds_out.encoding[key] = ds0_settings["encoding"][key]
 
-            # add regional sum of weights
-            ds_out[weight_sum.name] = weight_sum
+    # restore encoding for time from first file
+    ds_out[time_name].encoding = ds0_settings["time_encoding"]
 
-    print_timestamp("ds_in and client closed")
+    # change output units, if specified in var_specs
+    display_units = reduction["display_units"]
+    if display_units is not None:
+        ds_out[varname] = conv_units(ds_out[varname], display_units)
+        print_timestamp("units converted")
 
-    # if cluster was instantiated here, close it
-    if cluster_in is None:
-        cluster.close()
+    # add regional sum of weights
+    weight_sum = reduction["weight_sum"]
+    ds_out[weight_sum.name] = weight_sum
 
     return ds_out
 
 
+class _TseriesBlockWriter:
+    """
+    context manager writing a tseries to path, a time block at a time
+    The first block is written with xarray, subsequent blocks are appended
+    along the unlimited time dimension. Blocks are written to a temporary file, which
+    is renamed to path on exit, or removed if an exception occurred. Writes hold
+    HDF5_LOCK, so that writers can be used in concurrent threads.
+    If time_ind0 is not None, the existing tseries file path is extended, blocks are
+    appended to a copy of it starting at time index time_ind0, overwriting its values
+    from time_ind0 on, and attributes that depend on the files that the tseries was
+    generated from are updated.
+    """
+
+    def __init__(self, path, time_ind0=None):
+        self.path = path
+        self._tmp_path = tmp_fname(path)
+        self._tlen = 0
+        # encodings of time variables in the extended file, keyed by variable name
+        self._time_encodings = None
+        if time_ind0 is not None:
+            shutil.copyfile(path, self._tmp_path)
+            self._tlen = time_ind0
+            with HDF5_LOCK, netCDF4.Dataset(path, mode="r") as fptr:
+                self._time_encodings = {
+                    name: {
+                        key: var.getncattr(key)
+                        for key in ["units", "calendar"]
+                        if key in var.ncattrs()
+                    }
+                    for name, var in fptr.variables.items()
+                }
+                # bounds without units are encoded as the variable they bound
+                for name, var in fptr.variables.items():
+                    bounds = getattr(var, "bounds", None)
+                    if bounds in self._time_encodings:
+                        encoding = dict(self._time_encodings[name])
+                        encoding.update(self._time_encodings[bounds])
+                        self._time_encodings[bounds] = encoding
+
+    def __enter__(self):
+        return self
+
+    def append(self, ds):
+        """append time block ds to file"""
+        if self._tlen == 0:
+            ds = _tseries_write_prep(ds)
+            to_netcdf_locked(ds, self._tmp_path, format="NETCDF4_CLASSIC")
+        else:
+            # encode time dependent variables as xarray does when writing ds,
+            # and write their values into the time range of the block
+            # times of an extended file are encoded as they are in the file
+            ds = _tseries_write_prep(ds)
+            if self._time_encodings is not None:
+                for name, var in ds.variables.items():
+                    encoding = self._time_encodings.get(name, {})
+                    if var.dtype.kind in "MO" and " since " in encoding.get(
+                        "units", ""
+                    ):
+                        var.encoding.update(encoding)
+            variables, _ = xr.conventions.cf_encoder(
+                {
+                    name: var
+                    for name, var in ds.variables.items()
+                    if time_name in var.dims
+                },
+                {},
+            )
+            # HDF5_LOCK also serializes reads of input files in threads
+            with HDF5_LOCK, netCDF4.Dataset(self._tmp_path, mode="a") as fptr:
+                fptr.set_auto_maskandscale(False)
+                for name, var in variables.items():
+                    index = tuple(
+                        slice(self._tlen, self._tlen + ds.sizes[time_name])
+                        if dim == time_name
+                        else slice(None)
+                        for dim in var.dims
+                    )
+                    fptr.variables[name][index] = var.values
+                if self._time_encodings is not None:
+                    for key in [
+                        "input_file_list",
+                        "tseries_spec_hash",
+                        "input_files_hash",
+                    ]:
+                        if key in ds.attrs:
+                            fptr.setncattr(key, ds.attrs[key])
+            print_timestamp(f"block appended to {self._tmp_path}")
+        self._tlen += ds.sizes[time_name]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self._tlen > 0:
+            os.replace(self._tmp_path, self.path)
+            print_timestamp(f"{self.path} written")
+        elif os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class _TseriesAnnWriter:
+    """
+    writer of ann means of a mon tseries, computed from time blocks of the mon tseries
+    in memory, as they are produced, and appended to a file with writer, a
+    _TseriesBlockWriter
+    Months of the last year of each block are held until the next block is appended,
+    or the writer is closed, so that ann means do not depend on the time blocks.
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._ds_held = None
+
+    def append(self, ds_mon):
+        """append ann means of years that are complete, given time block ds_mon"""
+        if self._ds_held is not None:
+            ds_mon = xr.concat(
+                [self._ds_held, ds_mon],
+                dim=time_name,
+                data_vars="minimal",
+                coords="minimal",
+                compat="override",
+            )
+        year = ds_mon[time_name].dt.year.values
+        held = year == year[-1]
+        self._ds_held = ds_mon.isel({time_name: held})
+        if not held.all():
+            self._write(ds_mon.isel({time_name: ~held}))
+
+    def close(self):
+        """append ann means of held months"""
+        if self._ds_held is not None:
+            self._write(self._ds_held)
+            self._ds_held = None
+
+    def _write(self, ds_mon):
+        print_timestamp(f"computing ann means from mon means for {self._writer.path}")
+        self._writer.append(_tseries_ann(ds_mon))
+
+
+def _tseries_plan(varname_resolved, entries_ens, reduce_method, ds0=None):
+    """
+    return plan of tseries generation of varname_resolved from files of entries_ens,
+    as returned by tseries_plan.plan_tseries_gen
+    dims, shape, dtype, and numbers of time levels are from catalog header metadata,
+    if all files have it, otherwise from the first file, ds0 if it is provided,
+    assuming all files have the same number of time levels
+    """
+    headers = [data_catalog.file_header(entry) for _, entry in entries_ens.iterrows()]
+    if all(header is not None for header in headers):
+        vardims, varshape = headers[0]["var_dims"], headers[0]["var_shape"]
+        dtype = headers[0]["var_dtype"]
+        file_tlens = [int(header["time_len"]) for header in headers]
+    else:
+        if ds0 is None:
+            ds0_context = xr.open_dataset(entries_ens.iloc[0]["files"])
+        else:
+            ds0_context = contextlib.nullcontext(ds0)
+        with ds0_context as ds0_loc:
+            var = ds0_loc[varname_resolved]
+            vardims, varshape, dtype = var.dims, var.shape, var.dtype
+            file_tlens = [ds0_loc.sizes[time_name]] * len(entries_ens)
+    plan = plan_tseries_gen(vardims, varshape, dtype, file_tlens, reduce_method)
+    print_timestamp(f"varname={varname_resolved}, plan={plan}")
+    return plan
+
+
 def test_open_mfdataset(paths, time_chunksize, varname=None):
     for ind in range(len(paths) - 1):
         print(" ".join(["testing open_mfdatset for", paths[ind], paths[ind + 1]]))
@@ -525,6 +1716,10 @@ def test_open_mfdataset(paths, time_chunksize, varname=None):
             print(ds[varname])
 
 
-def tseries_fname(varname, component, experiment, ensemble, freq):
-    """return relative filename for tseries"""
-    return f"{varname}_{component}_{experiment}_{ensemble:02d}_{freq}.nc"
+def tseries_fname(varname, component, experiment, ensemble, freq, partial=False):
+    """
+    return relative filename for tseries
+    if partial is True, return filename for tseries of a subset of time
+    """
+    suffix = "_partial" if partial else ""
+    return f"{varname}_{component}_{experiment}_{ensemble:02d}_{freq}{suffix}.nc"
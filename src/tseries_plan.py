@@ -0,0 +1,190 @@
+"""planning of chunk sizes, time blocks, and cluster scale of tseries generation"""
+
+import functools
+import math
+import os
+
+import numpy as np
+from dask.utils import parse_bytes
+
+from src.config import tseries_worker_memory
+from src.utils import print_timestamp
+
+# approximate peak memory of a reduction task, in float64 values per value of its
+# input chunk, for each reduce method
+# values are converted to float64, and dense broadcasts them against each region,
+# the dense factor assumes about 20 regions, exact expands values into integer limbs
+task_mem_factors = {"dense": 24, "sparse": 4, "labelmap": 4, "exact": 32}
+
+# fraction of worker memory available to the peak memory of a single task,
+# leaving room for concurrently running tasks and data held by the worker
+worker_mem_frac = 0.25
+
+# smallest input chunk size, in bytes, that chunks are reduced to for parallelism,
+# smaller chunks are dominated by per-task overhead
+chunk_bytes_min = 2**24
+
+# range of number of workers, and number of tasks of a time block per worker
+workers_min = 2
+workers_max = 48
+tasks_per_worker = 2
+
+# plan entries that can be overridden
+override_keys = ["workers", "time_chunksize", "time_step"]
+
+
+def plan_tseries_gen(
+    vardims,
+    varshape,
+    dtype,
+    file_tlens,
+    reduce_method="dense",
+    worker_memory=None,
+    overrides=None,
+):
+    """
+    return plan of tseries generation for a field, a dict with keys
+        time_chunksize: chunksize of time dim
+        spatial_chunks: dict of chunksizes of spatial dims, empty if only time is chunked
+        time_step: number of time levels of time blocks, that are computed together
+        nblocks: number of time blocks
+        workers: number of workers to scale cluster to
+    vardims and varshape are dims and shape of the field in a single file,
+        the first dim is time
+    file_tlens is a list of the number of time levels in each file
+    worker_memory is memory per worker, in bytes or a string like "4GiB", it defaults
+        to the environment variable TSERIES_WORKER_MEMORY, or
+        config.tseries_worker_memory
+    overrides is a dict of plan entries in override_keys, that replace planned values,
+        other entries are planned consistently with them, it defaults to the environment
+        variable TSERIES_PLAN, e.g., "workers=24,time_chunksize=12"
+
+    Chunks are sized so that the peak memory of a task fits in a fraction of worker
+    memory, subject to being large enough to amortize per-task overhead, and small
+    enough that there are tasks for all workers. Time chunks do not span file
+    boundaries, and are aligned to years where possible, as are time blocks.
+    The number of workers is set from the number of tasks.
+    """
+    if worker_memory is None:
+        worker_memory = os.environ.get("TSERIES_WORKER_MEMORY", tseries_worker_memory)
+    if isinstance(worker_memory, str):
+        worker_memory = parse_bytes(worker_memory)
+    if overrides is None:
+        overrides = parse_overrides(os.environ.get("TSERIES_PLAN", ""))
+    for key in overrides:
+        if key not in override_keys:
+            raise ValueError(
+                f"unknown plan entry {key}, must be one of {override_keys}"
+            )
+
+    rank = len(vardims)
+    tlen = sum(file_tlens)
+    # time chunks that do not span files have sizes that divide all file lengths
+    file_tlen = functools.reduce(math.gcd, file_tlens)
+
+    # the exact reduce method does not depend on chunking, so the field can also be
+    # chunked over its vertical and latitudinal dims, giving more and smaller tasks
+    spatial_chunks = {}
+    if reduce_method == "exact" and rank > 2:
+        if rank > 3:
+            spatial_chunks[vardims[1]] = 10
+        spatial_chunks[vardims[-2]] = math.ceil(varshape[-2] / 4)
+    spatial_chunk_cnt = 1
+    spatial_chunk_len = 1
+    for dim, dimlen in zip(vardims[1:], varshape[1:]):
+        chunksize = spatial_chunks.get(dim, dimlen)
+        spatial_chunk_cnt *= math.ceil(dimlen / chunksize)
+        spatial_chunk_len *= chunksize
+
+    if "time_chunksize" in overrides:
+        time_chunksize = overrides["time_chunksize"]
+    else:
+        # bound on time levels from worker memory
+        task_bytes_per_time = (
+            spatial_chunk_len * 8 * task_mem_factors.get(reduce_method, 1)
+        )
+        tmax_mem = math.floor(worker_mem_frac * worker_memory / task_bytes_per_time)
+        if tmax_mem < 1:
+            print_timestamp(
+                "a single time level exceeds the memory budget of a task, "
+                "consider increasing TSERIES_WORKER_MEMORY"
+            )
+        # bound on time levels from having tasks for all workers
+        tmax_tasks = math.ceil(
+            tlen * spatial_chunk_cnt / (tasks_per_worker * workers_max)
+        )
+        # bound on time levels from minimum chunk size
+        tmin_bytes = math.ceil(
+            chunk_bytes_min / (spatial_chunk_len * np.dtype(dtype).itemsize)
+        )
+        time_chunksize = _aligned_divisor(
+            max(1, min(tmax_mem, max(tmin_bytes, tmax_tasks))), file_tlen
+        )
+    time_chunk_cnt = sum(
+        math.ceil(file_tlen_loc / time_chunksize) for file_tlen_loc in file_tlens
+    )
+
+    if "workers" in overrides:
+        workers = overrides["workers"]
+    else:
+        task_cnt = time_chunk_cnt * spatial_chunk_cnt
+        workers = math.ceil(task_cnt / tasks_per_worker)
+        workers = min(workers_max, max(workers_min, workers))
+        workers = 2 * math.ceil(workers / 2)  # round up to multiple of 2
+
+    if "time_step" in overrides:
+        time_step = overrides["time_step"]
+    else:
+        time_step_nominal = max(
+            time_chunksize,
+            tasks_per_worker * workers * time_chunksize // spatial_chunk_cnt,
+        )
+        # align time blocks to files if they span files, otherwise to years,
+        # or at least to time chunks
+        if time_step_nominal >= file_tlen:
+            block_unit = file_tlen
+        elif file_tlen % 12 == 0 and time_chunksize <= 12 and 12 % time_chunksize == 0:
+            block_unit = 12
+        else:
+            block_unit = time_chunksize
+        time_step = block_unit * max(1, round(time_step_nominal / block_unit))
+        # balance blocks, without splitting units
+        nblocks = math.ceil(tlen / time_step)
+        time_step = block_unit * math.ceil(tlen / nblocks / block_unit)
+    nblocks = math.ceil(tlen / time_step)
+
+    return {
+        "time_chunksize": time_chunksize,
+        "spatial_chunks": spatial_chunks,
+        "time_step": time_step,
+        "nblocks": nblocks,
+        "workers": workers,
+    }
+
+
+def parse_overrides(overrides_str):
+    """return dict of plan overrides, from a string like "workers=24,time_step=240" """
+    overrides = {}
+    for item in overrides_str.split(","):
+        if item.strip() == "":
+            continue
+        key, sep, value = item.partition("=")
+        if sep == "":
+            raise ValueError(f"plan override {item} is not of the form key=value")
+        overrides[key.strip()] = int(value)
+    return overrides
+
+
+def _aligned_divisor(tmax, file_tlen):
+    """
+    return largest divisor of file_tlen that is at most tmax, preferring divisors
+    aligned to years, i.e., multiples or divisors of 12, if file_tlen is a multiple of 12
+    """
+    if tmax >= file_tlen:
+        return file_tlen
+    divisors = [val for val in range(1, tmax + 1) if file_tlen % val == 0]
+    if file_tlen % 12 == 0:
+        divisors_year = [val for val in divisors if val % 12 == 0 or 12 % val == 0]
+        if divisors_year:
+            return divisors_year[-1]
+    return divisors[-1]
@@ -2,18 +2,47 @@
 
 from datetime import datetime
 import inspect
+import uuid
 
 import cftime
 import cf_units
 import numpy as np
 import xarray as xr
 from numpy.polynomial import polynomial
+from xarray.backends.locks import HDF5_LOCK
 
 
 def print_timestamp(msg):
     print(f"{str(datetime.now())}({inspect.stack()[1][3]}):{msg}")
 
 
+def tmp_fname(fname):
+    """
+    return name of a temporary file for writing fname to, and renaming it to fname,
+    so that readers never see a partially written file
+    names are unique, so that processes and threads writing fname do not collide
+    """
+    return f"{fname}.{uuid.uuid4().hex}.tmp"
+
+
+def to_netcdf_locked(ds, fname, format="NETCDF4"):
+    """
+    write ds to fname, as ds.to_netcdf does, holding HDF5_LOCK throughout
+    xarray only holds HDF5_LOCK while writing values, so concurrent writes in threads
+    are otherwise not thread safe, netCDF reads also acquire HDF5_LOCK
+    values of ds are loaded before acquiring HDF5_LOCK, because loading acquires it
+    """
+    ds = ds.load()
+    with HDF5_LOCK:
+        store = xr.backends.NetCDF4DataStore.open(
+            fname, mode="w", format=format, lock=False
+        )
+        try:
+            ds.dump_to_store(store, unlimited_dims=ds.encoding.get("unlimited_dims"))
+        finally:
+            store.close()
+
+
 def is_date(da):
     """
     Determine if da is a date-like variable.
@@ -127,6 +156,23 @@ def time_year_plus_frac(ds, time_name):
     return tvals_days / 365.0
 
 
+def time_range_sel(ds, time_name, time_range):
+    """
+    return subset of ds, along time_name, of values in the years of time_range
+    time_range is a tuple (start_year, end_year), end_year is inclusive
+    """
+    if np.dtype(ds[time_name]) == np.dtype("O"):
+        tvals_cftime = ds[time_name].values
+    else:
+        tvals_cftime = cftime.num2date(
+            ds[time_name].values,
+            ds[time_name].attrs["units"],
+            ds[time_name].attrs["calendar"],
+        )
+    years = np.array([tval.year for tval in tvals_cftime])
+    return ds.isel({time_name: (years >= time_range[0]) & (years <= time_range[1])})
+
+
 def smooth_1d_np(vals, filter_len=10 * 12, ret_edge_len=False):
     if filter_len % 2 == 1:
         smooth_edge_len = (filter_len - 1) // 2
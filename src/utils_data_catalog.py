@@ -1,65 +1,89 @@
 """interface for generating xarray Datasets accesible from data_catalog"""
 
 import xarray as xr
-import yaml
 
 from src import data_catalog
-from src.utils import print_timestamp, time_set_mid, drop_var_names
-
-from src.config import var_specs_fname
+from src.utils import print_timestamp, time_set_mid, time_range_sel, drop_var_names
+from src.var_specs import get_var_specs
 
 time_name = "time"
 
 
-def gen_ds_vars(varnames, component, experiment, stream=None, df=None):
+def gen_ds_vars(
+    varnames,
+    component,
+    experiment,
+    stream=None,
+    df=None,
+    catalog=None,
+    time_range=None,
+):
     """
     return xarray.Dataset containing varnames
-    assumes that data_catalog.set_catalog has been called
+    catalog is a data_catalog.Catalog object or catalog name,
+    if it is None, the active catalog of data_catalog is used
+    catalog is not used if df is provided
+    time_range is a tuple (start_year, end_year), end_year is inclusive,
+    if it is not None, only files overlapping time_range are opened
 
     arguments are passed to gen_ds_var
     """
     # if no stream is specified, get the default stream for this component
     if stream is None:
-        with open(var_specs_fname, mode="r") as fptr:
-            var_specs_all = yaml.safe_load(fptr)
-        stream = var_specs_all[component]["stream"]
+        stream = get_var_specs().stream(component)
 
     # get DataFrame of matching data_catalog entries
     if df is None:
-        df = data_catalog.find_in_index(
+        df = data_catalog.resolve_catalog(catalog).find_in_index(
             variable=varnames, component=component, stream=stream, experiment=experiment
         )
+    df = data_catalog.entries_in_time_range(df, time_range)
 
     ds = xr.merge(
-        [gen_ds_var(varname, component, experiment, stream, df) for varname in varnames]
+        [
+            gen_ds_var(varname, component, experiment, stream, df, None, time_range)
+            for varname in varnames
+        ]
     )
 
     return ds
 
 
-def gen_ds_var(varname, component, experiment, stream=None, df_in=None):
+def gen_ds_var(
+    varname,
+    component,
+    experiment,
+    stream=None,
+    df_in=None,
+    catalog=None,
+    time_range=None,
+):
     """
     return xarray.Dataset containing varname
-    assumes that data_catalog.set_catalog has been called
+    catalog is a data_catalog.Catalog object or catalog name,
+    if it is None, the active catalog of data_catalog is used
+    catalog is not used if df_in is provided
+    time_range is a tuple (start_year, end_year), end_year is inclusive,
+    if it is not None, only files overlapping time_range are opened,
+    and the returned Dataset is subset to time_range
     """
     print_timestamp(f"entering gen_ds_var, varname={varname}, experiment={experiment}")
     # if no stream is specified, get the default stream for this component
     if stream is None:
-        with open(var_specs_fname, mode="r") as fptr:
-            var_specs_all = yaml.safe_load(fptr)
-        stream = var_specs_all[component]["stream"]
+        stream = get_var_specs().stream(component)
 
     # get DataFrame of matching data_catalog entries
     if df_in is None:
-        df = data_catalog.find_in_index(
+        df = data_catalog.resolve_catalog(catalog).find_in_index(
             variable=varname, component=component, stream=stream, experiment=experiment
         )
     else:
         df = df_in.loc[df_in["variable"] == varname]
+    df = data_catalog.entries_in_time_range(df, time_range)
 
     if df.empty:
         raise ValueError(
-            f"no file matches found for varname={varname}, component={component}, experiment={experiment}"
+            f"no file matches found for varname={varname}, component={component}, experiment={experiment}, time_range={time_range}"
         )
 
     ensembles = df.ensemble.unique()
@@ -83,6 +107,9 @@ def gen_ds_var(varname, component, experiment, stream=None, df_in=None):
             varname, component, experiment, stream, df, ensembles[0]
         )
 
+    if time_range is not None:
+        ds = time_range_sel(ds, time_name, time_range)
+
     return ds
 
 
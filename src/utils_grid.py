@@ -8,6 +8,10 @@ import xarray as xr
 from src.utils import print_timestamp, dim_cnt_check
 from src.CIME_shr_const import CIME_shr_const
 
+# version of region mask definitions in _rmask_od, increment it when they change,
+# so that stored region masks and cached tseries derived from them are regenerated
+rmask_version = 1
+
 
 def get_latlon_isel_dict(ds, component, lat, lon):
     "return dict that selects for lat and lon values for given component"
@@ -86,6 +90,29 @@ def get_volume(ds, component):
 
 def get_rmask(ds, component):
     """return region mask appropriate for component"""
+    return get_rmask_compact(ds, component).dense()
+
+
+def get_rmask_compact(ds, component):
+    """return region mask appropriate for component, as a CompactRegionMask"""
+    rmask_od, lateral_dims = _rmask_od(ds, component)
+
+    # add coordinates if appropriate
+    coords = {}
+    if component == "atm" or component == "lnd":
+        coords["lat"] = ds["lat"].load()
+        coords["lon"] = ds["lon"].load()
+
+    masks = np.stack(
+        [np.asarray(rmask_field) != 0.0 for rmask_field in rmask_od.values()]
+    )
+    return CompactRegionMask(masks, list(rmask_od.keys()), lateral_dims, coords)
+
+
+def _rmask_od(ds, component):
+    """
+    return OrderedDict of region masks appropriate for component, and their dims
+    """
     rmask_od = OrderedDict()
     if component == "ocn":
         dim_cnt_check(ds, "KMT", 2)
@@ -252,19 +279,119 @@ def get_rmask(ds, component):
 
     print_timestamp("rmask_od created")
 
-    rmask = xr.DataArray(
-        np.zeros((len(rmask_od), ds.dims[lateral_dims[0]], ds.dims[lateral_dims[1]])),
-        dims=("region", lateral_dims[0], lateral_dims[1]),
-        coords={"region": list(rmask_od.keys())},
-    )
-    rmask.region.encoding["dtype"] = "S1"
+    return rmask_od, lateral_dims
 
-    # add coordinates if appropriate
-    if component == "atm" or component == "lnd":
-        rmask.coords["lat"] = ds["lat"]
-        rmask.coords["lon"] = ds["lon"]
 
-    for i, rmask_field in enumerate(rmask_od.values()):
-        rmask.values[i, :, :] = rmask_field
+class CompactRegionMask:
+    """
+    region masks, stored compactly
+
+    Regions are split into a partition of disjoint regions, stored as an integer
+    label map, and remaining overlapping regions, stored as bit-packed masks.
+    Regions are added to the partition greedily, smallest first.
+    The dense region x lateral dims representation is generated on demand.
+    """
 
-    return rmask
+    def __init__(self, masks, regions, lateral_dims, coords=None):
+        """
+        masks is a boolean array of shape (region, lateral dims)
+        coords are lateral coordinates added to the dense representation
+        """
+        self.regions = list(regions)
+        self.lateral_dims = tuple(lateral_dims)
+        self.shape = masks.shape[1:]
+        self.coords = {} if coords is None else coords
+
+        # label 0 is no region, label k is region self.partition[k-1]
+        self.labels = np.zeros(self.shape, dtype=np.uint8)
+        self.partition = []
+        covered = np.zeros(self.shape, dtype=bool)
+        for ind in np.argsort(masks.sum(axis=(1, 2)), kind="stable"):
+            if len(self.partition) == np.iinfo(np.uint8).max:
+                break
+            if not (masks[ind] & covered).any():
+                self.partition.append(int(ind))
+                covered |= masks[ind]
+                self.labels[masks[ind]] = len(self.partition)
+
+        self.overlap = [
+            ind for ind in range(len(self.regions)) if ind not in self.partition
+        ]
+        self.bits = np.packbits(
+            masks[self.overlap].reshape((len(self.overlap), -1)), axis=1
+        )
+
+    @classmethod
+    def from_dense(cls, rmask):
+        """return CompactRegionMask equivalent to dense region mask rmask"""
+        lateral_dims = [dim for dim in rmask.dims if dim != "region"]
+        coords = {key: coord for key, coord in rmask.coords.items() if key != "region"}
+        return cls(
+            rmask.transpose("region", *lateral_dims).values != 0.0,
+            rmask["region"].values.tolist(),
+            lateral_dims,
+            coords,
+        )
+
+    def to_dataset(self):
+        """return Dataset representation, from which from_dataset recreates self"""
+        ds = xr.Dataset(
+            {
+                "labels": (self.lateral_dims, self.labels),
+                "bits": (("overlap", "bits_byte"), self.bits),
+                "partition": ("partition", np.array(self.partition, dtype=np.int32)),
+                "overlap": ("overlap", np.array(self.overlap, dtype=np.int32)),
+                "regions": ("region", np.array(self.regions, dtype=object)),
+            }
+        )
+        for key, coord in self.coords.items():
+            ds.coords[key] = coord
+        ds.attrs["coord_names"] = " ".join(self.coords)
+        return ds
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """return CompactRegionMask from Dataset returned by to_dataset"""
+        rmask = cls.__new__(cls)
+        rmask.regions = ds["regions"].values.tolist()
+        rmask.lateral_dims = ds["labels"].dims
+        rmask.shape = ds["labels"].shape
+        rmask.coords = {key: ds[key] for key in ds.attrs["coord_names"].split()}
+        rmask.labels = ds["labels"].values.astype(np.uint8)
+        rmask.partition = ds["partition"].values.tolist()
+        rmask.overlap = ds["overlap"].values.tolist()
+        rmask.bits = ds["bits"].values.astype(np.uint8)
+        return rmask
+
+    @property
+    def nbytes(self):
+        """return number of bytes used by label map and bit-packed masks"""
+        return self.labels.nbytes + self.bits.nbytes
+
+    def masks(self):
+        """return boolean array of shape (region, lateral dims)"""
+        masks = np.zeros((len(self.regions),) + self.shape, dtype=bool)
+        for label, ind in enumerate(self.partition, start=1):
+            masks[ind] = self.labels == label
+        cell_cnt = self.labels.size
+        for bits, ind in zip(self.bits, self.overlap):
+            masks[ind] = np.unpackbits(bits)[:cell_cnt].reshape(self.shape) == 1
+        return masks
+
+    def region_coord(self):
+        """return region coordinate of dense representation"""
+        region = xr.DataArray(self.regions, dims="region", name="region")
+        region.encoding["dtype"] = "S1"
+        return region
+
+    def dense(self):
+        """return dense region mask, a float64 DataArray with dims (region, lateral dims)"""
+        rmask = xr.DataArray(
+            self.masks().astype(np.float64),
+            dims=("region",) + self.lateral_dims,
+            coords={"region": self.regions},
+        )
+        rmask.region.encoding["dtype"] = "S1"
+        for key, coord in self.coords.items():
+            rmask.coords[key] = coord
+        return rmask
@@ -0,0 +1,126 @@
+"""inter-process locks on generation of cache files"""
+
+from datetime import datetime, timezone
+import fcntl
+import json
+import os
+import socket
+
+from src.utils import print_timestamp
+
+
+class GenLock:
+    """
+    advisory lock on generation of the cache file path, an fcntl.flock lock of the
+    lock file path + ".genlock"
+
+    While the lock is held, the lock file contains the PID and host of the holder, and
+    when it acquired the lock. The lock is released by the OS if the holder exits, also
+    if it crashes, so a lock file that is not locked is stale, and is ignored, e.g., a
+    lock file left behind by a crashed process, or by an earlier version of this code.
+    Waiting for a lock blocks in the OS until the lock is released, instead of polling.
+    flock locks are per open file, so GenLock objects for the same path exclude each
+    other, also within a process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".genlock"
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self, blocking=True):
+        """
+        acquire lock, return True if it was acquired
+        if blocking is True, wait until the lock is released by its holder
+        """
+        if self._fd is not None:
+            raise RuntimeError(f"{self.lock_path} is already held by this object")
+        while True:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                print_timestamp(
+                    f"waiting for {self.lock_path}, held by {self.holder()}"
+                )
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # the holder removes the lock file before releasing the lock, if the
+            # lock file was replaced while waiting, lock the replacement
+            try:
+                if os.stat(self.lock_path).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+        self._fd = fd
+        holder = {
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+            "time": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z"),
+        }
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps(holder).encode())
+        return True
+
+    def release(self):
+        """release lock, removing the lock file"""
+        if self._fd is None:
+            return
+        os.remove(self.lock_path)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def held(self):
+        """
+        return True if the lock is held, by any process or GenLock object
+        The lock file is not locked, which could make a concurrent non-blocking
+        acquire fail. Instead, the holder of the lock is read from the lock file, and
+        the lock is held if the holder is a process on this host that is alive. The
+        lock is only tested with a shared lock of the lock file if the holder is on
+        another host, whose processes cannot be checked, or is not known yet, e.g.,
+        because the lock is being acquired.
+        """
+        if self._fd is not None:
+            return True
+        if not os.path.exists(self.lock_path):
+            return False
+        holder = self.holder()
+        if holder.get("host") == socket.gethostname() and "pid" in holder:
+            try:
+                os.kill(holder["pid"], 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+            return True
+        try:
+            fd = os.open(self.lock_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def holder(self):
+        """return dict of pid, host, and time of holder of lock, empty if unknown"""
+        try:
+            with open(self.lock_path, mode="r") as fptr:
+                return json.load(fptr)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,464 @@
+"""regional reductions of fields over spatial dimensions"""
+
+import numpy as np
+import xarray as xr
+
+import dask.array
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from src.utils import print_timestamp
+from src.utils_grid import CompactRegionMask
+
+# dense: broadcast fields against the region x space weight, then sum
+# sparse: one sparse matrix product with a region x cell weight matrix
+# labelmap: segment sums over the label map of a CompactRegionMask, for disjoint
+#     regions, and sums over bit-packed masks, for overlapping regions
+# exact: correctly rounded sums, accumulated exactly in integer limbs, so that results
+#     are bitwise independent of chunking, including chunking over reduce_dims
+reduce_methods = ["dense", "sparse", "labelmap", "exact"]
+
+# parameters of exact sums
+# the magnitude of a float64 is m * 2 ** (bit position + _exp_min), with m < 2 ** 53,
+# bit position >= 0, and 2 ** _exp_min is the smallest subnormal divided by 2 ** 53
+# m is split into integer limbs of _limb_bits bits, that are summed exactly as int64
+_limb_bits = 24
+_limb_mask = (1 << _limb_bits) - 1
+_exp_min = -1074 - 53
+_limb_cnt = (1024 - 53 - _exp_min) // _limb_bits + 4
+
+
+class RegionReducer:
+    """
+    sum, integrate, and average fields over reduce_dims, for each region of rmask
+
+    rmask is a region mask, as returned by utils_grid.get_rmask or
+        utils_grid.get_rmask_compact
+    weight is an area or volume, as returned by utils_grid.get_weight
+    NaN field values are excluded from sums, as with DataArray.sum.
+
+    Results of the dense method are the reference, results of other methods agree
+    with them to within roundoff.
+    Results of the exact method are correctly rounded sums of weight times da, and do
+    not depend on the chunking of da, so da may be chunked over reduce_dims.
+    """
+
+    def __init__(self, rmask, weight, reduce_dims, method="dense"):
+        if method not in reduce_methods:
+            raise ValueError(f"unknown reduce method={method}")
+        self.reduce_dims = list(reduce_dims)
+
+        if isinstance(rmask, CompactRegionMask):
+            lateral_dims = list(rmask.lateral_dims)
+        else:
+            lateral_dims = [dim for dim in rmask.dims if dim != "region"]
+
+        # non-dense methods require weight to be defined on exactly reduce_dims,
+        # and the lateral dimensions of rmask to be reduced
+        extra_dims = [dim for dim in self.reduce_dims if dim not in lateral_dims]
+        self._core_dims = extra_dims + lateral_dims
+        if method != "dense" and (
+            set(weight.dims) != set(self.reduce_dims)
+            or not set(lateral_dims) <= set(self.reduce_dims)
+        ):
+            print_timestamp(
+                f"weight dims={weight.dims} incompatible with {method} reduction over "
+                f"{self.reduce_dims}, using dense reduction"
+            )
+            method = "dense"
+        self.method = method
+
+        if method in ["labelmap", "exact"]:
+            if not isinstance(rmask, CompactRegionMask):
+                rmask = CompactRegionMask.from_dense(rmask)
+            self.region = rmask.region_coord()
+            kernel_class = _LabelMapKernel if method == "labelmap" else _ExactKernel
+            self._kernel = kernel_class(
+                rmask, weight.transpose(*self._core_dims).values
+            )
+            print_timestamp(f"{method} reducer constructed")
+            return
+
+        if isinstance(rmask, CompactRegionMask):
+            rmask = rmask.dense()
+        self.region = rmask["region"]
+
+        if method == "dense":
+            self._weight = rmask * weight
+            self._weight.attrs = weight.attrs
+        if method == "sparse":
+            if scipy is None:
+                raise ImportError("sparse reduce method requires scipy")
+            matrix = _region_cell_matrix(
+                rmask.transpose("region", *lateral_dims).values,
+                weight.transpose(*self._core_dims).values,
+            )
+            # sparse times dense, so that the result is dense
+            self._kernel = lambda operand: matrix.dot(operand.T).T
+        print_timestamp(f"{method} reducer constructed")
+
+    def integral(self, da):
+        """return sum of weight times da"""
+        if self.method == "dense":
+            return (da * self._weight).sum(dim=self.reduce_dims)
+        return self._apply(da, with_count=False).isel(_reduce_out=0, drop=True)
+
+    def average(self, da, weight_sum=None):
+        """
+        return weighted average of da, over cells where da is not NaN
+        if weight_sum is provided, it is used as the denominator, instead of computing
+        self.weight_sum(da), this is only valid if the NaN pattern of da is the same
+        as that of the field that weight_sum was computed from
+        """
+        if weight_sum is not None:
+            return self.integral(da) / weight_sum
+        if self.method == "dense":
+            numer = (da * self._weight).sum(dim=self.reduce_dims)
+            ones_masked = xr.ones_like(da).where(da.notnull())
+            denom = (ones_masked * self._weight).sum(dim=self.reduce_dims)
+            numer /= denom
+            return numer
+        da_out = self._apply(da, with_count=True)
+        return da_out.isel(_reduce_out=0, drop=True) / da_out.isel(
+            _reduce_out=1, drop=True
+        )
+
+    def weight_sum(self, da):
+        """return sum of weight, over cells where da is not NaN"""
+        if self.method == "dense":
+            ones_masked = xr.ones_like(da).where(da.notnull())
+            return (ones_masked * self._weight).sum(dim=self.reduce_dims)
+        return self._apply(da, with_count=True).isel(_reduce_out=1, drop=True)
+
+    def _apply(self, da, with_count):
+        """
+        return sums of weight times da, and if with_count is True,
+        sums of weight over cells where da is not NaN, along dimension _reduce_out
+        """
+        if self.method == "exact":
+            return self._apply_exact(da, with_count)
+
+        kernel = self._kernel
+        core_dim_cnt = len(self._core_dims)
+        region_cnt = self.region.size
+
+        def func(values):
+            batch_shape = values.shape[:-core_dim_cnt]
+            cell_cnt = int(np.prod(values.shape[-core_dim_cnt:]))
+            values = values.reshape((-1, cell_cnt)).astype(np.float64)
+            notnull = ~np.isnan(values)
+            operand = [np.where(notnull, values, 0.0)]
+            if with_count:
+                operand.append(notnull.astype(np.float64))
+            # one kernel call for all batch entries, and numerator and denominator
+            result = kernel(np.concatenate(operand, axis=0))
+            result = result.reshape((len(operand), -1, region_cnt))
+            return np.moveaxis(result, 0, -1).reshape(
+                batch_shape + (region_cnt, len(operand))
+            )
+
+        da_out = xr.apply_ufunc(
+            func,
+            da,
+            input_core_dims=[self._core_dims],
+            output_core_dims=[["region", "_reduce_out"]],
+            dask="parallelized",
+            output_dtypes=[np.float64],
+            output_sizes={"region": region_cnt, "_reduce_out": 2 if with_count else 1},
+        )
+        return da_out.assign_coords(region=self.region)
+
+    def _apply_exact(self, da, with_count):
+        """
+        _apply for the exact method
+        Exact integer sums are computed for each chunk of da, summed over chunks,
+        and then rounded to float64, so core dimensions of da may be chunked.
+        """
+        batch_dims = [dim for dim in da.dims if dim not in self._core_dims]
+        da = da.transpose(*batch_dims, *self._core_dims)
+        values = da.data
+        if not isinstance(values, dask.array.Array):
+            values = dask.array.from_array(values, chunks=values.shape)
+        batch_cnt = len(batch_dims)
+        core_axes = tuple(range(batch_cnt, values.ndim))
+        out_cnt = 2 if with_count else 1
+        region_cnt = self.region.size
+
+        # exact sums for each chunk, with size 1 core dimensions
+        limbs = values.map_blocks(
+            self._kernel,
+            dtype=np.int64,
+            chunks=values.chunks[:batch_cnt]
+            + tuple((1,) * len(chunks) for chunks in values.chunks[batch_cnt:])
+            + ((region_cnt,), (out_cnt,), (_limb_cnt + 2,)),
+            new_axis=[values.ndim, values.ndim + 1, values.ndim + 2],
+            with_count=with_count,
+        )
+        sums = limbs.sum(axis=core_axes).map_blocks(
+            _limbs_to_float, dtype=np.float64, drop_axis=batch_cnt + 2
+        )
+
+        da_out = xr.DataArray(
+            sums,
+            dims=batch_dims + ["region", "_reduce_out"],
+            coords={dim: da.coords[dim] for dim in batch_dims if dim in da.coords},
+        )
+        # xarray would otherwise infer the name from the dask array
+        da_out.name = da.name
+        return da_out.assign_coords(region=self.region)
+
+
+def nan_pattern_checksum(da, dims):
+    """
+    return checksum of the pattern of NaN values of da over dims, for each index of the
+    other dimensions of da
+    The checksum is an integer sum of fixed pseudo-random weights over the cells where
+    da is not NaN, so it is exact, and independent of chunking.
+    """
+    shape = tuple(da.sizes[dim] for dim in dims)
+    rng = np.random.RandomState(0)
+    weights = xr.DataArray(
+        rng.randint(1, 2**20, size=shape, dtype=np.int64), dims=dims
+    )
+    return (da.notnull() * weights).sum(dim=dims)
+
+
+def _region_cell_matrix(rmask_vals, weight_vals):
+    """
+    return sparse region x cell matrix of rmask_vals times weight_vals
+    cells are flattened from weight_vals, whose trailing dimensions are the
+    lateral dimensions of rmask_vals, leading dimensions of weight_vals are
+    extra dimensions, such as depth, that are not in rmask_vals
+    zero and non-finite weights are omitted
+    """
+    region_cnt = rmask_vals.shape[0]
+    lateral_cnt = rmask_vals[0].size
+    rmask_lateral = scipy.sparse.coo_matrix(rmask_vals.reshape((region_cnt, -1)))
+    weight_lateral = weight_vals.reshape((-1, lateral_cnt))
+
+    rows, cols, data = [], [], []
+    for extra_ind, weight_row in enumerate(weight_lateral):
+        rows.append(rmask_lateral.row)
+        cols.append(extra_ind * lateral_cnt + rmask_lateral.col)
+        data.append(rmask_lateral.data * weight_row[rmask_lateral.col])
+    rows, cols, data = (np.concatenate(vals) for vals in [rows, cols, data])
+    keep = np.isfinite(data) & (data != 0.0)
+
+    return scipy.sparse.csr_matrix(
+        (data[keep], (rows[keep], cols[keep])),
+        shape=(region_cnt, weight_lateral.size),
+    )
+
+
+class _LabelMapKernel:
+    """
+    regional sums of weighted rows of cells, using a CompactRegionMask
+    cells are flattened from weight_vals, whose trailing dimensions are the
+    lateral dimensions of the mask, as in _region_cell_matrix
+    """
+
+    def __init__(self, rmask, weight_vals):
+        self.region_cnt = len(rmask.regions)
+        self.labels = rmask.labels.ravel()
+        self.partition = rmask.partition
+        self.overlap = rmask.overlap
+        self.bits = rmask.bits
+        weight_vals = weight_vals.reshape((-1, self.labels.size))
+        self.weight_vals = np.where(np.isfinite(weight_vals), weight_vals, 0.0)
+
+    def __call__(self, operand):
+        """return array of shape (rows of operand, region)"""
+        # sum weighted values over extra dimensions, leaving lateral dimensions
+        row_cnt = operand.shape[0]
+        operand = operand.reshape((row_cnt,) + self.weight_vals.shape)
+        lateral = np.einsum("rel,el->rl", operand, self.weight_vals)
+
+        result = np.zeros((row_cnt, self.region_cnt))
+        # segment sums over label map, label 0 is no region, and is discarded
+        label_cnt = len(self.partition) + 1
+        for row_ind in range(row_cnt):
+            sums = np.bincount(
+                self.labels, weights=lateral[row_ind], minlength=label_cnt
+            )
+            result[row_ind, self.partition] = sums[1:]
+        # sums over bit-packed masks
+        if self.overlap:
+            masks = np.unpackbits(self.bits, axis=1)[:, : self.labels.size]
+            result[:, self.overlap] = lateral.dot(masks.T.astype(np.float64))
+        return result
+
+
+class _ExactKernel:
+    """
+    exact regional sums of weighted values, for chunks of fields, using a
+    CompactRegionMask
+    Sums are returned as integer limbs, that are summed across chunks, and converted to
+    float64 with _limbs_to_float.
+    """
+
+    def __init__(self, rmask, weight_vals):
+        self.region_cnt = len(rmask.regions)
+        self.labels = rmask.labels
+        self.partition = rmask.partition
+        self.overlap = rmask.overlap
+        self.masks = np.unpackbits(rmask.bits, axis=1)[:, : rmask.labels.size]
+        self.masks = self.masks.reshape((-1,) + rmask.labels.shape).astype(bool)
+        self.weight_vals = np.where(np.isfinite(weight_vals), weight_vals, 0.0)
+
+    def __call__(self, block, with_count, block_info=None):
+        """
+        return exact sums of weight times block, and if with_count is True,
+        sums of weight over cells where block is not NaN, as integer limbs
+        returned array has shape
+            batch shape + (1,) * core dim cnt + (region, out cnt, _limb_cnt + 2)
+        """
+        core_dim_cnt = self.weight_vals.ndim
+        lateral_dim_cnt = self.labels.ndim
+        batch_shape = block.shape[:-core_dim_cnt]
+        core_slices = tuple(
+            slice(start, stop)
+            for start, stop in block_info[0]["array-location"][-core_dim_cnt:]
+        )
+        lateral_slices = core_slices[-lateral_dim_cnt:]
+        weight_vals = self.weight_vals[core_slices].ravel()
+        cell_cnt = weight_vals.size
+        labels = np.broadcast_to(
+            self.labels[lateral_slices], block.shape[-core_dim_cnt:]
+        ).ravel()
+
+        values = block.reshape((-1, cell_cnt)).astype(np.float64)
+        notnull = ~np.isnan(values)
+        operand = [np.where(notnull, values, 0.0) * weight_vals]
+        if with_count:
+            operand.append(notnull * weight_vals)
+        # rows are batch entries, for each operand
+        operand = np.stack(operand, axis=1).reshape((-1, cell_cnt))
+        row_cnt = operand.shape[0]
+
+        result = np.zeros((row_cnt, self.region_cnt, _limb_cnt + 2), dtype=np.int64)
+        result[:, :, _limb_cnt] = np.sum(operand == np.inf, axis=1)[:, np.newaxis]
+        result[:, :, _limb_cnt + 1] = np.sum(operand == -np.inf, axis=1)[:, np.newaxis]
+        operand = np.where(np.isfinite(operand), operand, 0.0)
+        limb_inds, limb_vals = _float_to_limbs(operand)
+
+        # sums over label map, label 0 is no region, and is discarded
+        label_cnt = len(self.partition) + 1
+        bin_inds = (
+            np.arange(row_cnt)[:, np.newaxis, np.newaxis] * label_cnt
+            + labels[np.newaxis, :, np.newaxis]
+        ) * _limb_cnt + limb_inds
+        sums = _bincount_exact(bin_inds, limb_vals, row_cnt * label_cnt * _limb_cnt)
+        sums = sums.reshape((row_cnt, label_cnt, _limb_cnt))
+        result[:, self.partition, :_limb_cnt] = sums[:, 1:]
+        # sums over masks of overlapping regions
+        for mask_ind, region_ind in enumerate(self.overlap):
+            mask = np.broadcast_to(
+                self.masks[mask_ind][lateral_slices], block.shape[-core_dim_cnt:]
+            ).ravel()
+            bin_inds = (
+                np.arange(row_cnt)[:, np.newaxis, np.newaxis] * _limb_cnt
+                + limb_inds[:, mask]
+            )
+            sums = _bincount_exact(bin_inds, limb_vals[:, mask], row_cnt * _limb_cnt)
+            result[:, region_ind, :_limb_cnt] = sums.reshape((row_cnt, _limb_cnt))
+
+        result = result.reshape(batch_shape + (-1, self.region_cnt, _limb_cnt + 2))
+        result = np.moveaxis(result, -3, -2)
+        return result.reshape(
+            batch_shape + (1,) * core_dim_cnt + result.shape[len(batch_shape) :]
+        )
+
+
+def _float_to_limbs(vals):
+    """
+    return limb indices and signed limb values of finite float64 array vals
+    returned arrays have shape vals.shape + (6,), the sum over the last axis of
+    limb values times 2 ** (limb index * _limb_bits + _exp_min) is vals
+    """
+    mant, exp = np.frexp(np.abs(vals))
+    mant = (mant * 2.0**53).astype(np.int64)
+    limb_ind, shift = np.divmod(exp.astype(np.int64) - 53 - _exp_min, _limb_bits)
+    sign = np.where(vals < 0.0, -1, 1)
+    limb_inds, limb_vals = [], []
+    for piece_ind in range(3):
+        piece = ((mant >> (piece_ind * _limb_bits)) & _limb_mask) << shift
+        limb_inds.extend([limb_ind + piece_ind, limb_ind + piece_ind + 1])
+        limb_vals.extend([sign * (piece & _limb_mask), sign * (piece >> _limb_bits)])
+    return np.stack(limb_inds, axis=-1), np.stack(limb_vals, axis=-1)
+
+
+def _bincount_exact(bin_inds, limb_vals, bin_cnt):
+    """
+    return int64 sums of limb_vals, for each bin in bin_inds
+    limb values are less than 2 ** _limb_bits in magnitude, so float64 sums are exact
+    for up to 2 ** (53 - _limb_bits) values per bin
+    """
+    sums = np.bincount(
+        bin_inds.ravel(),
+        weights=limb_vals.ravel().astype(np.float64),
+        minlength=bin_cnt,
+    )
+    return sums.astype(np.int64)
+
+
+def _limbs_to_float(limbs):
+    """
+    return correctly rounded float64 values of sums of limbs, along the last axis
+    the last two entries of the last axis are counts of inf and -inf values
+    """
+    limbs_flat = limbs.reshape((-1, limbs.shape[-1]))
+    inf_cnt, neg_inf_cnt = limbs_flat[:, _limb_cnt], limbs_flat[:, _limb_cnt + 1]
+
+    # propagate carries, after which the most significant limb has the sign of the
+    # sum, and then propagate carries of the magnitude of the sum
+    vals = limbs_flat[:, :_limb_cnt].copy()
+    _limbs_carry(vals)
+    sign = np.where(vals[:, -1] < 0, -1, 1)
+    vals *= sign[:, np.newaxis]
+    _limbs_carry(vals)
+
+    # the sum, rounded to float64, is determined by the 4 most significant nonzero
+    # limbs, whose 73 or more bits exceed the 53 bits of float64, and whether any
+    # less significant limbs are nonzero, which is recorded in the least significant
+    # bit, so that ties are broken correctly
+    # adding their values, in two exactly representable 48 bit parts, rounds once
+    row_cnt = vals.shape[0]
+    nonzero = vals != 0
+    top_ind = _limb_cnt - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    vals_pad = np.concatenate([np.zeros((row_cnt, 3), dtype=np.int64), vals], axis=1)
+    rows = np.arange(row_cnt)
+    top = [vals_pad[rows, top_ind + 3 - ind] for ind in range(4)]
+    sticky = (nonzero & (np.arange(_limb_cnt) < (top_ind - 3)[:, np.newaxis])).any(
+        axis=1
+    )
+    hi = (top[0] << _limb_bits) | top[1]
+    lo = (top[2] << _limb_bits) | top[3] | sticky
+    mant = hi.astype(np.float64) * float(1 << (2 * _limb_bits)) + lo.astype(np.float64)
+    with np.errstate(over="ignore"):
+        result = sign * np.ldexp(mant, (top_ind - 3) * _limb_bits + _exp_min)
+
+    # subnormal values are rounded again by ldexp, compute them exactly
+    for ind in np.flatnonzero((result != 0.0) & (np.abs(result) < 2.0**-1022)):
+        total = 0
+        for limb_ind in np.flatnonzero(vals[ind]):
+            total += int(vals[ind, limb_ind]) << (int(limb_ind) * _limb_bits)
+        # int true division is correctly rounded
+        result[ind] = sign[ind] * (total / (1 << -_exp_min))
+
+    result = np.where(inf_cnt > 0, np.inf, result)
+    result = np.where(neg_inf_cnt > 0, -np.inf, result)
+    result = np.where((inf_cnt > 0) & (neg_inf_cnt > 0), np.nan, result)
+    return result.reshape(limbs.shape[:-1])
+
+
+def _limbs_carry(vals):
+    """
+    propagate carries of int64 limbs vals in place, along the last axis, so that
+    limbs are in [0, 2 ** _limb_bits), except the most significant
+    """
+    for limb_ind in range(vals.shape[-1] - 1):
+        carry, vals[..., limb_ind] = np.divmod(vals[..., limb_ind], 1 << _limb_bits)
+        vals[..., limb_ind + 1] += carry
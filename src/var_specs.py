@@ -0,0 +1,137 @@
+"""interface to variable specifications, in var_specs.yaml"""
+
+import os
+import threading
+
+import cf_units
+import yaml
+
+from src.config import var_specs_fname
+from src.utils_units import clean_units
+
+tseries_ops = ["average", "integrate"]
+
+# in-process memo of VarSpecs objects, keyed by file name
+# values are (source_key, VarSpecs), where source_key identifies the file version
+_var_specs_cache = {}
+_var_specs_cache_lock = threading.Lock()
+
+
+class VarSpecs:
+    """
+    variable specifications, parsed from a var_specs file
+
+    Specifications are validated when the file is loaded. Accessors resolve
+    var specific settings, falling back to settings for the component.
+    """
+
+    def __init__(self, fname=var_specs_fname):
+        self.fname = fname
+        with open(fname, mode="r") as fptr:
+            self._specs = yaml.safe_load(fptr)
+        self._validate()
+
+    def __repr__(self):
+        return f"VarSpecs({self.fname!r})"
+
+    def _validate(self):
+        """raise ValueError if specifications are malformed"""
+        for component, component_spec in self._specs.items():
+            for key in ["stream", "reduce_dims", "tseries_op", "vars"]:
+                if key not in component_spec:
+                    raise ValueError(
+                        f"{key} missing for component={component} in {self.fname}"
+                    )
+            self._validate_spec(component_spec, component, None)
+            for varname, var_spec in component_spec["vars"].items():
+                self._validate_spec(var_spec, component, varname)
+
+    def _validate_spec(self, spec, component, varname):
+        """raise ValueError if spec for component or varname is malformed"""
+        if "tseries_op" in spec and spec["tseries_op"] not in tseries_ops:
+            raise ValueError(
+                f"unknown tseries_op={spec['tseries_op']} for component={component}, "
+                f"varname={varname} in {self.fname}"
+            )
+        for key in ["unit_conv", "display_units", "integral_display_units"]:
+            if key not in spec:
+                continue
+            try:
+                cf_units.Unit(clean_units(str(spec[key])))
+            except ValueError as err:
+                raise ValueError(
+                    f"invalid {key}={spec[key]} for component={component}, "
+                    f"varname={varname} in {self.fname}"
+                ) from err
+
+    def components(self):
+        """return list of components"""
+        return list(self._specs)
+
+    def var_spec(self, component, varname):
+        """return dict of var specific settings, empty if there are none"""
+        return self._specs[component]["vars"].get(varname, {})
+
+    def _get(self, component, varname, key):
+        """return var specific setting for key, or setting for component"""
+        var_spec = self.var_spec(component, varname)
+        return var_spec[key] if key in var_spec else self._specs[component][key]
+
+    def stream(self, component, varname=None):
+        """return stream of varname, or default stream of component"""
+        return self._get(component, varname, "stream")
+
+    def varname_resolved(self, component, varname):
+        """resolve varname to underlying varname that appears in files"""
+        return self.var_spec(component, varname).get("varname", varname)
+
+    def reduce_dims(self, component, varname):
+        """return dimensions that tseries of varname is reduced over"""
+        return self._get(component, varname, "reduce_dims")
+
+    def tseries_op(self, component, varname):
+        """return operation, average or integrate, that generates tseries of varname"""
+        return self._get(component, varname, "tseries_op")
+
+    def unit_conv(self, component, varname):
+        """return units conversion factor of varname, None if there is none"""
+        return self.var_spec(component, varname).get("unit_conv")
+
+    def display_units(self, component, varname):
+        """
+        return units that tseries of varname are converted to, None if there are none
+        integral_display_units is used if tseries_op is integrate
+        """
+        units_key = (
+            "integral_display_units"
+            if self.tseries_op(component, varname) == "integrate"
+            else "display_units"
+        )
+        return self.var_spec(component, varname).get(units_key)
+
+    def resolved_spec(self, component, varname):
+        """return dict of settings that tseries of varname are generated with"""
+        return {
+            "varname": self.varname_resolved(component, varname),
+            "reduce_dims": self.reduce_dims(component, varname),
+            "tseries_op": self.tseries_op(component, varname),
+            "unit_conv": self.unit_conv(component, varname),
+            "display_units": self.display_units(component, varname),
+        }
+
+
+def get_var_specs(fname=var_specs_fname):
+    """
+    return VarSpecs object for fname
+    VarSpecs objects are memoized, and reloaded when fname changes
+    """
+    stat = os.stat(fname)
+    source_key = f"{stat.st_mtime_ns}:{stat.st_size}"
+    with _var_specs_cache_lock:
+        cached = _var_specs_cache.get(fname)
+        if cached is not None and cached[0] == source_key:
+            return cached[1]
+    var_specs = VarSpecs(fname)
+    with _var_specs_cache_lock:
+        _var_specs_cache[fname] = (source_key, var_specs)
+    return var_specs
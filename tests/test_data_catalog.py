@@ -0,0 +1,517 @@
+#! /usr/bin/env python3
+
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import yaml
+
+from src import data_catalog
+from src.config import rootdir
+
+catalog_name = "cesm_ocean_ice"
+
+# (component, stream, varnames, datestrs) of files generated for synthetic catalogs
+tseries_specs = [
+    ("ocn", "pop.h", ["FG_CO2", "DIC"], ["000101-001012", "001101-002012"]),
+    ("ocn", "pop.h.ecosys.nyear1", ["photoC_TOT_zint"], ["0001-0020"]),
+    ("atm", "cam.h0", ["SFCO2", "CO2"], ["000101-002012"]),
+    ("lnd", "clm2.h0", ["NBP"], ["000101-002012"]),
+]
+
+
+@pytest.fixture
+def tmp_libdir(tmp_path, monkeypatch):
+    """copy catalog to a temporary libdir, so that sidecar files are written there"""
+    fname = f"{catalog_name}.csv.gz"
+    shutil.copy(os.path.join(rootdir, "lib_data_catalog", fname), tmp_path / fname)
+    monkeypatch.setattr(data_catalog, "libdir", str(tmp_path))
+    data_catalog.set_catalog(catalog_name)
+    yield tmp_path
+    data_catalog._catalog_cache.clear()
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"experiment": "JRA"},
+        {"variable": "FG_CO2", "component": "ocn", "stream": "pop.h"},
+        {"variable": ["FG_CO2", "aice"], "experiment": ["JRA", "coreII"]},
+        {"variable": "not_a_variable"},
+        # repeated values, e.g., of varnames that resolve to the same varname in files
+        {
+            "variable": ["FG_CO2", "FG_CO2", "DIC"],
+            "component": "ocn",
+            "stream": "pop.h",
+            "experiment": "JRA",
+        },
+        {
+            "variable": ["FG_CO2", "DIC"],
+            "component": "ocn",
+            "stream": "pop.h",
+            "experiment": ["JRA", "coreII"],
+            "ensemble": 0,
+            "case": "g.e21.GOMIPECOIAF_JRA.TL319_g17.CMIP6-omip2.001",
+        },
+    ],
+)
+def test_find_in_index(tmp_libdir, kwargs):
+    df = pd.read_csv(data_catalog.active_database_file_name, index_col=0)
+    for key, val in kwargs.items():
+        df = df.loc[df[key].isin(val if isinstance(val, list) else [val])]
+    expected = df.sort_values(by=["sequence_order", "files"])
+
+    # repeat query, so that memoized catalog is used
+    for _ in range(2):
+        df_subset = data_catalog.find_in_index(**kwargs)
+        assert df_subset.index.tolist() == expected.index.tolist()
+        assert df_subset["files"].tolist() == expected["files"].tolist()
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"experiment": "JRA", "component": "ocn", "stream": "pop.h"},
+        {"experiment": "JRA", "component": "ocn", "stream": ["pop.h", np.nan]},
+        {"experiment": "JRA", "component": "ocn", "stream": "pop.h", "ensemble": 1},
+        {"experiment": "JRA", "component": "ocn", "stream": "pop.h", "variable": "DIC"},
+    ],
+)
+def test_find_in_index_nan_key(kwargs):
+    # rows with missing ensemble or stream are found, as by an unindexed query
+    df = pd.DataFrame(
+        {
+            "experiment": ["JRA"] * 4,
+            "component": ["ocn"] * 4,
+            "stream": ["pop.h", "pop.h", np.nan, "pop.h"],
+            "variable": ["FG_CO2", "DIC", "FG_CO2", "DIC"],
+            "ensemble": [0, np.nan, 0, 1],
+            "sequence_order": [0] * 4,
+            "files": [f"file_{ind}.nc" for ind in range(4)],
+        }
+    )
+    df = data_catalog._catalog_typed(df)
+    expected = df
+    for key, val in kwargs.items():
+        expected = expected.loc[
+            expected[key].isin(val if isinstance(val, list) else [val])
+        ]
+    df_subset = data_catalog._IndexedCatalog(df).find(**kwargs)
+    assert df_subset["files"].tolist() == expected["files"].tolist()
+
+
+def test_find_in_index_bad_column(tmp_libdir):
+    with pytest.raises(ValueError):
+        data_catalog.find_in_index(not_a_column="FG_CO2")
+
+
+def test_catalog_memo_invalidation(tmp_libdir):
+    df_0 = data_catalog.find_in_index(experiment="JRA")
+
+    # replace catalog with a subset, verify that memoized catalog is not used
+    df = pd.read_csv(data_catalog.active_database_file_name, index_col=0)
+    df.loc[df["experiment"] == "coreII"].to_csv(data_catalog.active_database_file_name)
+
+    assert data_catalog.find_in_index(experiment="JRA").empty
+    assert len(df_0) > 0
+
+    # verify that sidecar is regenerated and read when in-process memo is cleared
+    data_catalog._catalog_cache.clear()
+    assert data_catalog.find_in_index(experiment="JRA").empty
+    assert len(data_catalog.find_in_index(experiment="coreII")) > 0
+
+
+@pytest.mark.parametrize(
+    "time_range, expected",
+    [
+        ((1, 10), ["000101-001012", "0001-0020", "000101-002012"]),
+        ((11, 11), ["001101-002012", "0001-0020", "000101-002012"]),
+        ((15, 30), ["001101-002012", "0001-0020", "000101-002012"]),
+        ((21, 30), []),
+    ],
+)
+def test_entries_in_time_range(time_range, expected):
+    datestrs = sorted({datestr for spec in tseries_specs for datestr in spec[3]})
+    entries = pd.DataFrame(
+        {"date_range": [str(datestr.split("-")) for datestr in datestrs]}
+    )
+    entries = data_catalog.entries_in_time_range(entries, time_range)
+    assert set(entries["date_range"]) == {
+        str(datestr.split("-")) for datestr in expected
+    }
+
+
+def gen_data_source(root_dir, case):
+    """generate synthetic CESM tseries directory tree, for a single case"""
+    for component, stream, varnames, datestrs in tseries_specs:
+        tseries_dir = root_dir / component / "proc" / "tseries" / "month_1"
+        tseries_dir.mkdir(parents=True, exist_ok=True)
+        for varname in varnames:
+            for datestr in datestrs:
+                (tseries_dir / f"{case}.{stream}.{varname}.{datestr}.nc").touch()
+    # files that should not appear in the catalog
+    hist_dir = root_dir / "ocn" / "hist"
+    hist_dir.mkdir(parents=True, exist_ok=True)
+    (hist_dir / f"{case}.pop.h.0001-01.nc").touch()
+    (root_dir / "ocn" / "proc" / "README").touch()
+
+
+@pytest.fixture
+def tmp_collection(tmp_path, monkeypatch):
+    """synthetic data sources and collection input file, in a temporary libdir"""
+    libdir = tmp_path / "lib_data_catalog"
+    libdir.mkdir()
+    fname = "cesm_definitions.yml"
+    shutil.copy(os.path.join(rootdir, "lib_data_catalog", fname), libdir / fname)
+    monkeypatch.setattr(data_catalog, "libdir", str(libdir))
+
+    data_sources = {}
+    for experiment, ens_cnt in [("piControl", 1), ("historical", 3)]:
+        data_sources[experiment] = []
+        for ens in range(ens_cnt):
+            case = f"b.e21.{experiment}.{ens + 1:03d}"
+            root_dir = tmp_path / "archive" / case
+            gen_data_source(root_dir, case)
+            data_sources[experiment].append(
+                {
+                    "case": case,
+                    "parent_branch_year": 1 + 10 * ens,
+                    "root_dir": str(root_dir),
+                    "exclude_dirs": ["*/hist"],
+                }
+            )
+    collection_input_file = tmp_path / "expr_metadata.yaml"
+    with open(collection_input_file, mode="w") as fptr:
+        yaml.dump({"synthetic": {"type": "cesm", "data_sources": data_sources}}, fptr)
+    yield collection_input_file
+    data_catalog._catalog_cache.clear()
+
+
+@pytest.mark.parametrize("nworkers", [1, 4])
+def test_build_catalog(tmp_collection, nworkers):
+    data_catalog.build_catalog(tmp_collection, nworkers=nworkers)
+    data_catalog.set_catalog("synthetic")
+
+    nfiles_per_case = sum(
+        len(varnames) * len(datestrs) for _, _, varnames, datestrs in tseries_specs
+    )
+    df = data_catalog.find_in_index()
+    assert len(df) == 4 * nfiles_per_case
+    assert df["files"].is_unique
+    assert set(df["experiment"]) == {"piControl", "historical"}
+    assert set(df["ensemble"]) == {0, 1, 2}
+
+    df = data_catalog.find_in_index(
+        experiment="historical", component="ocn", stream="pop.h", variable="DIC"
+    )
+    assert len(df) == 3 * 2
+    assert df["files"].tolist() == sorted(df["files"])
+    for _, row in df.iterrows():
+        assert row["case"] == f"b.e21.historical.{row['ensemble'] + 1:03d}"
+        assert row["parent_branch_year"] == 1 + 10 * row["ensemble"]
+        assert row["file_basename"] == os.path.basename(row["files"])
+
+
+def test_add_header_metadata(tmp_collection):
+    data_catalog.build_catalog(tmp_collection)
+    data_catalog.set_catalog("synthetic")
+    df = data_catalog.find_in_index(
+        experiment="historical", component="ocn", stream="pop.h", variable="DIC"
+    )
+    fname = df["files"].iloc[0]
+
+    # replace empty file with a small tseries file
+    time_bound = np.arange(121.0).repeat(2)[1:-1].reshape((120, 2)) * 30.0
+    ds = xr.Dataset(
+        {
+            "DIC": (("time", "z_t", "nlat", "nlon"), np.zeros((120, 3, 4, 5), "f4")),
+            "time_bound": (("time", "d2"), time_bound),
+        },
+        coords={
+            "time": (
+                "time",
+                time_bound.mean(axis=1),
+                {
+                    "units": "days since 0001-01-01",
+                    "calendar": "noleap",
+                    "bounds": "time_bound",
+                },
+            )
+        },
+    )
+    ds.to_netcdf(fname)
+
+    data_catalog.build_catalog(tmp_collection, headers=True)
+    df = data_catalog.find_in_index(
+        experiment="historical", component="ocn", stream="pop.h", variable="DIC"
+    )
+    assert set(data_catalog.header_columns) <= set(df.columns)
+    header = data_catalog.file_header(df.iloc[0])
+    assert header["var_dims"] == ("time", "z_t", "nlat", "nlon")
+    assert header["var_shape"] == (120, 3, 4, 5)
+    assert header["var_dtype"] == "float32"
+    assert header["time_len"] == 120
+    assert header["time_bound_first"] == 0.0
+    assert header["time_bound_last"] == 3600.0
+    assert header["time_units"] == "days since 0001-01-01"
+    assert header["time_calendar"] == "noleap"
+    assert header["file_size"] == os.path.getsize(fname)
+
+    # remaining files are empty, and have no header metadata
+    assert df["file_size"].isna().sum() == len(df) - 1
+    assert data_catalog.file_header(df.iloc[1]) is None
+
+
+def test_add_header_metadata_1d(tmp_collection):
+    data_catalog.build_catalog(tmp_collection)
+    data_catalog.set_catalog("synthetic")
+    df = data_catalog.find_in_index(
+        experiment="historical", component="ocn", stream="pop.h", variable="FG_CO2"
+    )
+    fname = df["files"].iloc[0]
+
+    # replace empty file with a tseries file of a variable with a single dimension,
+    # whose var_dims and var_shape look like numbers in the catalog
+    ds = xr.Dataset({"FG_CO2": (("time",), np.zeros(120, "f4"))})
+    ds.to_netcdf(fname)
+
+    data_catalog.build_catalog(tmp_collection, headers=True)
+    for _ in range(2):
+        df = data_catalog.find_in_index(
+            experiment="historical", component="ocn", stream="pop.h", variable="FG_CO2"
+        )
+        header = data_catalog.file_header(df.iloc[0])
+        assert header["var_dims"] == ("time",)
+        assert header["var_shape"] == (120,)
+        # headers are retained by incremental builds
+        data_catalog.build_catalog(tmp_collection, incremental=True)
+
+
+def test_build_catalog_unlistable_dir(tmp_collection, monkeypatch):
+    # a directory that cannot be listed, e.g., that is unreadable, or that was removed
+    # during the scan, is skipped, and is rescanned by the next incremental build
+    lnd_dir = str(tmp_collection.parent / "archive" / "b.e21.historical.001" / "lnd")
+    scandir = os.scandir
+
+    def scandir_unlistable(path):
+        if path == lnd_dir:
+            raise PermissionError(f"Permission denied: {path}")
+        return scandir(path)
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(os, "scandir", scandir_unlistable)
+        data_catalog.build_catalog(tmp_collection, incremental=True)
+    data_catalog.set_catalog("synthetic")
+    df = data_catalog.find_in_index()
+    assert len(df) > 0
+    assert not df["files"].str.startswith(lnd_dir + "/").any()
+
+    data_catalog.build_catalog(tmp_collection, incremental=True)
+    df_incremental = data_catalog.find_in_index()
+    data_catalog.build_catalog(tmp_collection, clobber=True)
+    df_full = data_catalog.find_in_index()
+    assert df_incremental["files"].tolist() == df_full["files"].tolist()
+    assert df_full["files"].str.startswith(lnd_dir + "/").any()
+
+
+def test_build_catalog_incremental(tmp_collection):
+    data_catalog.build_catalog(tmp_collection, incremental=True)
+    data_catalog.set_catalog("synthetic")
+    with open(tmp_collection, mode="r") as fptr:
+        collections = yaml.safe_load(fptr)
+    data_sources = collections["synthetic"]["data_sources"]
+
+    # add an experiment, remove an ensemble member, add files and directories,
+    # remove a directory, change attributes of a data source
+    root_dir = tmp_collection.parent / "archive" / "new_case"
+    gen_data_source(root_dir, "new_case")
+    data_sources["1pctCO2"] = [
+        {"case": "new_case", "root_dir": str(root_dir), "exclude_dirs": ["*/hist"]}
+    ]
+    del data_sources["historical"][2]
+    tseries_dir = os.path.join(
+        data_sources["historical"][0]["root_dir"], "ocn", "proc", "tseries"
+    )
+    case = data_sources["historical"][0]["case"]
+    open(
+        os.path.join(tseries_dir, "month_1", f"{case}.pop.h.DIC.002101-003012.nc"),
+        mode="w",
+    ).close()
+    os.makedirs(os.path.join(tseries_dir, "day_1"))
+    open(
+        os.path.join(
+            tseries_dir, "day_1", f"{case}.pop.h.nday1.SST.00010101-00201231.nc"
+        ),
+        mode="w",
+    ).close()
+    shutil.rmtree(os.path.join(data_sources["piControl"][0]["root_dir"], "lnd", "proc"))
+    data_sources["historical"][1]["parent_branch_year"] = 101
+    with open(tmp_collection, mode="w") as fptr:
+        yaml.dump(collections, fptr)
+
+    data_catalog.build_catalog(tmp_collection, incremental=True)
+    df_incremental = data_catalog.find_in_index()
+
+    data_catalog.build_catalog(tmp_collection, clobber=True)
+    df_full = data_catalog.find_in_index()
+
+    # verify that incremental update matches full build
+    assert df_incremental["files"].tolist() == df_full["files"].tolist()
+    for col in df_full.columns:
+        assert (
+            df_incremental[col].astype(str).tolist()
+            == df_full[col].astype(str).tolist()
+        )
+    assert set(df_full["experiment"]) == {"piControl", "historical", "1pctCO2"}
+    assert set(df_full.loc[df_full["experiment"] == "historical", "ensemble"]) == {0, 1}
+    assert len(df_full.loc[df_full["component"] == "lnd"]) == 3
+    assert len(df_full.loc[df_full["variable"] == "SST"]) == 1
+
+
+def test_cesm_filename_parts_batch():
+    with open(os.path.join(rootdir, "lib_data_catalog", "cesm_definitions.yml")) as f:
+        component_streams = yaml.full_load(f)["component_streams"]
+
+    datestrs = [
+        "000101010000Z-000101311800Z",
+        "0001010100Z-0001013118Z",
+        "0001010100-0001013118",
+        "00010101-00011231",
+        "185001-201412",
+        "0001-0100",
+        "185001",
+    ]
+    filenames = []
+    for ind, (component, streams) in enumerate(component_streams.items()):
+        for stream in streams:
+            for datestr in datestrs:
+                filenames.append(
+                    f"b.e21.case.{ind:03d}.{stream}.VAR_{ind}.{datestr}.nc"
+                )
+    # file that does not conform to case.stream.variable.datestr.nc pattern
+    filenames.append("b.e21.case.001.pop.h.FG_CO2.0001-0100.extra.nc")
+    # files that the regular expression matches ambiguously: with a stream of an
+    # earlier component, or a datestr, elsewhere in the name, with a stream that also
+    # appears earlier in the name, and with a stream in the case name
+    filenames.extend(
+        [
+            "b.e21.pop.h.case.cam.h0.SFCO2.000101-001012.nc",
+            "b.e21.case.cam.h0.pop.h.FG_CO2.185001-201412.nc",
+            "b.e21.000101-000112.case.pop.h.FG_CO2.0001-0100.nc",
+            "b.e21.case.001.cam.h0.SFCO2.0001-0100.185001.nc",
+            "b.e21.cam.h0x.001.cam.h0.SFCO2.185001-201412.nc",
+            "b.e21.case.pop.h.001.cam.h0.SFCO2.185001-201412.nc",
+        ]
+    )
+
+    df = data_catalog._cesm_filename_parts_batch(filenames, component_streams)
+    assert len(df) == len(filenames)
+    for ind, filename in enumerate(filenames):
+        fileparts = data_catalog._cesm_filename_parts(filename, component_streams)
+        if fileparts is None:
+            assert df.iloc[ind].isna().all()
+        else:
+            assert df.iloc[ind].to_dict() == fileparts
+
+
+def test_catalog_threads(tmp_path, monkeypatch):
+    for name in ["cesm_land", "cesm_ocean_ice"]:
+        fname = f"{name}.csv.gz"
+        shutil.copy(os.path.join(rootdir, "lib_data_catalog", fname), tmp_path / fname)
+    monkeypatch.setattr(data_catalog, "libdir", str(tmp_path))
+
+    catalogs = [data_catalog.Catalog(name) for name in ["cesm_land", "cesm_ocean_ice"]]
+    queries = [
+        (catalogs[0], {"experiment": "GSWP-CLM5", "component": "lnd"}),
+        (catalogs[1], {"experiment": "JRA", "component": "ocn"}),
+        (catalogs[1], {"experiment": "coreII", "component": "ice"}),
+    ]
+    expected = [catalog.get_files(**kwargs) for catalog, kwargs in queries]
+    data_catalog._catalog_cache.clear()
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(
+            executor.map(lambda query: query[0].get_files(**query[1]), 4 * queries)
+        )
+    assert results == 4 * expected
+    assert all(len(files) > 0 for files in expected)
+    data_catalog._catalog_cache.clear()
+
+
+def test_catalog_threads_independent(tmp_path, monkeypatch):
+    for name in ["cesm_land", "cesm_ocean_ice"]:
+        fname = f"{name}.csv.gz"
+        shutil.copy(os.path.join(rootdir, "lib_data_catalog", fname), tmp_path / fname)
+    monkeypatch.setattr(data_catalog, "libdir", str(tmp_path))
+    data_catalog._catalog_cache.clear()
+
+    # reading cesm_land waits until cesm_ocean_ice has been read in another thread,
+    # which would deadlock if reads of different catalogs were serialized
+    land_reading = threading.Event()
+    ocean_ice_read = threading.Event()
+    read_catalog_sidecar = data_catalog._read_catalog_sidecar
+
+    def read_catalog_sidecar_wait(database_file_name, source_key):
+        if "cesm_land" in database_file_name:
+            land_reading.set()
+            assert ocean_ice_read.wait(60.0)
+        return read_catalog_sidecar(database_file_name, source_key)
+
+    monkeypatch.setattr(
+        data_catalog, "_read_catalog_sidecar", read_catalog_sidecar_wait
+    )
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(data_catalog.Catalog("cesm_land").get_files)
+        assert land_reading.wait(60.0)
+        assert len(data_catalog.Catalog("cesm_ocean_ice").get_files()) > 0
+        ocean_ice_read.set()
+        assert len(future.result()) > 0
+    data_catalog._catalog_cache.clear()
+
+
+def test_build_catalog_incremental_shared_root(tmp_collection):
+    with open(tmp_collection, mode="r") as fptr:
+        collections = yaml.safe_load(fptr)
+    data_sources = collections["synthetic"]["data_sources"]
+
+    # members of an experiment in a shared archive root, and in a root_dir that is a
+    # string prefix of another member's root_dir
+    archive_dir = tmp_collection.parent / "archive"
+    data_sources["1pctCO2"] = []
+    for case, root_dir in [
+        ("shared.001", archive_dir / "shared"),
+        ("shared.002", archive_dir / "shared"),
+        ("b.e21.1pctCO2.001", archive_dir / "b.e21.1pctCO2.001"),
+        ("b.e21.1pctCO2.0010", archive_dir / "b.e21.1pctCO2.0010"),
+    ]:
+        gen_data_source(root_dir, case)
+        data_sources["1pctCO2"].append(
+            {"case": case, "root_dir": str(root_dir), "exclude_dirs": ["*/hist"]}
+        )
+    with open(tmp_collection, mode="w") as fptr:
+        yaml.dump(collections, fptr)
+    data_catalog.build_catalog(tmp_collection, incremental=True)
+    data_catalog.set_catalog("synthetic")
+
+    # remove a member in the shared root, the other member in it is not rescanned
+    del data_sources["1pctCO2"][1]
+    with open(tmp_collection, mode="w") as fptr:
+        yaml.dump(collections, fptr)
+
+    data_catalog.build_catalog(tmp_collection, incremental=True)
+    df_incremental = data_catalog.find_in_index()
+
+    data_catalog.build_catalog(tmp_collection, clobber=True)
+    df_full = data_catalog.find_in_index()
+
+    assert df_incremental["files"].tolist() == df_full["files"].tolist()
+    assert set(df_full.loc[df_full["experiment"] == "1pctCO2", "case"]) == {
+        "shared.001",
+        "b.e21.1pctCO2.001",
+        "b.e21.1pctCO2.0010",
+    }
@@ -0,0 +1,38 @@
+#! /usr/bin/env python3
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from src.exec_backend import get_backend, ExecBackend, DistributedBackend
+
+
+@pytest.mark.parametrize("backend_name", ["local_cluster", "threads", "processes"])
+def test_backend(monkeypatch, backend_name):
+    monkeypatch.setenv("TSERIES_BACKEND", backend_name)
+    backend = get_backend()
+    assert get_backend(backend) is backend
+
+    da = xr.DataArray(np.arange(24.0).reshape((4, 6)), dims=("x", "y")).chunk({"x": 1})
+    backend.scale(2)
+    with backend.session():
+        # nested sessions share resources
+        with backend.session():
+            (da_sum,) = backend.compute(da.sum(dim="y"))
+    backend.close()
+    assert da_sum.identical(da.sum(dim="y").compute())
+
+
+def test_backend_cluster():
+    backend = get_backend(cluster_in="not_a_cluster")
+    assert isinstance(backend, DistributedBackend)
+    # clusters provided by the caller are not closed
+    backend.close()
+    assert backend.cluster == "not_a_cluster"
+
+
+def test_bad_backend(monkeypatch):
+    monkeypatch.setenv("TSERIES_BACKEND", "not_a_backend")
+    with pytest.raises(ValueError):
+        get_backend()
+    assert isinstance(get_backend(ExecBackend()), ExecBackend)
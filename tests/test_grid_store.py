@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from src.grid_store import GridStore, grid_var_names
+from src.utils_grid import get_weight, get_rmask
+from src.utils_reduce import RegionReducer
+
+
+def gen_ds(component):
+    """return synthetic Dataset with grid variables and a field, for component"""
+    rng = np.random.RandomState(0)
+    if component == "atm":
+        lat = np.linspace(-87.5, 87.5, 36)
+        ds = xr.Dataset(
+            {"gw": ("lat", np.cos(np.deg2rad(lat)))},
+            coords={"lat": lat, "lon": np.arange(0.0, 360.0, 5.0)},
+        )
+        dims = ("lat", "lon")
+    if component == "ocn":
+        shape = (24, 32)
+        dims = ("nlat", "nlon")
+        ds = xr.Dataset(
+            {
+                "TAREA": (dims, 1.0 + rng.uniform(size=shape), {"units": "cm^2"}),
+                "KMT": (dims, rng.randint(0, 5, size=shape).astype(np.float64)),
+                "REGION_MASK": (
+                    dims,
+                    rng.randint(0, 11, size=shape).astype(np.float64),
+                ),
+                "TLAT": (dims, rng.uniform(-90.0, 90.0, size=shape)),
+                "TLONG": (dims, rng.uniform(0.0, 360.0, size=shape)),
+            }
+        )
+    field = rng.normal(size=tuple(ds.sizes[dim] for dim in dims))
+    field[rng.uniform(size=field.shape) < 0.2] = np.nan
+    ds["field"] = (dims, field)
+    return ds, list(dims)
+
+
+@pytest.mark.parametrize("component", ["atm", "ocn"])
+@pytest.mark.parametrize("cached", [False, True])
+def test_grid_store(tmp_path, component, cached):
+    ds, reduce_dims = gen_ds(component)
+    weight = get_weight(ds, component, reduce_dims)
+    reducer = RegionReducer(get_rmask(ds, component), weight, reduce_dims)
+    weight_sum = reducer.weight_sum(ds["field"])
+
+    # populate store, and verify that entries are read from store
+    if cached:
+        grid_store = GridStore(str(tmp_path))
+        grid_store.weight(ds, component, reduce_dims)
+        grid_store.rmask(ds, component)
+        grid_store.weight_sum(ds, component, reducer, ds["field"])
+        assert len(os.listdir(tmp_path)) == 3
+        # different grid gets different entries
+        ds_alt = ds.copy(deep=True)
+        ds_alt[grid_var_names[component][0]] *= 2.0
+        grid_store.weight(ds_alt, component, reduce_dims)
+        assert len(os.listdir(tmp_path)) == 4
+
+    grid_store = GridStore(str(tmp_path))
+    weight_store = grid_store.weight(ds, component, reduce_dims)
+    assert weight_store.attrs == weight.attrs
+    np.testing.assert_array_equal(weight_store.values, weight.values)
+    assert grid_store.rmask(ds, component).dense().identical(get_rmask(ds, component))
+
+    reducer_store = RegionReducer(
+        grid_store.rmask(ds, component), weight_store, reduce_dims
+    )
+    weight_sum_store = grid_store.weight_sum(ds, component, reducer_store, ds["field"])
+    assert weight_sum_store.identical(weight_sum)
+
+
+def test_grid_store_disabled():
+    ds, reduce_dims = gen_ds("atm")
+    grid_store = GridStore(None)
+    weight = grid_store.weight(ds, "atm", reduce_dims)
+    assert weight.identical(get_weight(ds, "atm", reduce_dims))
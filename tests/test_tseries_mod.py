@@ -1,16 +1,28 @@
 #! /usr/bin/env python3
 
+import functools
 import os
+import shutil
+import threading
 
+import numpy as np
 import pytest
 import xarray as xr
+import yaml
 
 from src import data_catalog
+from src import exec_backend
+from src import tseries_mod
+from src import utils_lock
 from src.config import rootdir
-from src.tseries_mod import tseries_get_vars
+from src.grid_store import GridStore
+from src.tseries_mod import tseries_get_var, tseries_get_vars
+from src.utils import time_range_sel
 from src.utils_test import dict_skip_keys, ds_identical_skip_attr_list
+from src.var_specs import get_var_specs
 
-data_catalog.set_catalog("cesm_coupled")
+# the catalog is only needed by campaign_required tests, and tests of cached tseries
+data_catalog.set_catalog("cesm_coupled", check_exists=False)
 
 cache_dir_test = os.path.join(rootdir, "tseries_test")
 os.makedirs(cache_dir_test, exist_ok=True)
@@ -43,6 +55,7 @@ def test_tseries_get_vars_cached(varnames, component, experiment, stream):
         (["TOTECOSYSC", "NBP"], "lnd", "esm-hist", None),
         (["FG_CO2", "POC_FLUX_100m"], "ocn", "esm-hist-cmip5", None),
         (["FG_CO2", "POC_FLUX_100m"], "ocn", "esm-hist", None),
+        (["DIC", "DIC_vertint"], "ocn", "esm-hist", None),
     ],
 )
 @pytest.mark.campaign_required
@@ -75,3 +88,657 @@ def test_tseries_get_vars_gen(varnames, component, experiment, stream):
     )
     skip_attr_list = ["history"]
     assert ds_identical_skip_attr_list(ds_base, ds_test, skip_attr_list)
+
+
+# var specs of tseries generated from synthetic files
+# CO2 and CO2_int share a varname in files, so they are generated in a single pass
+synthetic_var_specs = {
+    "atm": {
+        "stream": "cam.h0",
+        "reduce_dims": ["lat", "lon"],
+        "tseries_op": "average",
+        "vars": {
+            "CO2": {"unit_conv": "(28.966 g)/(44 g)", "display_units": "ppmv"},
+            "CO2_int": {"varname": "CO2", "tseries_op": "integrate"},
+            "SFCO2": {"unit_conv": "(12 g)/(44 g)", "tseries_op": "integrate"},
+        },
+    }
+}
+
+# time blocks of tseries generation, they are not aligned to years
+synthetic_plan = "time_chunksize=6,time_step=18"
+
+
+def gen_cam_tseries(root_dir, case, datestrs, seed=0):
+    """
+    generate synthetic CAM monthly tseries files of CO2 and SFCO2, for a single case
+    datestrs are of the form YYYYMM-YYYYMM, files are in a noleap calendar
+    """
+    tseries_dir = root_dir / "atm" / "proc" / "tseries" / "month_1"
+    tseries_dir.mkdir(parents=True, exist_ok=True)
+    lat = np.linspace(-84.375, 84.375, 16)
+    lon = np.arange(0.0, 360.0, 15.0)
+    days_per_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+    rng = np.random.RandomState(seed)
+    for datestr in datestrs:
+        month_ind0 = 12 * (int(datestr[:4]) - 1) + int(datestr[4:6]) - 1
+        month_ind1 = 12 * (int(datestr[7:11]) - 1) + int(datestr[11:13])
+        nmonths = month_ind1 - month_ind0
+        bounds = np.cumsum([0.0] + days_per_month * int(datestr[7:11]))
+        bounds = bounds[month_ind0 : month_ind1 + 1]
+        time_bnds = np.stack([bounds[:-1], bounds[1:]], axis=1)
+        ds_common = xr.Dataset(
+            {
+                "gw": ("lat", np.cos(np.deg2rad(lat))),
+                "time_bnds": (("time", "nbnd"), time_bnds),
+                "P0": ((), 1.0e5),
+                "hyai": ("ilev", [0.0, 1.0]),
+                "hyam": ("lev", [0.5]),
+                "hybi": ("ilev", [1.0, 0.0]),
+                "hybm": ("lev", [0.5]),
+                "co2vmr": ("time", np.full(nmonths, 2.8e-4)),
+                "ch4vmr": ("time", np.full(nmonths, 7.0e-7)),
+                "f11vmr": ("time", np.zeros(nmonths)),
+                "f12vmr": ("time", np.zeros(nmonths)),
+                "n2ovmr": ("time", np.full(nmonths, 2.7e-7)),
+                "sol_tsi": ("time", np.full(nmonths, 1361.0)),
+            },
+            coords={
+                "time": (
+                    "time",
+                    time_bnds[:, 1],
+                    {
+                        "units": "days since 0001-01-01 00:00:00",
+                        "calendar": "noleap",
+                        "bounds": "time_bnds",
+                    },
+                ),
+                "lat": lat,
+                "lon": lon,
+            },
+        )
+        shape = (nmonths, lat.size, lon.size)
+        co2 = 4.0e-4 + 1.0e-5 * rng.normal(size=shape)
+        # time-invariant NaN pattern
+        co2[:, 0, :5] = np.nan
+        fields = {
+            "CO2": (co2, "kg/kg", "CO2"),
+            "SFCO2": (1.0e-8 * rng.normal(size=shape), "kg/m2/s", "CO2 surface flux"),
+        }
+        for varname, (values, units, long_name) in fields.items():
+            ds = ds_common.copy()
+            ds[varname] = (
+                ("time", "lat", "lon"),
+                values.astype(np.float32),
+                {"units": units, "long_name": long_name},
+            )
+            fname = tseries_dir / f"{case}.cam.h0.{varname}.{datestr}.nc"
+            ds.to_netcdf(fname, unlimited_dims=["time"])
+
+
+@pytest.fixture
+def tmp_synthetic(tmp_path, monkeypatch):
+    """
+    synthetic catalog, named synthetic, of CAM monthly tseries files of 2 ensemble
+    members of experiment historical, in a temporary libdir, with var specs, grid store,
+    execution backend, and time blocks for generating tseries from them
+    yields collection input file
+    """
+    libdir = tmp_path / "lib_data_catalog"
+    libdir.mkdir()
+    fname = "cesm_definitions.yml"
+    shutil.copy(os.path.join(rootdir, "lib_data_catalog", fname), libdir / fname)
+    monkeypatch.setattr(data_catalog, "libdir", str(libdir))
+    # build_catalog sets the active catalog, restore it afterwards
+    monkeypatch.setattr(data_catalog, "_active_catalog", data_catalog._active_catalog)
+    monkeypatch.setattr(
+        data_catalog,
+        "active_database_file_name",
+        data_catalog.active_database_file_name,
+    )
+
+    data_sources = []
+    for ens in range(2):
+        case = f"b.e21.historical.{ens + 1:03d}"
+        root_dir = tmp_path / "archive" / case
+        gen_cam_tseries(root_dir, case, ["000101-000212", "000301-000412"], ens)
+        data_sources.append({"case": case, "root_dir": str(root_dir)})
+    collection_input_file = tmp_path / "expr_metadata.yaml"
+    with open(collection_input_file, mode="w") as fptr:
+        collections = {"historical": data_sources}
+        yaml.dump({"synthetic": {"type": "cesm", "data_sources": collections}}, fptr)
+    data_catalog.build_catalog(collection_input_file)
+
+    var_specs_fname = tmp_path / "var_specs.yaml"
+    with open(var_specs_fname, mode="w") as fptr:
+        yaml.dump(synthetic_var_specs, fptr)
+    monkeypatch.setattr(
+        tseries_mod, "get_var_specs", functools.partial(get_var_specs, var_specs_fname)
+    )
+    monkeypatch.setattr(
+        tseries_mod, "GridStore", functools.partial(GridStore, tmp_path / "grid_cache")
+    )
+
+    for name in ["CLOBBER", "TSERIES_CONCURRENCY", "TSERIES_STREAM", "TSERIES_GEN_ANN"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("TSERIES_BACKEND", "threads")
+    monkeypatch.setenv("TSERIES_PLAN", synthetic_plan)
+    monkeypatch.setenv("TSERIES_REDUCE_METHOD", "dense")
+
+    # cache directories of tseries under test, and of reference tseries
+    (tmp_path / "tseries").mkdir()
+    (tmp_path / "tseries_ref").mkdir()
+
+    yield collection_input_file
+    data_catalog._catalog_cache.clear()
+
+
+def tseries_ref(tmp_path, varnames, freq, monkeypatch):
+    """
+    return tseries of varnames from synthetic files, generated from scratch, one
+    varname at a time, without streaming, concurrency, or generating ann tseries
+    along with mon tseries
+    """
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("TSERIES_STREAM", "0")
+        mpatch.setenv("TSERIES_GEN_ANN", "0")
+        mpatch.setenv("TSERIES_CONCURRENCY", "1")
+        ds_list = [
+            tseries_get_vars(
+                [varname],
+                "atm",
+                "historical",
+                freq=freq,
+                cache_dir=tmp_path / "tseries_ref",
+                catalog="synthetic",
+            )
+            for varname in varnames
+        ]
+        return xr.merge(ds_list).load()
+
+
+def assert_tseries_identical(ds_base, ds_test):
+    """assert that tseries are identical, except for their history attribute"""
+    assert ds_identical_skip_attr_list(ds_base.load(), ds_test.load(), ["history"])
+
+
+def record_gen_calls(monkeypatch):
+    """
+    record calls of tseries_mod._tseries_gen_fused, return list of tuples of their
+    varnames and input files
+    """
+    calls = []
+    gen_fused = tseries_mod._tseries_gen_fused
+
+    def gen_fused_record(varnames, component, ensemble, entries, *args, **kwargs):
+        fnames = entries.loc[entries["ensemble"] == ensemble].files.tolist()
+        calls.append((varnames, [os.path.basename(fname) for fname in fnames]))
+        return gen_fused(varnames, component, ensemble, entries, *args, **kwargs)
+
+    monkeypatch.setattr(tseries_mod, "_tseries_gen_fused", gen_fused_record)
+    return calls
+
+
+def test_tseries_get_var_entries_in(tmp_synthetic, tmp_path, monkeypatch):
+    ds_base = tseries_ref(tmp_path, ["SFCO2"], "mon", monkeypatch)
+
+    # entries_in without a catalog, the cache manifest is not used
+    entries = data_catalog.Catalog("synthetic").find_in_index(variable="SFCO2")
+    monkeypatch.setattr(data_catalog, "_active_catalog", None)
+    cache_dir = tmp_path / "tseries"
+    ds_test = tseries_get_var(
+        "SFCO2", "atm", "historical", cache_dir=cache_dir, entries_in=entries
+    )
+    assert_tseries_identical(ds_base, ds_test)
+    assert not os.path.exists(cache_dir / tseries_mod.manifest_fname)
+
+    # without entries_in, the catalog is needed
+    with pytest.raises(ValueError):
+        tseries_get_var("SFCO2", "atm", "historical", cache_dir=cache_dir)
+
+
+@pytest.mark.parametrize("concurrency", ["1", "2"])
+@pytest.mark.parametrize("freq", ["mon", "ann"])
+def test_tseries_gen_stream(tmp_synthetic, tmp_path, monkeypatch, concurrency, freq):
+    varnames = ["CO2", "CO2_int", "SFCO2"]
+    ds_base = tseries_ref(tmp_path, varnames, freq, monkeypatch)
+
+    monkeypatch.setenv("TSERIES_STREAM", "1")
+    monkeypatch.setenv("TSERIES_CONCURRENCY", concurrency)
+    cache_dir = tmp_path / "tseries"
+    ds_test = tseries_get_vars(
+        varnames,
+        "atm",
+        "historical",
+        freq=freq,
+        cache_dir=cache_dir,
+        catalog="synthetic",
+    )
+    assert_tseries_identical(ds_base, ds_test)
+
+    # temporary files, checkpoints, and lock files are removed
+    for fname in os.listdir(cache_dir):
+        assert fname.endswith(".nc") or fname == tseries_mod.manifest_fname
+
+
+def test_tseries_gen_concurrent(tmp_synthetic, tmp_path, monkeypatch):
+    varnames = ["CO2", "CO2_int", "SFCO2"]
+    ds_base = tseries_ref(tmp_path, varnames, "mon", monkeypatch)
+
+    # record products that are generated concurrently
+    products_list = []
+    gen_concurrent = tseries_mod._tseries_gen_concurrent
+
+    def gen_concurrent_record(products, *args):
+        products_list.append(products)
+        return gen_concurrent(products, *args)
+
+    monkeypatch.setattr(tseries_mod, "_tseries_gen_concurrent", gen_concurrent_record)
+    monkeypatch.setenv("TSERIES_CONCURRENCY", "2")
+    ds_test = tseries_get_vars(
+        varnames,
+        "atm",
+        "historical",
+        cache_dir=tmp_path / "tseries",
+        catalog="synthetic",
+    )
+    assert_tseries_identical(ds_base, ds_test)
+
+    # products of CO2 and CO2_int, and of SFCO2, for each ensemble member
+    assert len(products_list) == 1
+    assert sorted((product[0], product[1]) for product in products_list[0]) == [
+        (["CO2", "CO2_int"], 0),
+        (["CO2", "CO2_int"], 1),
+        (["SFCO2"], 0),
+        (["SFCO2"], 1),
+    ]
+
+
+def test_tseries_time_range(tmp_synthetic, tmp_path, monkeypatch):
+    ds_base = tseries_ref(tmp_path, ["SFCO2"], "mon", monkeypatch)
+    # attributes of tseries that depend on the files they were generated from
+    skip_attr_list = ["history", "input_file_list", "input_files_hash"]
+
+    calls = record_gen_calls(monkeypatch)
+    cache_dir = tmp_path / "tseries"
+    for time_range, fnames_gen in [
+        # partial tseries is generated
+        ((3, 4), ["000301-000412"]),
+        # partial tseries is extended, reusing the cached partial tseries
+        ((1, 4), ["000101-000212"]),
+        # partial tseries covers time_range
+        ((2, 3), []),
+    ]:
+        calls.clear()
+        ds_test = tseries_get_vars(
+            ["SFCO2"],
+            "atm",
+            "historical",
+            cache_dir=cache_dir,
+            catalog="synthetic",
+            time_range=time_range,
+        )
+        assert ds_identical_skip_attr_list(
+            time_range_sel(ds_base, "time", time_range), ds_test.load(), skip_attr_list
+        )
+        # generated tseries, for each ensemble member
+        assert [fnames[0].split(".")[-2] for _, fnames in calls] == fnames_gen * 2
+        assert all(len(fnames) == 1 for _, fnames in calls)
+        assert os.path.exists(cache_dir / "SFCO2_atm_historical_00_mon_partial.nc")
+
+    # full tseries is used if it covers time_range
+    tseries_get_vars(
+        ["SFCO2"], "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+    os.remove(cache_dir / "SFCO2_atm_historical_00_mon_partial.nc")
+    calls.clear()
+    ds_test = tseries_get_vars(
+        ["SFCO2"],
+        "atm",
+        "historical",
+        cache_dir=cache_dir,
+        catalog="synthetic",
+        time_range=(3, 4),
+    )
+    assert calls == []
+    assert_tseries_identical(time_range_sel(ds_base, "time", (3, 4)), ds_test)
+
+
+def test_tseries_time_range_gap(tmp_synthetic, tmp_path, monkeypatch):
+    # attributes of tseries that depend on the files they were generated from
+    skip_attr_list = ["history", "input_file_list", "input_files_hash"]
+
+    def extend_experiment(datestr):
+        for ens in range(2):
+            case = f"b.e21.historical.{ens + 1:03d}"
+            root_dir = tmp_path / "archive" / case
+            gen_cam_tseries(root_dir, case, [datestr], 10 + ens)
+        data_catalog.build_catalog(tmp_synthetic, incremental=True)
+
+    # partial tseries is generated while files of years 5-6 are missing
+    extend_experiment("000701-000812")
+    cache_dir = tmp_path / "tseries"
+    tseries_get_vars(
+        ["SFCO2"],
+        "atm",
+        "historical",
+        cache_dir=cache_dir,
+        catalog="synthetic",
+        time_range=(3, 8),
+    )
+
+    # cached partial tseries is not reused when the missing files are added
+    extend_experiment("000501-000612")
+    calls = record_gen_calls(monkeypatch)
+    ds_test = tseries_get_vars(
+        ["SFCO2"],
+        "atm",
+        "historical",
+        cache_dir=cache_dir,
+        catalog="synthetic",
+        time_range=(1, 8),
+    )
+    assert [len(fnames) for _, fnames in calls] == [4, 4]
+    ds_base = tseries_ref(tmp_path, ["SFCO2"], "mon", monkeypatch)
+    assert ds_identical_skip_attr_list(
+        time_range_sel(ds_base, "time", (1, 8)), ds_test.load(), skip_attr_list
+    )
+
+
+def test_tseries_gen_fused(tmp_synthetic, tmp_path, monkeypatch):
+    varnames = ["CO2", "CO2_int", "SFCO2"]
+    ds_base = tseries_ref(tmp_path, varnames, "mon", monkeypatch)
+
+    calls = record_gen_calls(monkeypatch)
+    ds_test = tseries_get_vars(
+        varnames,
+        "atm",
+        "historical",
+        cache_dir=tmp_path / "tseries",
+        catalog="synthetic",
+    )
+    assert_tseries_identical(ds_base, ds_test)
+
+    # CO2 and CO2_int are generated in a single pass, for each ensemble member
+    assert sorted(varnames for varnames, _ in calls) == [
+        ["CO2", "CO2_int"],
+        ["CO2", "CO2_int"],
+        ["SFCO2"],
+        ["SFCO2"],
+    ]
+
+
+@pytest.mark.parametrize("backend_name", ["local_cluster", "processes"])
+def test_tseries_gen_backend(tmp_synthetic, tmp_path, monkeypatch, backend_name):
+    varnames = ["CO2", "CO2_int", "SFCO2"]
+    ds_base = tseries_ref(tmp_path, varnames, "mon", monkeypatch)
+
+    # record backends that are instantiated
+    backends = []
+    get_backend = exec_backend.get_backend
+
+    def get_backend_record(cluster_in=None):
+        backend = get_backend(cluster_in)
+        if backend is not cluster_in:
+            backends.append(backend)
+        return backend
+
+    monkeypatch.setattr(exec_backend, "get_backend", get_backend_record)
+    monkeypatch.setenv("TSERIES_BACKEND", backend_name)
+    ds_test = tseries_get_vars(
+        varnames,
+        "atm",
+        "historical",
+        cache_dir=tmp_path / "tseries",
+        catalog="synthetic",
+    )
+    assert_tseries_identical(ds_base, ds_test)
+
+    # a single backend is shared by all varnames, and closed
+    assert len(backends) == 1
+    if backend_name == "local_cluster":
+        assert backends[0]._cluster is None
+
+
+def test_tseries_gen_resume(tmp_synthetic, tmp_path, monkeypatch):
+    ds_base = tseries_ref(tmp_path, ["SFCO2"], "mon", monkeypatch)
+
+    # interrupt generation when the third time block is computed
+    computes = []
+    interrupt = [True]
+    compute = exec_backend.ThreadsBackend.compute
+
+    def compute_interrupted(self, *args):
+        computes.append(args)
+        if interrupt[0] and len(computes) == 3:
+            raise RuntimeError("worker died")
+        return compute(self, *args)
+
+    monkeypatch.setattr(exec_backend.ThreadsBackend, "compute", compute_interrupted)
+    monkeypatch.setenv("TSERIES_STREAM", "1")
+    cache_dir = tmp_path / "tseries"
+    with pytest.raises(RuntimeError):
+        tseries_get_vars(
+            ["SFCO2"], "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+        )
+    path = cache_dir / "SFCO2_atm_historical_00_mon.nc"
+    assert not os.path.exists(path)
+    assert os.path.isdir(f"{path}.ckpt")
+
+    # resumed generation only computes time blocks that were not checkpointed,
+    # 1 of ensemble member 0, and 3 of ensemble member 1
+    computes.clear()
+    interrupt[0] = False
+    ds_test = tseries_get_vars(
+        ["SFCO2"], "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+    assert len(computes) == 4
+    assert_tseries_identical(ds_base, ds_test)
+    for fname in os.listdir(cache_dir):
+        assert fname.endswith(".nc") or fname == tseries_mod.manifest_fname
+
+
+def test_tseries_extend(tmp_synthetic, tmp_path, monkeypatch):
+    varnames = ["CO2", "SFCO2"]
+    cache_dir = tmp_path / "tseries"
+    for freq in ["mon", "ann"]:
+        tseries_get_vars(
+            varnames,
+            "atm",
+            "historical",
+            freq=freq,
+            cache_dir=cache_dir,
+            catalog="synthetic",
+        )
+
+    # record whether cached tseries are extendable, i.e., are appended to
+    extendable = []
+    tseries_extendable = tseries_mod._tseries_extendable
+
+    def extendable_record(*args):
+        extendable.append(tseries_extendable(*args))
+        return extendable[-1]
+
+    monkeypatch.setattr(tseries_mod, "_tseries_extendable", extendable_record)
+
+    # extend the experiment, first ending mid-year, then completing the year
+    calls = record_gen_calls(monkeypatch)
+    for datestr in ["000501-000506", "000507-000612"]:
+        for ens in range(2):
+            case = f"b.e21.historical.{ens + 1:03d}"
+            root_dir = tmp_path / "archive" / case
+            gen_cam_tseries(root_dir, case, [datestr], 10 + ens)
+        data_catalog.build_catalog(tmp_synthetic, incremental=True)
+
+        # mon and ann tseries are extended, generating tseries of only the new files
+        calls.clear()
+        extendable.clear()
+        ds_test = {
+            freq: tseries_get_vars(
+                varnames,
+                "atm",
+                "historical",
+                freq=freq,
+                cache_dir=cache_dir,
+                catalog="synthetic",
+            )
+            for freq in ["mon", "ann"]
+        }
+        assert sorted(calls) == sorted(
+            ([varname], [f"{case}.cam.h0.{varname}.{datestr}.nc"])
+            for varname in varnames
+            for case in ["b.e21.historical.001", "b.e21.historical.002"]
+        )
+        # mon and ann tseries, of each varname and ensemble member
+        assert extendable == [True] * 8
+        shutil.rmtree(tmp_path / "tseries_ref")
+        (tmp_path / "tseries_ref").mkdir()
+        for freq in ["mon", "ann"]:
+            ds_base = tseries_ref(tmp_path, varnames, freq, monkeypatch)
+            assert_tseries_identical(ds_base, ds_test[freq])
+
+
+def test_tseries_manifest(tmp_synthetic, tmp_path, monkeypatch):
+    varnames = ["CO2", "SFCO2"]
+    cache_dir = tmp_path / "tseries"
+    tseries_get_vars(
+        varnames, "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+
+    # record validations of provenance attributes of cached tseries files
+    validations = []
+    provenance_valid = tseries_mod._tseries_provenance_valid
+
+    def provenance_valid_record(cache_path, *args):
+        validations.append(os.path.basename(cache_path))
+        return provenance_valid(cache_path, *args)
+
+    monkeypatch.setattr(
+        tseries_mod, "_tseries_provenance_valid", provenance_valid_record
+    )
+
+    # manifest hits do not validate cached files, or generate tseries
+    calls = record_gen_calls(monkeypatch)
+    tseries_get_vars(
+        varnames, "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+    assert validations == []
+    assert calls == []
+
+    # edit var specs of SFCO2, only its tseries are validated and regenerated
+    var_specs = yaml.safe_load(yaml.dump(synthetic_var_specs))
+    var_specs["atm"]["vars"]["SFCO2"]["tseries_op"] = "average"
+    with open(tmp_path / "var_specs.yaml", mode="w") as fptr:
+        yaml.dump(var_specs, fptr)
+    ds_test = tseries_get_vars(
+        varnames, "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+    assert validations and all(fname.startswith("SFCO2") for fname in validations)
+    assert sorted(varnames for varnames, _ in calls) == [["SFCO2"], ["SFCO2"]]
+    ds_base = tseries_ref(tmp_path, varnames, "mon", monkeypatch)
+    assert_tseries_identical(ds_base, ds_test)
+    assert ds_test["SFCO2"].attrs["long_name"].startswith("Averaged")
+
+    # rewrite input files of ensemble member 0 in place, without rebuilding the
+    # catalog, tseries generated from them are validated and regenerated
+    validations.clear()
+    calls.clear()
+    case = "b.e21.historical.001"
+    gen_cam_tseries(tmp_path / "archive" / case, case, ["000301-000412"], 20)
+    ds_test = tseries_get_vars(
+        varnames, "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+    datestrs = ["000101-000212", "000301-000412"]
+    assert sorted(calls) == [
+        ([varname], [f"{case}.cam.h0.{varname}.{datestr}.nc" for datestr in datestrs])
+        for varname in varnames
+    ]
+    shutil.rmtree(tmp_path / "tseries_ref")
+    (tmp_path / "tseries_ref").mkdir()
+    ds_base = tseries_ref(tmp_path, varnames, "mon", monkeypatch)
+    assert_tseries_identical(ds_base, ds_test)
+
+
+def test_tseries_gen_wait(tmp_synthetic, tmp_path, monkeypatch):
+    ds_base = tseries_ref(tmp_path, ["SFCO2"], "mon", monkeypatch)
+
+    # signal when generation waits for a GenLock
+    waiting = threading.Event()
+    print_timestamp = utils_lock.print_timestamp
+
+    def print_timestamp_signal(msg):
+        print_timestamp(msg)
+        if msg.startswith("waiting for"):
+            waiting.set()
+
+    monkeypatch.setattr(utils_lock, "print_timestamp", print_timestamp_signal)
+
+    # generation of ensemble member 0 waits while another holder of its GenLock
+    # generates it, and reuses the file it generated
+    calls = record_gen_calls(monkeypatch)
+    cache_dir = tmp_path / "tseries"
+    fname = "SFCO2_atm_historical_00_mon.nc"
+    results = []
+    with utils_lock.GenLock(str(cache_dir / fname)):
+        thread = threading.Thread(
+            target=lambda: results.append(
+                tseries_get_vars(
+                    ["SFCO2"],
+                    "atm",
+                    "historical",
+                    cache_dir=cache_dir,
+                    catalog="synthetic",
+                )
+            )
+        )
+        thread.start()
+        assert waiting.wait(60.0)
+        assert calls == []
+        shutil.copy(tmp_path / "tseries_ref" / fname, cache_dir / fname)
+    thread.join()
+
+    assert [fnames[0].split(".")[3] for _, fnames in calls] == ["002"]
+    assert_tseries_identical(ds_base, results[0])
+
+
+@pytest.mark.parametrize("gen_ann", [None, "1"])
+def test_tseries_gen_ann(tmp_synthetic, tmp_path, monkeypatch, gen_ann):
+    varnames = ["CO2", "CO2_int", "SFCO2"]
+    ds_base = tseries_ref(tmp_path, varnames, "ann", monkeypatch)
+
+    # ann means are computed from time blocks of streamed mon tseries in memory,
+    # before the mon tseries files are written
+    ann_writes = []
+    ann_write = tseries_mod._TseriesAnnWriter._write
+
+    def ann_write_record(self, ds_mon):
+        mon_path = self._writer.path.replace("_ann.nc", "_mon.nc")
+        ann_writes.append(os.path.exists(mon_path))
+        return ann_write(self, ds_mon)
+
+    monkeypatch.setattr(tseries_mod._TseriesAnnWriter, "_write", ann_write_record)
+    monkeypatch.setenv("TSERIES_STREAM", "1")
+    if gen_ann is not None:
+        monkeypatch.setenv("TSERIES_GEN_ANN", gen_ann)
+    cache_dir = tmp_path / "tseries"
+    tseries_get_vars(
+        varnames, "atm", "historical", cache_dir=cache_dir, catalog="synthetic"
+    )
+
+    # ann tseries are only generated along with mon tseries if TSERIES_GEN_ANN=1
+    fname = "SFCO2_atm_historical_00_ann.nc"
+    assert os.path.exists(cache_dir / fname) == (gen_ann == "1")
+    assert ann_writes == [False] * len(ann_writes)
+    assert bool(ann_writes) == (gen_ann == "1")
+
+    calls = record_gen_calls(monkeypatch)
+    ds_test = tseries_get_vars(
+        varnames,
+        "atm",
+        "historical",
+        freq="ann",
+        cache_dir=cache_dir,
+        catalog="synthetic",
+    )
+    assert calls == []
+    assert_tseries_identical(ds_base, ds_test)
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+
+import pytest
+
+from src.tseries_plan import (
+    parse_overrides,
+    plan_tseries_gen,
+    task_mem_factors,
+    worker_mem_frac,
+    workers_max,
+)
+
+ocn_2d = (("time", "nlat", "nlon"), (120, 384, 320))
+ocn_3d = (("time", "z_t", "nlat", "nlon"), (120, 60, 384, 320))
+file_tlens = [120] * 16 + [60]
+
+
+@pytest.mark.parametrize("field", [ocn_2d, ocn_3d])
+@pytest.mark.parametrize("method", ["dense", "labelmap", "exact"])
+def test_plan(field, method):
+    vardims, varshape = field
+    plan = plan_tseries_gen(
+        vardims, varshape, "float32", file_tlens, method, "9GB", overrides={}
+    )
+    time_chunksize = plan["time_chunksize"]
+
+    # time chunks and blocks do not span files, and are aligned to years
+    assert 60 % time_chunksize == 0
+    assert 12 % time_chunksize == 0 or time_chunksize % 12 == 0
+    assert plan["time_step"] % time_chunksize == 0
+    assert plan["time_step"] % 12 == 0
+    assert plan["nblocks"] * plan["time_step"] >= sum(file_tlens)
+    assert (plan["nblocks"] - 1) * plan["time_step"] < sum(file_tlens)
+
+    # tasks fit in memory budget
+    chunk_len = time_chunksize
+    for dim, dimlen in zip(vardims[1:], varshape[1:]):
+        chunk_len *= plan["spatial_chunks"].get(dim, dimlen)
+    task_bytes = chunk_len * 8 * task_mem_factors[method]
+    assert task_bytes <= worker_mem_frac * 9.0e9
+
+    # there is enough work for the cluster
+    assert plan["workers"] == workers_max
+
+    assert bool(plan["spatial_chunks"]) == (method == "exact")
+
+
+def test_plan_small():
+    # small fields in a single file are not split into tiny chunks
+    plan = plan_tseries_gen(
+        ("time", "lat", "lon"), (24, 16, 32), "float64", [24], overrides={}
+    )
+    assert plan == {
+        "time_chunksize": 24,
+        "spatial_chunks": {},
+        "time_step": 24,
+        "nblocks": 1,
+        "workers": 2,
+    }
+
+
+def test_plan_overrides(monkeypatch):
+    vardims, varshape = ocn_2d
+    monkeypatch.setenv("TSERIES_PLAN", "time_chunksize=6, workers=8")
+    plan = plan_tseries_gen(vardims, varshape, "float32", file_tlens)
+    assert plan["time_chunksize"] == 6
+    assert plan["workers"] == 8
+    # 2 tasks per worker, rounded to whole files
+    assert plan["time_step"] == 120
+
+    with pytest.raises(ValueError):
+        plan_tseries_gen(vardims, varshape, "float32", file_tlens, overrides={"x": 1})
+    with pytest.raises(ValueError):
+        parse_overrides("workers")
@@ -1,5 +1,8 @@
 #! /usr/bin/env python3
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 import cftime
 import numpy as np
@@ -14,6 +17,7 @@ from src.utils import (
     da_w_lags,
     smooth,
     regression_slope,
+    tmp_fname,
 )
 
 nyrs = 300
@@ -171,3 +175,14 @@ def test_regression_slope():
 
     slope = regression_slope(da_1d, da_nd)
     assert np.all(np.isclose(slope.values, expected_slope.values))
+
+
+def test_tmp_fname(tmp_path):
+    fname = str(tmp_path / "file.nc")
+    with ThreadPoolExecutor(4) as executor:
+        tmp_fnames = list(executor.map(lambda _: tmp_fname(fname), range(16)))
+    assert len(set(tmp_fnames)) == len(tmp_fnames)
+    for tmp_fname_loc in tmp_fnames:
+        assert os.path.dirname(tmp_fname_loc) == str(tmp_path)
+        assert tmp_fname_loc.startswith(fname)
+        assert not os.path.exists(tmp_fname_loc)
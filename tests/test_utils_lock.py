@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+
+import fcntl
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from src.utils_lock import GenLock
+
+
+def test_genlock(tmp_path):
+    path = str(tmp_path / "tseries.nc")
+    lock = GenLock(path)
+    assert not lock.held()
+    with lock:
+        assert lock.held()
+        assert GenLock(path).held()
+        assert not GenLock(path).acquire(blocking=False)
+        assert lock.holder()["pid"] == os.getpid()
+    assert not GenLock(path).held()
+    assert not os.path.exists(path + ".genlock")
+
+
+def test_genlock_held_no_lock(tmp_path, monkeypatch):
+    path = str(tmp_path / "tseries.nc")
+    with GenLock(path):
+        # held does not lock the lock file, which could make a concurrent
+        # non-blocking acquire fail
+        with monkeypatch.context() as mpatch:
+            mpatch.setattr(fcntl, "flock", None)
+            assert GenLock(path).held()
+        assert not GenLock(path).acquire(blocking=False)
+    assert not os.path.exists(path + ".genlock")
+
+
+def test_genlock_stale(tmp_path):
+    path = str(tmp_path / "tseries.nc")
+
+    # lock file left behind by an earlier version, or a crashed process
+    open(path + ".genlock", mode="w").close()
+    assert not GenLock(path).held()
+
+    # lock held by a process that exits without releasing it
+    script = (
+        "import os; from src.utils_lock import GenLock; "
+        f"GenLock({path!r}).acquire(); os._exit(0)"
+    )
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=os.getcwd())
+    assert os.path.exists(path + ".genlock")
+    assert not GenLock(path).held()
+    lock = GenLock(path)
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_genlock_wait(tmp_path):
+    path = str(tmp_path / "tseries.nc")
+    lock = GenLock(path)
+    lock.acquire()
+    timer = threading.Timer(0.5, lock.release)
+    timer.start()
+    time_start = time.time()
+    with GenLock(path):
+        # woken up when the lock is released, not by polling
+        assert 0.4 < time.time() - time_start < 2.0
+    timer.join()
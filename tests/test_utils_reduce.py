@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+
+from fractions import Fraction
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from src.utils_grid import CompactRegionMask
+from src.utils_reduce import (
+    RegionReducer,
+    nan_pattern_checksum,
+    _float_to_limbs,
+    _limbs_to_float,
+    _limb_cnt,
+)
+
+nlat, nlon, nz, ntime = 6, 8, 4, 5
+
+
+def gen_fields(vertical):
+    """return rmask, weight, da, reduce_dims for a synthetic grid"""
+    rng = np.random.RandomState(0)
+    lat = np.linspace(-75.0, 75.0, nlat)
+    lon = np.arange(nlon)[np.newaxis, :]
+    rmask_vals = np.stack(
+        [
+            np.ones((nlat, nlon)),
+            (lat[:, np.newaxis] < 0.0) * np.ones((nlat, nlon)),
+            np.zeros((nlat, nlon)),
+        ]
+    )
+    rmask_vals[:, 0, :] = 0.0
+    # regions that overlap the partition of the other regions
+    rmask_vals = np.concatenate([rmask_vals, rmask_vals[:2] * (lon >= 3)])
+    rmask = xr.DataArray(
+        rmask_vals,
+        dims=("region", "nlat", "nlon"),
+        coords={"region": ["Global", "SH", "empty", "Global_E", "SH_E"]},
+    )
+
+    area = xr.DataArray(
+        1.0 + rng.uniform(size=(nlat, nlon)),
+        dims=("nlat", "nlon"),
+        attrs={"units": "m2"},
+    )
+    dims = ("time", "nlat", "nlon")
+    if vertical:
+        dz = xr.DataArray(1.0 + rng.uniform(size=nz), dims=("z_t",))
+        weight = dz * area
+        weight.attrs["units"] = "m3"
+        dims = ("time", "z_t", "nlat", "nlon")
+        reduce_dims = ["z_t", "nlat", "nlon"]
+    else:
+        weight = area
+        reduce_dims = ["nlat", "nlon"]
+
+    shape = tuple(
+        {"time": ntime, "z_t": nz, "nlat": nlat, "nlon": nlon}[dim] for dim in dims
+    )
+    vals = rng.normal(size=shape).astype(np.float32)
+    vals[rng.uniform(size=shape) < 0.2] = np.nan
+    da = xr.DataArray(vals, dims=dims).chunk({"time": 2})
+
+    return rmask, weight, da, reduce_dims
+
+
+@pytest.mark.parametrize("vertical", [False, True])
+def test_dense_reducer(vertical):
+    rmask, weight, da, reduce_dims = gen_fields(vertical)
+    reducer = RegionReducer(rmask, weight, reduce_dims, "dense")
+
+    weight_region = rmask * weight
+    numer = (da * weight_region).sum(dim=reduce_dims)
+    denom = (xr.ones_like(da).where(da.notnull()) * weight_region).sum(dim=reduce_dims)
+
+    assert reducer.integral(da).identical(numer)
+    assert reducer.average(da).identical(numer / denom)
+    assert reducer.weight_sum(da).identical(denom)
+
+
+@pytest.mark.parametrize("vertical", [False, True])
+@pytest.mark.parametrize("op", ["integral", "average", "weight_sum"])
+@pytest.mark.parametrize("method", ["sparse", "labelmap", "exact"])
+@pytest.mark.parametrize("compact", [False, True])
+def test_reducer(vertical, op, method, compact):
+    rmask, weight, da, reduce_dims = gen_fields(vertical)
+    expected = getattr(RegionReducer(rmask, weight, reduce_dims, "dense"), op)(da)
+    if compact:
+        rmask = CompactRegionMask.from_dense(rmask)
+    reducer = RegionReducer(rmask, weight, reduce_dims, method)
+    assert reducer.method == method
+    result = getattr(reducer, op)(da)
+
+    assert result.dims == expected.dims
+    assert (result["region"] == expected["region"]).all()
+    xr.testing.assert_allclose(result, expected.transpose(*result.dims))
+
+
+@pytest.mark.parametrize("vertical", [False, True])
+def test_exact_reducer(vertical):
+    rmask, weight, da, reduce_dims = gen_fields(vertical)
+    # values spanning many orders of magnitude, so that sums depend on order
+    da = da * 10.0 ** (8 * da)
+    reducer = RegionReducer(rmask, weight, reduce_dims, "exact")
+    result = reducer.integral(da)
+
+    # results are correctly rounded exact sums
+    products = (da.astype(np.float64) * weight).transpose("time", *reduce_dims)
+    for region_ind in [0, 3]:
+        mask = rmask.isel(region=region_ind).values != 0.0
+        for time_ind in range(ntime):
+            vals = products.isel(time=time_ind).values[..., mask]
+            expected = float(sum(Fraction(val) for val in vals[~np.isnan(vals)]))
+            assert result.values[time_ind, region_ind] == expected
+
+    # results are independent of chunking, including over reduce_dims
+    for chunks in [{"time": 1}, {"nlat": 2, "nlon": 3}, {"time": 3, "nlat": 1}]:
+        if vertical:
+            chunks["z_t"] = 1
+        assert reducer.integral(da.chunk(chunks)).identical(result)
+        assert reducer.average(da.chunk(chunks)).identical(reducer.average(da))
+
+
+def test_exact_reducer_inf():
+    rmask, weight, da, reduce_dims = gen_fields(vertical=False)
+    reducer = RegionReducer(rmask, weight, reduce_dims, "exact")
+    vals = da.values.copy()
+    vals[0, 1, 1] = np.inf
+    vals[1, 1, 1] = -np.inf
+    vals[1, 1, 2] = np.inf
+    vals[2, 1, 1] = 1.0e308
+    vals[2, 1, 2] = 1.0e308
+    result = reducer.integral(da.copy(data=vals)).isel(region=0).values
+    assert result[0] == np.inf
+    assert np.isnan(result[1])
+    assert result[2] == np.inf
+
+
+def test_limbs_to_float():
+    rng = np.random.RandomState(0)
+    # sums of values of mixed signs, spanning the range of float64, sums that are
+    # ties, or are broken by small values, and sums that are subnormal or overflow
+    vals_list = [
+        rng.normal(size=5) * 10.0 ** rng.randint(-300, 300, size=5) for _ in range(100)
+    ]
+    vals_list += [
+        [1.0, 2.0**-53],
+        [1.0, 2.0**-53, 2.0**-1000],
+        [-1.0, -(2.0**-53), -(2.0**-1074)],
+        [1.0 + 2.0**-52, 2.0**-53],
+        [5.0e-324, 5.0e-324, 2.0**-1023],
+        [2.0**-1022, -(2.0**-1074)],
+        [1.0e308, 1.0e308],
+        [-1.0e308, -1.0e308],
+        [1.0, -1.0],
+        [0.0],
+    ]
+    limbs = np.zeros((len(vals_list), _limb_cnt + 2), dtype=np.int64)
+    for row, vals in zip(limbs, vals_list):
+        limb_inds, limb_vals = _float_to_limbs(np.array(vals))
+        np.add.at(row, limb_inds.ravel(), limb_vals.ravel())
+    result = _limbs_to_float(limbs)
+    for val, vals in zip(result, vals_list):
+        total = sum(Fraction(val) for val in vals)
+        try:
+            expected = float(total)
+        except OverflowError:
+            expected = np.inf if total > 0 else -np.inf
+        assert val == expected
+
+
+def test_reducer_fallback():
+    # weight that is not defined on all of reduce_dims is reduced densely
+    rmask, weight, da, _ = gen_fields(vertical=True)
+    reducer = RegionReducer(rmask, weight.isel(z_t=0), ["nlat", "nlon"], "sparse")
+    assert reducer.method == "sparse"
+    reducer = RegionReducer(rmask, weight, ["nlat", "nlon"], "sparse")
+    assert reducer.method == "dense"
+
+
+def test_bad_method():
+    rmask, weight, _, reduce_dims = gen_fields(vertical=False)
+    with pytest.raises(ValueError):
+        RegionReducer(rmask, weight, reduce_dims, "not_a_method")
+
+
+def test_compact_region_mask():
+    rmask, _, _, _ = gen_fields(vertical=False)
+    rmask_compact = CompactRegionMask.from_dense(rmask)
+    assert rmask_compact.dense().identical(rmask)
+    assert sorted(rmask_compact.partition + rmask_compact.overlap) == list(range(5))
+    assert rmask_compact.nbytes < rmask.nbytes / 16
+
+
+@pytest.mark.parametrize("vertical", [False, True])
+@pytest.mark.parametrize("method", ["dense", "sparse", "labelmap", "exact"])
+def test_average_weight_sum(vertical, method):
+    rmask, weight, da, reduce_dims = gen_fields(vertical)
+    # NaN pattern of first time, at all times
+    da = da.fillna(1.0).where(da.isel(time=0).notnull())
+    reducer = RegionReducer(rmask, weight, reduce_dims, method)
+    weight_sum = reducer.weight_sum(da.isel(time=0, drop=True))
+    xr.testing.assert_allclose(reducer.average(da, weight_sum), reducer.average(da))
+
+
+def test_nan_pattern_checksum():
+    _, _, da, reduce_dims = gen_fields(vertical=True)
+    checksum = nan_pattern_checksum(da, reduce_dims)
+    assert checksum.dims == ("time",)
+    assert len(np.unique(checksum.values)) == ntime
+    da_invariant = da.fillna(1.0).where(da.isel(time=0).notnull())
+    checksum = nan_pattern_checksum(da_invariant, reduce_dims)
+    assert (checksum == checksum.isel(time=0)).all()
+    # checksum is independent of chunking
+    checksum_chunked = nan_pattern_checksum(da_invariant.chunk({"z_t": 1}), reduce_dims)
+    assert checksum_chunked.identical(checksum)
@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+
+import os
+
+import pytest
+import yaml
+
+from src.config import var_specs_fname
+from src.var_specs import VarSpecs, get_var_specs
+
+
+@pytest.mark.parametrize(
+    "component, varname, stream, reduce_dims, tseries_op, unit_conv, display_units",
+    [
+        (
+            "atm",
+            "CO2",
+            "cam.h0",
+            ["lat", "lon"],
+            "average",
+            "(28.966 g)/(44 g)",
+            "ppmv",
+        ),
+        (
+            "atm",
+            "SFCO2",
+            "cam.h0",
+            ["lat", "lon"],
+            "integrate",
+            "(12 g)/(44 g)",
+            "Pg yr-1",
+        ),
+        ("ice", "aice", "cice.h", ["nj", "ni"], "integrate", None, "10^12 m2"),
+        ("ocn", "not_a_var", "pop.h", ["nlat", "nlon"], "average", None, None),
+    ],
+)
+def test_var_specs(
+    component, varname, stream, reduce_dims, tseries_op, unit_conv, display_units
+):
+    var_specs = get_var_specs()
+    assert var_specs.stream(component, varname) == stream
+    assert var_specs.reduce_dims(component, varname) == reduce_dims
+    assert var_specs.tseries_op(component, varname) == tseries_op
+    assert var_specs.unit_conv(component, varname) == unit_conv
+    assert var_specs.display_units(component, varname) == display_units
+    assert var_specs.varname_resolved(component, varname) == varname
+    assert var_specs.resolved_spec(component, varname) == {
+        "varname": varname,
+        "reduce_dims": reduce_dims,
+        "tseries_op": tseries_op,
+        "unit_conv": unit_conv,
+        "display_units": display_units,
+    }
+
+
+def test_get_var_specs_memo(tmp_path):
+    fname = str(tmp_path / "var_specs.yaml")
+    with open(var_specs_fname, mode="r") as fptr:
+        specs = yaml.safe_load(fptr)
+    with open(fname, mode="w") as fptr:
+        yaml.dump(specs, fptr)
+
+    var_specs = get_var_specs(fname)
+    assert get_var_specs(fname) is var_specs
+
+    # modify file, verify that it is reloaded
+    specs["ocn"]["stream"] = "pop.h.nday1"
+    with open(fname, mode="w") as fptr:
+        yaml.dump(specs, fptr)
+    os.utime(fname, ns=(0, 0))
+    assert get_var_specs(fname) is not var_specs
+    assert get_var_specs(fname).stream("ocn") == "pop.h.nday1"
+
+
+@pytest.mark.parametrize(
+    "var_spec",
+    [
+        {"unit_conv": "(12 g)/(44 not_a_unit)"},
+        {"display_units": "not_a_unit"},
+        {"tseries_op": "not_an_op"},
+    ],
+)
+def test_var_specs_invalid(tmp_path, var_spec):
+    fname = str(tmp_path / "var_specs.yaml")
+    with open(var_specs_fname, mode="r") as fptr:
+        specs = yaml.safe_load(fptr)
+    specs["ocn"]["vars"]["bad_var"] = var_spec
+    with open(fname, mode="w") as fptr:
+        yaml.dump(specs, fptr)
+
+    with pytest.raises(ValueError, match="bad_var"):
+        VarSpecs(fname)